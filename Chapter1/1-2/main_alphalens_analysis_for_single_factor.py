@@ -106,21 +106,19 @@ fundamental_features_list = result["fundamental_features"]
 # print(f"總計有{len(fundamental_features_list)}個因子")
 
 """
-使用 for 迴圈從 FinLab 獲取多個因子的資料。
-將所有因子資料儲存到字典 factors_data_dict 中，鍵為因子名稱，值為對應的因子資料。
+一次從 FinLab 獲取多個因子的資料。
+factor_name 傳入因子名稱列表，回傳對齊到交易日的 FactorCube（日期 x 股票 x 因子），
+用 factors_cube.factor(因子名稱) 取出單一因子的寬表。
 """
-factors_data_dict = {}
-for factor in fundamental_features_list:
-    factor_data = chap1_utils.get_factor_data(
-        stock_symbols=top_N_stocks,
-        factor_name=factor,
-        trading_days=list(close_price_data.index),
-    )
-    factors_data_dict[factor] = factor_data
+factors_cube = chap1_utils.get_factor_data(
+    stock_symbols=top_N_stocks,
+    factor_name=fundamental_features_list,
+    trading_days=list(close_price_data.index),
+)
 # 使用 Alphalens 進行因子分析
 for factor_name in fundamental_features_list[41:]:
     print(f"factor: {factor_name}")
-    factor_series = factors_data_dict[factor_name].stack().droplevel(2)
+    factor_series = factors_cube.factor(factor_name).stack()
     factor_series.index.names = ["date", "asset"]
     factor_series = factor_series.rename(lambda x: f"{x}.TW", level="asset")
 
@@ -43,40 +43,15 @@ all_factors_list = [
     "經常稅後淨利",
 ]
 # 取得 FinLab 多個因子資料
-# 將多個因子資料整合(concat)成一個資料集
-factors_data_dict = {}
-for factor in all_factors_list:
-    # factor_data = chap1_utils.get_factor_data(
-    #     stock_symbols=top_N_stocks,
-    #     factor_name=factor,
-    #     trading_days=list(close_price_data.index),
-    # )
-    # factor_data = factor_data.reset_index()
-    # factor_data = factor_data.assign(factor_name=factor)
-
-    # 下方優化上方程式碼，直接在一行內完成資料的取得、重置索引和新增因子名稱欄位的操作
-    factor_data = (
-        chap1_utils.get_factor_data(
-            stock_symbols=top_N_stocks,
-            factor_name=factor,
-            trading_days=list(close_price_data.index),
-        )
-        .reset_index()
-        .assign(factor_name=factor)
-        # .dropna()
-    )
-    factors_data_dict[factor] = factor_data
-    # print(f"已取得因子 {factor} 的資料，資料的前 5 行：\n{factor_data.head()}\n")
-
-# 將所有因子資料合併成一個 DataFrame
-concat_factors_data = pd.concat(factors_data_dict.values(), ignore_index=True)
-# 將資料格式轉換為索引是 datetime 和 asset，欄位名稱是因子名稱
-# pivot_table 用於將長格式的資料展開轉換為寬格式(P1-101)
-concat_factors_data = concat_factors_data.pivot_table(
-    index=["datetime", "asset"],
-    columns="factor_name",
-    values="value",
+# factor_name 傳入因子列表，所有因子共用同一次交易日對齊，回傳 FactorCube（日期 x 股票 x 因子）
+factors_cube = chap1_utils.get_factor_data(
+    stock_symbols=top_N_stocks,
+    factor_name=all_factors_list,
+    trading_days=list(close_price_data.index),
 )
+# 將資料格式轉換為索引是 datetime 和 asset，欄位名稱是因子名稱
+# 直接由三維陣列攤平，不需要再 concat 後用 pivot_table 展開(P1-101)
+concat_factors_data = factors_cube.to_frame()
 # 處理異常值和遺失值，將無窮大的值替換為 NaN，並透過向前填補的方法填補遺失值
 concat_factors_data.replace([np.inf, -np.inf], np.nan, inplace=True)
 
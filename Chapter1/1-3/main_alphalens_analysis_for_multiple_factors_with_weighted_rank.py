@@ -42,19 +42,16 @@ pos_corr_factors = [
     "稅前淨利成長率",
     "稅後淨利成長率",
 ]
-# 從 FinLab 取得多個因子資料，並將這些資料儲存在 factors_data_dict 字典中，字典的鍵是因子名稱，值是對應的因子資料。
+# 從 FinLab 一次取得多個因子資料（FactorCube：日期 x 股票 x 因子），
+# 再轉成 factors_data_dict 字典，字典的鍵是因子名稱，值是對應的因子資料（欄位 datetime、asset、value）。
+factors_data = chap1_utils.get_factor_data(
+    stock_symbols=top_N_stocks,
+    factor_name=pos_corr_factors,
+    trading_days=list(close_price_data.index),
+).to_frame()
 factors_data_dict = {}
 for factor in pos_corr_factors:
-    factor_data = (
-        chap1_utils.get_factor_data(
-            stock_symbols=top_N_stocks,
-            factor_name=factor,
-            trading_days=list(close_price_data.index),
-        )
-        .reset_index()
-        .assign(factor_name=factor)
-    )
-    factors_data_dict[factor] = factor_data
+    factors_data_dict[factor] = factors_data[factor].rename("value").reset_index()
 # 根據各個因子（欄位：value）對股票進行排序，排序後的結果存放在 ranked_factors_data_dict 字典中，字典的鍵是因子名稱，值為排名結果。
 rank_factors_data_dict = {}
 for factor in factors_data_dict:
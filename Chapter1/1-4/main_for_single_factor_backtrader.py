@@ -35,10 +35,9 @@ all_stock_data = chap1_utils.get_daily_OHLCV_data(
     stock_symbols=top_N_stocks,
     start_date=analysis_period_start_date,
     end_date=analysis_period_end_date,
+    compact=True,  # 精簡型別：價格 float32、asset 為 category、datetime 為 datetime64，節省記憶體並加快合併
 )
 print(all_stock_data)
-all_stock_data["datetime"] = all_stock_data["datetime"].astype(str)
-all_stock_data["asset"] = all_stock_data["asset"].astype(str)
 # 指定各個季度下要使用來排序的因子
 # name 對應的是每個季度的因子名稱
 # corr 對應的是因子值與未來收益的關係（根據單因子 Alphalens 分析結果）
@@ -74,6 +73,7 @@ for quarter, factor in select_rank_factor_dict.items():
             stock_symbols=top_N_stocks,
             factor_name=factor["name"],
             trading_days=list(trading_days),
+            compact=True,
         )
         .reset_index()
         .assign(factor_name=factor["name"])
@@ -88,13 +88,18 @@ for quarter, factor in select_rank_factor_dict.items():
         positive_corr=factor["corr"],  # 根據因子相關性決定的排序方向
         rank_column="value",  # 用來排序的欄位名稱
         rank_result_column="rank",  # 儲存排序結果的欄位名稱
+        compact=True,
     ).drop(columns=["value"])
     # 合併該季度的因子數據
     all_factor_data = pd.concat([all_factor_data, quarter_factor_data])
-# 重設索引並將日期與股票代碼轉換為字串格式
+# 重設索引；日期維持 datetime64，股票代碼改用 category，直接以整數代碼合併，不再轉成字串
+# 有因子但沒下載到股價的股票不在股價數據的類別中，直接 astype 會變成 NaN，所以兩邊都改用聯集的類別
 all_factor_data = all_factor_data.reset_index(drop=True)
-all_factor_data["datetime"] = all_factor_data["datetime"].astype(str)
-all_factor_data["asset"] = all_factor_data["asset"].astype(str)
+asset_dtype = pd.CategoricalDtype(
+    all_stock_data["asset"].cat.categories.union(pd.Index(all_factor_data["asset"].unique()))
+)
+all_stock_data["asset"] = all_stock_data["asset"].astype(asset_dtype)
+all_factor_data["asset"] = all_factor_data["asset"].astype(asset_dtype)
 # 將因子數據與股價數據進行合併
 all_stock_and_all_factor_data = pd.merge(
     all_stock_data, all_factor_data, on=["datetime", "asset"], how="outer"
@@ -102,7 +107,7 @@ all_stock_and_all_factor_data = pd.merge(
 # 站股票代碼和日期排序並填補遺失值
 all_stock_and_all_factor_data = (
     all_stock_and_all_factor_data.sort_values(by=["asset", "datetime"])
-    .groupby("asset", group_keys=False)
+    .groupby("asset", group_keys=False, observed=True)
     .apply(lambda group: group.ffill())
     .reset_index(drop=True)
 )
@@ -1,10 +1,12 @@
-import os, finlab
+import os, re, json, time, threading, finlab
 import yfinance as yf
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from typing_extensions import Annotated
-from typing import Tuple, Iterable, Annotated
+from typing import Tuple, Iterable, Callable, NamedTuple, Annotated
 from finlab import data
 
 # current_folder = os.path.dirname(__file__) # 目前程式檔案所在的資料夾相對路徑
@@ -14,6 +16,17 @@ def get_parent_dir(levels=1):
     return Path(__file__).parent.relative_to(Path(__file__).anchor) if levels == 0 else Path(__file__).parents[levels - 1]
 
 
+# FinLab 資料集本地快取設定：存放資料夾、有效期限(秒)、快取總容量上限(位元組)
+FINLAB_CACHE_DIR = get_parent_dir(2) / ".cache" / "finlab"
+FINLAB_CACHE_TTL = 24 * 60 * 60
+FINLAB_CACHE_MAX_BYTES = 2 * 1024**3
+
+# 本地收盤價資料庫：每檔股票一個 Parquet 檔，manifest.json 記錄每檔股票已保存的日期範圍
+PRICE_STORE_DIR = get_parent_dir(2) / ".cache" / "prices"
+# yf.download 共用模組層級的結果暫存(yfinance.shared._DFS)，同一時間只能有一個呼叫
+_YF_DOWNLOAD_LOCK = threading.Lock()
+
+
 def finlab_login() -> None:
     """
     函式說明：使用 FinLab API token 登入 FinLab
@@ -31,6 +44,90 @@ def finlab_login() -> None:
     finlab.login(api_token=api_token)
 
 
+def get_finlab_data(
+    dataset: Annotated[str, "FinLab 資料集名稱", "例如 price:收盤價、company_basic_info"],
+    deadline: Annotated[bool, "是否先把索引轉為財報截止日(.deadline())再快取"] = False,
+    use_cache: Annotated[bool, "是否使用本地快取"] = True,
+) -> Annotated[pd.DataFrame, "FinLab 資料表(pd.DataFrame)"]:
+    """
+    函式說明：
+    透過本地快取取得 FinLab 資料集(dataset)，避免每次執行都重新下載、解析同一張寬表。
+    快取以 Parquet(欄式儲存)檔案存放，路徑為 FINLAB_CACHE_DIR/資料集名稱/快照日期.parquet：
+    1. 最新快照在有效期限(FINLAB_CACHE_TTL)內，直接讀取快照
+    2. 否則重新從 FinLab 下載，寫入當日快照並刪除同資料集的舊快照
+    3. 寫入後若快取總容量超過 FINLAB_CACHE_MAX_BYTES，依最近使用時間由舊到新刪除快照
+    備註：data.get 回傳的是 FinlabDataFrame，讀回快取後為 pd.DataFrame，
+    因此需要 .deadline() 的資料集要用 deadline=True，在寫入快取前先轉換。
+    """
+    dataset_dir = FINLAB_CACHE_DIR / _to_cache_name(
+        f"{dataset}@deadline" if deadline else dataset
+    )
+    if use_cache:
+        snapshot = _get_latest_snapshot(dataset_dir)
+        if snapshot is not None and time.time() - snapshot.stat().st_mtime < FINLAB_CACHE_TTL:
+            try:
+                df = pd.read_parquet(snapshot)
+                # 更新存取時間，做為容量淘汰時的最近使用依據
+                os.utime(snapshot, (time.time(), snapshot.stat().st_mtime))
+                return df
+            except Exception as e:
+                print(f"[warn] 讀取快取 {snapshot} 失敗，改為重新下載：{e}")
+
+    df = data.get(dataset)
+    if deadline:
+        df = df.deadline()
+    # 複製一份，避免後續修改欄名時動到 FinLab 內部的資料
+    df = pd.DataFrame(df).copy()
+
+    if use_cache:
+        _save_snapshot(df, dataset_dir)
+        _evict_finlab_cache(FINLAB_CACHE_MAX_BYTES)
+    return df
+
+
+def _to_cache_name(dataset: str) -> str:
+    # 資料集名稱含有 ":" 等檔名不允許的字元，統一替換成 "_"
+    return re.sub(r'[\\/:*?"<>|\s]', "_", dataset)
+
+
+def _get_latest_snapshot(dataset_dir: Path) -> Path | None:
+    # 快照檔名是 YYYY-MM-DD.parquet，依檔名排序即是依快照日期排序
+    if not dataset_dir.is_dir():
+        return None
+    snapshots = sorted(dataset_dir.glob("*.parquet"))
+    return snapshots[-1] if snapshots else None
+
+
+def _save_snapshot(df: pd.DataFrame, dataset_dir: Path) -> None:
+    snapshot_date = time.strftime("%Y-%m-%d")
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    target = dataset_dir / f"{snapshot_date}.parquet"
+    tmp = dataset_dir / f".{snapshot_date}.{os.getpid()}.tmp"
+    try:
+        df.to_parquet(tmp)
+        # 先寫暫存檔再替換，避免同時執行的程式讀到寫一半的檔案
+        os.replace(tmp, target)
+    except Exception as e:
+        print(f"[warn] 無法寫入快取 {target}，本次不使用快取：{e}")
+        tmp.unlink(missing_ok=True)
+        return
+    # 刪除同資料集較舊的快照
+    for old in dataset_dir.glob("*.parquet"):
+        if old != target:
+            old.unlink(missing_ok=True)
+
+
+def _evict_finlab_cache(max_bytes: int) -> None:
+    # 依最近使用時間(atime)由舊到新刪除快照，直到總容量不超過 max_bytes
+    snapshots = [(f, f.stat()) for f in FINLAB_CACHE_DIR.glob("*/*.parquet")]
+    total = sum(st.st_size for _, st in snapshots)
+    for f, st in sorted(snapshots, key=lambda x: x[1].st_atime):
+        if total <= max_bytes:
+            break
+        f.unlink(missing_ok=True)
+        total -= st.st_size
+
+
 def get_top_stocks_by_market_value(
     excluded_industry: Annotated[list[str], "需要排除特定產業類別列表"] = [],
     pre_list_date: Annotated[str, "上市日期需早於此指定日期"] = None,
@@ -44,7 +141,7 @@ def get_top_stocks_by_market_value(
     3. 選擇市值前 N 大的上市公司(top_n)
     """
     # 從 FinLab 取得公司基本資料表，內容包括公司股票代碼、公司名稱、上市日期和產業類別
-    company_info = data.get("company_basic_info")[
+    company_info = get_finlab_data("company_basic_info")[
         ["stock_id", "公司名稱", "上市日期", "產業類別", "市場別"]
     ]
     # 如果有指定要排除的產業類別，則過濾掉這些產業的公司
@@ -58,7 +155,7 @@ def get_top_stocks_by_market_value(
     # 如果有設定top_n條件，則選取市值前 N 大的公司股票代碼
     if top_n:
         # 從 Finlab 取得最新的個股市值數據表，並重設索引名稱為 market_value
-        market_value = pd.DataFrame(data.get("etl:market_value")) # 回傳一個以日期為 index、股票代號為欄位的表
+        market_value = get_finlab_data("etl:market_value") # 回傳一個以日期為 index、股票代號為欄位的表
         market_value = market_value[market_value.index == pre_list_date]
         market_value = market_value.reset_index().melt(
             id_vars="date", var_name="stock_id", value_name="market_value"
@@ -73,11 +170,87 @@ def get_top_stocks_by_market_value(
         return company_info["stock_id"].tolist() # ["1101", "1102", "1216", ...]
 
 
+def get_universe_mask(
+    rebalance_dates: Annotated[
+        Iterable[pd.Timestamp] | pd.DatetimeIndex, "再平衡日期列表"
+    ],
+    excluded_industry: Annotated[list[str], "需要排除特定產業類別列表"] = [],
+    min_listed_days: Annotated[int, "再平衡日當天至少已上市的天數"] = 0,
+    top_n: Annotated[int, "每個再平衡日市值前 N 大的公司"] = None,
+    market: Annotated[str | None, "市場別(sii: 上市, otc: 上櫃)，None 表示不篩選"] = "sii",
+) -> Annotated[
+    pd.DataFrame,
+    "成分股遮罩(布林值)",
+    "index=再平衡日期(datetime)，columns=股票代碼(asset)，True 表示該日為成分股",
+]:
+    """
+    函式說明：
+    一次計算所有再平衡日(rebalance_dates)的股票池，條件與 get_top_stocks_by_market_value 相同，但每個日期各自判斷：
+    1. 排除特定產業的公司(excluded_industry)
+    2. 再平衡日當天已上市滿 min_listed_days 天
+    3. 以再平衡日當天(含)以前最近一筆市值，選出市值前 N 大的公司(top_n)
+    全部以 日期 x 股票 的陣列運算完成，不逐日 melt / merge。
+    回傳的遮罩可以傳給 get_factor_data、rank_stocks_by_factor 的 universe_mask，跳過非成分股的計算。
+    """
+    dates = _to_trading_days(rebalance_dates)
+    company_info = get_finlab_data("company_basic_info")[
+        ["stock_id", "上市日期", "產業類別", "市場別"]
+    ].drop_duplicates("stock_id")
+    # 產業、市場別不隨時間變動，先篩掉
+    if excluded_industry:
+        company_info = company_info[~company_info["產業類別"].isin(excluded_industry)]
+    if market:
+        company_info = company_info[company_info["市場別"] == market]
+    assets = pd.Index(company_info["stock_id"].astype(str), name="asset")
+
+    # 上市日期 + min_listed_days 早於再平衡日才算成分股(上市日期缺失者視為不符合)
+    list_date = pd.to_datetime(company_info["上市日期"], errors="coerce").to_numpy()
+    member = (
+        list_date[None, :] + np.timedelta64(min_listed_days, "D")
+    ) < dates.to_numpy()[:, None]
+
+    if top_n:
+        # 每個再平衡日取當天(含)以前最近一筆市值，避免用到未來資料
+        market_value = get_finlab_data("etl:market_value")
+        market_value.index = pd.to_datetime(market_value.index)
+        market_value.columns = pd.Index(market_value.columns).astype(str)
+        market_value = (
+            market_value.sort_index().reindex(columns=assets).reindex(dates, method="ffill")
+        )
+        # 非成分股的市值設為 NaN 不參與排名，再依市值由大到小排名取前 N 名
+        values = np.where(member, market_value.to_numpy(dtype=float), np.nan)
+        rank = pd.DataFrame(values).rank(axis=1, ascending=False, method="first")
+        member &= (rank <= top_n).to_numpy()
+
+    return pd.DataFrame(member, index=dates.rename("datetime"), columns=assets)
+
+
+def _lookup_universe_mask(
+    universe_mask: Annotated[pd.DataFrame, "get_universe_mask 回傳的成分股遮罩"],
+    dates: Annotated[Iterable[pd.Timestamp], "日期"],
+    assets: Annotated[Iterable[str], "股票代碼"],
+    outer: Annotated[bool, "True 回傳 日期 x 股票 的二維結果，False 逐筆對應 (dates[i], assets[i])"] = False,
+) -> Annotated[np.ndarray, "布林陣列，True 表示為成分股"]:
+    """
+    函式說明：
+    查詢 (日期, 股票) 是否為成分股：每個日期使用當天(含)以前最近一次再平衡的名單；
+    第一個再平衡日之前的日期、或不在遮罩中的股票都視為非成分股。
+    """
+    row = universe_mask.index.searchsorted(pd.DatetimeIndex(dates), side="right") - 1
+    col = universe_mask.columns.get_indexer(pd.Index(assets).astype(str))
+    if outer:
+        row, col = row[:, None], col[None, :]
+    values = universe_mask.to_numpy(dtype=bool)
+    return values[np.maximum(row, 0), np.maximum(col, 0)] & (row >= 0) & (col >= 0)
+
+
 def get_daily_close_prices_data(
     stock_symbols: Annotated[list[str], "股票代碼列表"],
     start_date: Annotated[str, "起始日期", "YYYY-MM-DD"],
     end_date: Annotated[str, "結束日期", "YYYY-MM-DD"],
     is_tw_stock: Annotated[bool, "stock_symbols 是否是台灣股票"] = True,
+    incremental: Annotated[bool, "是否使用本地收盤價資料庫，只下載缺少的最新資料"] = False,
+    compact: Annotated[bool, "是否使用精簡型別(float32 數值、category 股票代碼、datetime64 日期)以節省記憶體"] = False,
 ) -> Annotated[
     pd.DataFrame,
     "每日股票收盤價資料表",
@@ -95,6 +268,9 @@ def get_daily_close_prices_data(
     Close: 收盤價，指股票在該交易日結束時的價格。
     Adj Close: 調整後收盤價，將股票分割和股息等因素考慮進去後的收盤價。
     Volumn: 交易量，表示在該交易日內買賣該股票的總股數。
+    incremental=True 時改從本地收盤價資料庫(PRICE_STORE_DIR)讀取，
+    每檔股票只向 yfinance 下載資料庫最後一筆日期之後的資料並追加保存。
+    compact=True 時收盤價改用 float32 保存。
     """
     # yfinance 需要 .TW
     yf_symbols = stock_symbols
@@ -113,14 +289,18 @@ def get_daily_close_prices_data(
             for symbol in stock_symbols
         ]
     
-    # 從 YFinance 下載指定股票在給定日期範圍內的數據，並取出收盤價欄位(Close)的資料
-    stock_data = yf.download(yf_symbols, start=start_date, end=end_date)["Close"]
+    if incremental:
+        # 先把缺少的資料補進本地資料庫，再從資料庫讀出指定日期範圍
+        stock_data = _update_close_price_store(yf_symbols, start_date, end_date)
+    else:
+        # 從 YFinance 下載指定股票在給定日期範圍內的數據，並取出收盤價欄位(Close)的資料
+        with _YF_DOWNLOAD_LOCK:
+            stock_data = yf.download(yf_symbols, start=start_date, end=end_date)["Close"]
 
     # 若 yfinance 是空的(None)，改用FinLab
     if stock_data is None or stock_data.empty or stock_data.shape[0] == 0:
         # FinLab 取收盤價（index=日期, columns=股票代碼）
-        close = data.get("price:收盤價") # 因為這邊是 FinlabDataFrame，無法跟 Alphalens 的格式(pd.DateFrame)對齊
-        close = pd.DataFrame(close)
+        close = get_finlab_data("price:收盤價") # 快取讀回的是 pd.DataFrame，可以跟 Alphalens 的格式對齊
 
         # FinLab 欄位不含 .TW，所以先把 .TW 去掉再選
         finlab_symbols = [s.replace(".TW", "") for s in stock_symbols]
@@ -137,7 +317,8 @@ def get_daily_close_prices_data(
             close = pd.DataFrame(close)
             close.columns = [f"{finlab_symbols[0]}.TW"]
 
-        return close.ffill()
+        close = close.ffill()
+        return _to_compact(close) if compact else close
 
     # yfinance 成功：統一回 DataFrame
     stock_data = pd.DataFrame(stock_data)
@@ -146,7 +327,8 @@ def get_daily_close_prices_data(
     if len(yf_symbols) == 1:
         stock_data.columns = yf_symbols
 
-    return stock_data.ffill()
+    stock_data = stock_data.ffill()
+    return _to_compact(stock_data) if compact else stock_data
 
     # # 如果只取一支股票，將其轉換為 DataFrame 並設定欄位名稱為該股票代碼
     # if len(stock_symbols) == 1:
@@ -159,6 +341,133 @@ def get_daily_close_prices_data(
     # stock_data.columns = stock_data.columns.str.replace(".TW", "", regex=False)
     # return stock_data
 
+def _update_close_price_store(
+    yf_symbols: Annotated[list[str], "yfinance 股票代碼列表(帶 .TW)"],
+    start_date: Annotated[str, "起始日期", "YYYY-MM-DD"],
+    end_date: Annotated[str, "結束日期(不含)", "YYYY-MM-DD"],
+) -> Annotated[pd.DataFrame, "start_date~end_date 的收盤價寬表", "欄位為 yf_symbols"]:
+    """
+    函式說明：
+    依照 manifest.json 記錄的每檔股票已保存範圍，只下載缺少的部分並追加到本地收盤價資料庫：
+    1. 資料庫沒有該股票，或保存範圍晚於 start_date：下載 start_date~end_date 完整資料
+    2. 否則從最後保存日期的前一個交易日(settled)開始下載，追加在舊資料後面；
+       最後一天可能是盤中不完整的資料，所以一併重抓並以新下載的為準
+    3. yf.download 的收盤價是還原(auto_adjust)價格，除權息或分割後整段歷史都會改變，
+       因此只比對已經收盤確定的 settled 那天與資料庫保存的值，不一致時整檔重新下載，避免前後還原基準不同
+    4. 下載不到任何資料的股票記錄在 manifest(last 為 None)，之後只檢查新增的日期
+    manifest.json 先寫暫存檔再替換，中途中斷時不會留下寫一半的 manifest。
+    需要從同一天開始下載的股票會合併成一次 yf.download 呼叫。
+    """
+    close_dir = PRICE_STORE_DIR / "close"
+    close_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = PRICE_STORE_DIR / "manifest.json"
+    manifest = (
+        json.loads(manifest_path.read_text(encoding="utf-8"))
+        if manifest_path.exists()
+        else {}
+    )
+
+    # 依照下載起始日期將股票分組
+    fetch_groups = {}
+    for symbol in yf_symbols:
+        held = manifest.get(symbol)
+        if held is None or held["start"] > start_date:
+            fetch_start = start_date
+        elif held["last"] is None:
+            # 之前下載不到資料的股票，只檢查上次檢查之後的日期
+            fetch_start = held["checked"]
+        else:
+            fetch_start = held.get("settled") or held["last"]
+        if fetch_start < end_date:
+            fetch_groups.setdefault(fetch_start, []).append(symbol)
+
+    # 還原基準改變、需要整檔重新下載的股票，依照下載起始日期分組
+    refetch_groups = {}
+    for fetch_start, symbols in fetch_groups.items():
+        new_data = _download_close_prices(symbols, fetch_start, end_date)
+        for symbol in symbols:
+            tail = new_data[symbol].dropna() if symbol in new_data.columns else None
+            held = manifest.get(symbol)
+            start = min(held["start"], start_date) if held else start_date
+            path = close_dir / f"{symbol}.parquet"
+            if tail is None or tail.empty:
+                if held is None or held["last"] is None:
+                    manifest[symbol] = {"start": start, "last": None, "checked": end_date}
+                continue
+            # 把新資料接在舊資料後面，重複的日期以新下載的為準
+            if path.exists() and held is not None and held["last"] is not None:
+                old = pd.read_parquet(path)[symbol]
+                # 最後保存的那天可能是盤中資料，只比對它之前已經收盤確定的日期
+                overlap = old.index.intersection(tail.index)
+                overlap = overlap[overlap < held["last"]]
+                if len(overlap) and not np.allclose(
+                    old.loc[overlap].to_numpy(), tail.loc[overlap].to_numpy(), rtol=1e-6
+                ):
+                    refetch_groups.setdefault(start, []).append(symbol)
+                    continue
+                tail = pd.concat([old, tail])
+                tail = tail[~tail.index.duplicated(keep="last")].sort_index()
+            tail.to_frame(symbol).to_parquet(path)
+            manifest[symbol] = _close_price_manifest_entry(start, tail)
+
+    for fetch_start, symbols in refetch_groups.items():
+        new_data = _download_close_prices(symbols, fetch_start, end_date)
+        for symbol in symbols:
+            if symbol not in new_data.columns or new_data[symbol].dropna().empty:
+                continue
+            close = new_data[symbol].dropna()
+            # 以新的還原基準覆蓋整檔資料
+            close.to_frame(symbol).to_parquet(close_dir / f"{symbol}.parquet")
+            manifest[symbol] = _close_price_manifest_entry(fetch_start, close)
+
+    # 先寫暫存檔再替換，避免中斷時留下寫一半、與 parquet 不一致的 manifest
+    tmp = manifest_path.with_name(f".{manifest_path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, manifest_path)
+
+    # 從資料庫讀出需要的股票，並只保留 start_date~end_date 的資料
+    held_symbols = [s for s in yf_symbols if (close_dir / f"{s}.parquet").exists()]
+    if not held_symbols:
+        return pd.DataFrame()
+    close = pd.concat(
+        [pd.read_parquet(close_dir / f"{s}.parquet")[s] for s in held_symbols], axis=1
+    )
+    close = close[(close.index >= start_date) & (close.index < end_date)]
+    return close.reindex(columns=yf_symbols)
+
+
+def _close_price_manifest_entry(
+    start: Annotated[str, "保存範圍的起始日期", "YYYY-MM-DD"],
+    close: Annotated[pd.Series, "資料庫中保存的收盤價(依日期排序)"],
+) -> Annotated[dict, "manifest.json 中一檔股票的記錄"]:
+    # settled 是最後一天的前一個交易日，下次更新從這天開始下載，用來比對還原基準
+    dates = close.index.strftime("%Y-%m-%d")
+    return {
+        "start": start,
+        "last": dates[-1],
+        "settled": dates[-2] if len(dates) > 1 else None,
+    }
+
+
+def _download_close_prices(
+    symbols: Annotated[list[str], "yfinance 股票代碼列表(帶 .TW)"],
+    start_date: Annotated[str, "起始日期", "YYYY-MM-DD"],
+    end_date: Annotated[str, "結束日期(不含)", "YYYY-MM-DD"],
+) -> Annotated[pd.DataFrame, "收盤價寬表", "欄位為 symbols，下載失敗時為空表"]:
+    """
+    函式說明：
+    以一次 yf.download 下載 symbols 的收盤價，單檔時補上股票代碼欄名。
+    """
+    with _YF_DOWNLOAD_LOCK:
+        new_data = yf.download(symbols, start=start_date, end=end_date)
+    if new_data is None or new_data.empty:
+        return pd.DataFrame()
+    new_data = pd.DataFrame(new_data["Close"])
+    if len(symbols) == 1:
+        new_data.columns = symbols
+    return new_data
+
+
 # def get_factor_data(
 #         stock_symbols: Annotated[list[str], "股票代碼列表"],
 #         factor_name: Annotated[str, "因子名稱"],
@@ -200,18 +509,104 @@ def get_daily_close_prices_data(
 #     return factor_data
 
 
+class FactorCube(NamedTuple):
+    """
+    多個因子對齊後的三維資料：values[日期, 股票, 因子]，另外附上三個維度的座標標籤。
+    """
+
+    values: Annotated[np.ndarray, "因子值，形狀為 (len(dates), len(assets), len(factors))"]
+    dates: Annotated[pd.DatetimeIndex, "交易日"]
+    assets: Annotated[pd.Index, "股票代碼"]
+    factors: Annotated[list[str], "因子名稱"]
+
+    def factor(
+        self, factor_name: Annotated[str, "因子名稱"]
+    ) -> Annotated[pd.DataFrame, "單一因子的寬表，index=datetime，columns=股票代碼"]:
+        """
+        函式說明：取出單一因子的 日期 x 股票 寬表（不複製資料）。
+        """
+        return pd.DataFrame(
+            self.values[:, :, self.factors.index(factor_name)],
+            index=self.dates.rename("datetime"),
+            columns=self.assets.rename("asset"),
+        )
+
+    def to_frame(self) -> Annotated[
+        pd.DataFrame, "MultiIndex(datetime, asset)，欄位為因子名稱"
+    ]:
+        """
+        函式說明：把三維資料攤平成 MultiIndex(datetime, asset) x 因子 的資料表，取代 melt + pivot_table 的來回轉換。
+        """
+        index = pd.MultiIndex.from_product(
+            [self.dates, self.assets], names=["datetime", "asset"]
+        )
+        return pd.DataFrame(
+            self.values.reshape(-1, len(self.factors)),
+            index=index,
+            columns=pd.Index(self.factors, name="factor_name"),
+        )
+
+
+class LazyFactorData:
+    """
+    延遲轉換的因子資料：保存交易日寬表，第一次被當成長表使用時才轉換並快取結果。
+    可以直接當成 get_factor_data 回傳的長表使用（屬性與索引操作會轉給長表）。
+    """
+
+    def __init__(self, wide_data: Annotated[pd.DataFrame, "index=日期，columns=股票代碼"]):
+        self.wide = wide_data
+        self._long = None
+
+    def to_frame(self) -> Annotated[pd.DataFrame, "MultiIndex(datetime, asset) + column 'value'"]:
+        """
+        函式說明：取得長表，只在第一次呼叫時轉換。
+        """
+        if self._long is None:
+            self._long = _wide_to_long(self.wide)
+        return self._long
+
+    def __getattr__(self, name):
+        # 特殊方法(如 pickle/copy 會查詢的 __setstate__)不轉給長表，避免在物件尚未初始化時遞迴
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.to_frame(), name)
+
+    def __getitem__(self, key):
+        return self.to_frame()[key]
+
+    def __len__(self):
+        return self.wide.size
+
+    def __repr__(self):
+        return f"LazyFactorData(dates={len(self.wide.index)}, assets={len(self.wide.columns)})"
+
+
 def get_factor_data(
     stock_symbols: Annotated[list[str], "股票代碼列表"],
-    factor_name: Annotated[str, "因子名稱"],
+    factor_name: Annotated[str | list[str], "因子名稱；傳入列表時一次取得多個因子"],
     trading_days: Annotated[
         Iterable[pd.Timestamp] | pd.DatetimeIndex | None, "指定則把季頻擴展到這些交易日"
     ] = None,
+    lazy: Annotated[
+        bool, "有指定 trading_days 時，是否回傳 LazyFactorData，等到真正使用時才轉成長表"
+    ] = False,
+    compact: Annotated[bool, "是否使用精簡型別(float32 數值、category 股票代碼、datetime64 日期)以節省記憶體"] = False,
+    universe_mask: Annotated[
+        pd.DataFrame | None, "get_universe_mask 回傳的成分股遮罩；指定時非成分股的因子值設為 NaN"
+    ] = None,
 ) -> Annotated[
-    pd.DataFrame,
+    pd.DataFrame | FactorCube | LazyFactorData,
     "有指定 trading_days 時：MultiIndex(datetime, asset) + column 'value'；未指定時：index=datetime，columns=股票代碼",
+    "factor_name 為列表時：回傳 FactorCube(values[日期, 股票, 因子], dates, assets, factors)",
+    "lazy=True 時：回傳包裝交易日寬表的 LazyFactorData",
 ]:
     """
     從 FinLab 取得指定因子，選出目標股票；若指定 trading_days，則擴展為交易日頻率並長表化。
+    factor_name 為列表時，所有因子共用同一次交易日 reindex + ffill，直接回傳對齊好的三維資料(FactorCube)，
+    不再逐個因子 melt / sort / set_index 後又 pivot 回來。
+    compact=True 時因子值改用 float32（長表的 asset 索引本身就是整數代碼）。
+    指定 universe_mask 時（需搭配 trading_days），每個交易日只保留當時成分股的因子值，其餘設為 NaN；
+    沒有指定 stock_symbols 時，只處理曾經是成分股的股票。
     備註：
     finlab.data.get(dataset)
         時間序列資料
@@ -226,9 +621,71 @@ def get_factor_data(
     5) melt 成長表
     6) 設成 MultiIndex
     """
+    if universe_mask is not None:
+        if trading_days is None:
+            raise ValueError("指定 universe_mask 時必須指定 trading_days。")
+        if not stock_symbols:
+            stock_symbols = universe_mask.columns[universe_mask.any(axis=0)].tolist()
+
+    if not isinstance(factor_name, str):
+        return _get_factor_cube(
+            stock_symbols, list(factor_name), trading_days, compact, universe_mask
+        )
+
+    # 1) ~ 3) 讀因子、整理欄名、選股
+    factor_data = _get_factor_wide_data(stock_symbols, factor_name)
+    if compact:
+        factor_data = _to_compact(factor_data)
+
+    # 4) 若不要求交易日，直接回傳（寬表）
+    if trading_days is None:
+        return factor_data
+
+    # 5) 轉為交易日頻率：用 DatetimeIndex 對齊 + ffill（建議的 extend 寫法）
+    #    extend_factor_data 也可以用，但 reindex 更簡潔、效能好
+    #    先整理索引與交易日
+    factor_data = factor_data.sort_index()
+    td = _to_trading_days(trading_days)
+    out = (
+        factor_data.reindex(td)  # 對齊到交易日
+        .ffill()  # 向前填補(不用bfill向後填補是因為不能拿明天或未來的資料去填補，這樣等於是預先看見未來)
+    )
+    if universe_mask is not None:
+        out = out.where(_lookup_universe_mask(universe_mask, out.index, out.columns, outer=True))
+
+    # 6) 長表化 & 設定 MultiIndex
+    #    寬表的日期已經排好序，只需把股票欄位排序，就能直接組出 (datetime, asset) 索引，不必 melt 後再排序整張長表
+    if lazy:
+        return LazyFactorData(out)
+    return _wide_to_long(out)
+
+
+def _wide_to_long(
+    wide_data: Annotated[pd.DataFrame, "index=日期(已排序)，columns=股票代碼"],
+) -> Annotated[pd.DataFrame, "MultiIndex(datetime, asset) + column 'value'"]:
+    """
+    函式說明：
+    把日期已排序的寬表轉成依 (datetime, asset) 排序的長表。
+    只排序股票欄位(數量很少)，再用 MultiIndex.from_product 和攤平的陣列直接組出長表，結果與 melt + sort_values 相同。
+    """
+    assets = pd.Index(wide_data.columns)
+    order = assets.argsort(kind="stable")
+    values = wide_data.to_numpy()[:, order]
+    index = pd.MultiIndex.from_product(
+        [pd.Index(wide_data.index, name="datetime"), assets[order].rename("asset")]
+    )
+    return pd.DataFrame({"value": values.ravel()}, index=index)
+
+
+def _get_factor_wide_data(
+    stock_symbols: Annotated[list[str], "股票代碼列表"],
+    factor_name: Annotated[str, "因子名稱"],
+) -> Annotated[pd.DataFrame, "index=財報截止日，columns=股票代碼"]:
+    """
+    函式說明：讀取單一因子的原始寬表，整理欄名並選出目標股票。
+    """
     # 1) 讀因子（假設回傳的是 pandas.DataFrame，index=財報日，columns=股票代碼）
-    factor_data = data.get(f"fundamental_features:{factor_name}").deadline()
-    factor_data = factor_data.copy()
+    factor_data = get_finlab_data(f"fundamental_features:{factor_name}", deadline=True)
 
     # 2) 欄名正規化：全部轉字串、去空白（避免 '2330 ' / 2330 / '2330.TW' 類型落差）
     cols = pd.Index(factor_data.columns).astype(str).str.strip()
@@ -251,30 +708,75 @@ def get_factor_data(
             )
         factor_data = factor_data.reindex(columns=want)  # 不會丟 KeyError
 
-    # 4) 若不要求交易日，直接回傳（寬表）
-    if trading_days is None:
-        return factor_data
+    return factor_data
 
-    # 5) 轉為交易日頻率：用 DatetimeIndex 對齊 + ffill（建議的 extend 寫法）
-    #    extend_factor_data 也可以用，但 reindex 更簡潔、效能好
-    #    先整理索引與交易日
-    factor_data = factor_data.sort_index()
-    td = pd.DatetimeIndex(pd.to_datetime(list(trading_days))).unique().sort_values()
-    out = (
-        factor_data.reindex(td)  # 對齊到交易日
-        .ffill()  # 向前填補(不用bfill向後填補是因為不能拿明天或未來的資料去填補，這樣等於是預先看見未來)
-        .reset_index()
-        .rename(columns={"index": "datetime"})
-    )
 
-    # 6) 長表化 & 設定 MultiIndex
-    out = (
-        out.melt(id_vars="datetime", var_name="asset", value_name="value")
-        .sort_values(["datetime", "asset"])
-        .set_index(["datetime", "asset"])
+def _to_compact(
+    df: Annotated[pd.DataFrame, "資料表"],
+) -> Annotated[pd.DataFrame, "精簡型別後的資料表"]:
+    """
+    函式說明：
+    把資料表轉成精簡型別：浮點數欄位改為 float32，asset 欄位改為 category(整數代碼)，datetime 欄位轉為 datetime64。
+    整數欄位(例如成交量)維持原樣，避免 float32 的精度不足。
+    """
+    df = df.astype(
+        {c: "float32" for c, dtype in df.dtypes.items() if pd.api.types.is_float_dtype(dtype)}
     )
+    if "asset" in df.columns:
+        df["asset"] = df["asset"].astype("category")
+    if "datetime" in df.columns:
+        df["datetime"] = pd.to_datetime(df["datetime"])
+    return df
+
+
+def _to_trading_days(
+    trading_days: Annotated[Iterable[pd.Timestamp] | pd.DatetimeIndex, "交易日"],
+) -> Annotated[pd.DatetimeIndex, "去重並排序後的交易日"]:
+    return pd.DatetimeIndex(pd.to_datetime(list(trading_days))).unique().sort_values()
+
+
+def _get_factor_cube(
+    stock_symbols: Annotated[list[str], "股票代碼列表"],
+    factor_names: Annotated[list[str], "因子名稱列表"],
+    trading_days: Annotated[
+        Iterable[pd.Timestamp] | pd.DatetimeIndex, "把季頻擴展到這些交易日"
+    ],
+    compact: Annotated[bool, "是否以 float32 保存因子值"] = False,
+    universe_mask: Annotated[pd.DataFrame | None, "成分股遮罩，非成分股設為 NaN"] = None,
+) -> Annotated[FactorCube, "values[日期, 股票, 因子] 與座標標籤"]:
+    """
+    函式說明：
+    一次取得多個因子，所有因子並排成一張寬表後只做一次交易日 reindex + ffill，
+    再直接把底層陣列轉成 日期 x 股票 x 因子 的三維陣列。
+    """
+    if trading_days is None:
+        raise ValueError("一次取得多個因子時必須指定 trading_days。")
 
-    return out
+    wide_data = [_get_factor_wide_data(stock_symbols, factor) for factor in factor_names]
+    # 沒有指定股票時，取所有因子出現過的股票（保留第一次出現的順序）
+    assets = (
+        wide_data[0].columns
+        if stock_symbols
+        else pd.Index(dict.fromkeys(c for df in wide_data for c in df.columns))
+    )
+    # 欄位為 (因子, 股票) 的寬表：各因子自己的財報日合併成同一個日期索引
+    combined = pd.concat(
+        [df.reindex(columns=assets) for df in wide_data], axis=1, keys=factor_names
+    ).sort_index()
+    td = _to_trading_days(trading_days)
+    # 和單一因子相同：只保留交易日上的值，再向前填補
+    values = combined.reindex(td).ffill().to_numpy(dtype="float32" if compact else float)
+    # (日期, 因子 x 股票) -> (日期, 股票, 因子)
+    values = values.reshape(len(td), len(factor_names), len(assets)).transpose(0, 2, 1)
+    if universe_mask is not None:
+        member = _lookup_universe_mask(universe_mask, td, assets, outer=True)
+        values = np.where(member[:, :, None], values, np.nan).astype(values.dtype)
+    return FactorCube(
+        values=np.ascontiguousarray(values),
+        dates=td,
+        assets=pd.Index(assets),
+        factors=list(factor_names),
+    )
 
 
 def extend_factor_data(
@@ -345,6 +847,10 @@ def rank_stocks_by_factor(
     ],
     rank_column: Annotated[str, "用於排序的欄位名稱"],
     rank_result_column: Annotated[str, "保存排序結果的欄位名稱"] = "rank",
+    compact: Annotated[bool, "是否使用精簡型別(float32 數值、category 股票代碼、datetime64 日期)以節省記憶體"] = False,
+    universe_mask: Annotated[
+        pd.DataFrame | None, "get_universe_mask 回傳的成分股遮罩；指定時只對當天的成分股排名"
+    ] = None,
 ) -> Annotated[
     pd.DataFrame,
     "包含排序結果的資料表",
@@ -355,9 +861,16 @@ def rank_stocks_by_factor(
     根據某個指定因子的值(rank_column)對股票進行排序，遞增或遞減排序方式取決於因子與未來收益的相關性(positive_corr)。
     如果相關性為正，則將股票按因子值由小到大排序；如果相關性為負，則將股票按因子值由大到小排序。
     最後，將排序結果新增至原始因子資料表中，且指定排序結果欄位名稱為 rank_result_column。
+    指定 universe_mask 時，回傳結果只包含當天是成分股的資料。
     """
     # 複製因子資料表，以避免對原資料進行修改
-    ranked_df = factor_df.copy()
+    # 有指定成分股遮罩時，只複製當天是成分股的資料，非成分股不參與排名
+    if universe_mask is not None:
+        ranked_df = factor_df[
+            _lookup_universe_mask(universe_mask, factor_df["datetime"], factor_df["asset"])
+        ].copy()
+    else:
+        ranked_df = factor_df.copy()
     # 將 datetime 欄位設置為索引
     ranked_df = ranked_df.set_index("datetime")
     # 針對每一天的資料，根據指定的因子欄位進行排名
@@ -368,7 +881,7 @@ def rank_stocks_by_factor(
     ].rank(ascending=positive_corr)
     ranked_df = ranked_df.fillna(0)
     ranked_df.reset_index(inplace=True)
-    return ranked_df
+    return _to_compact(ranked_df) if compact else ranked_df
 
 
 def calculate_weighted_rank(
@@ -452,10 +965,23 @@ def get_daily_OHLCV_data(
     start_date: Annotated[str, "起始日期", "YYYY-MM-DD"],
     end_date: Annotated[str, "結束日期", "YYYY-MM-DD"],
     is_tw_stock: Annotated[bool, "stock_symbols 是否是台灣股票"] = True,
+    chunk_size: Annotated[int, "每次下載的股票數量"] = 100,
+    max_workers: Annotated[int, "同時下載的執行緒數量上限"] = 8,
+    download_fn: Annotated[
+        Callable[[list[str], str, str], pd.DataFrame] | None,
+        "下載一批股票的函式，回傳欄位為 (價量欄位, 股票代碼) 的 MultiIndex 寬表",
+        "預設每批呼叫一次 yf.download，沒有資料的股票再逐檔補抓，測試時可換成本地的替代資料來源",
+    ] = None,
+    compact: Annotated[bool, "是否使用精簡型別(float32 數值、category 股票代碼、datetime64 日期)以節省記憶體"] = False,
 ) -> Annotated[pd.DataFrame, "價量的資料集", "欄位名稱包含股票代碼、日期、開高低收量"]:
     """
     函式說明：
     取得指定股票(stock_symbols)在給定日期範圍內(stock_date ~ end_date)的每日價量資料。
+    股票代碼每 chunk_size 檔分成一批，每批只呼叫一次 yf.download(批次內由 yfinance 同時下載每檔股票)，
+    批次在最多 max_workers 個執行緒中處理：yf.download 依序執行，缺少資料的股票的逐檔補抓則同時進行，
+    再一次性把所有批次組成長表，不再逐檔整理後 concat。
+    沒有下載到任何資料的股票會印出警告，不會默默從結果中消失。
+    compact=True 時開高低收改用 float32、asset 改用 category。
     """
     # 如果是台灣股票，則在股票代碼後加上".TW"
     if is_tw_stock:
@@ -463,24 +989,133 @@ def get_daily_OHLCV_data(
             f"{symbol}.TW" if ".TW" not in symbol else symbol
             for symbol in stock_symbols
         ]
-    # 使用 pd.concat 合併多隻股票的數據
-    all_stock_data = pd.concat(
-        [
-            # 從 YFinance 下載每隻股票在指定日期範圍內的數據
-            pd.DataFrame(yf.download(symbol, start=start_date, end=end_date)).droplevel(
-                "Ticker", axis=1
-            )
-            # 新增一個 "asset" 的欄位，用來儲存股票代碼
-            .assign(asset=symbol.split(".")[0])
-            # 重設索引並將日期欄位名稱從 Date 改為 datetime
-            .reset_index().rename(columns={"Date": "datetime"})
-            # 使用向前填補的方法處理資料中的遺失值
-            .ffill()
-            for symbol in stock_symbols
-        ]
-    )
-    all_stock_data.columns.name = None
-    all_stock_data = all_stock_data[
-        ["Open", "High", "Low", "Close", "Volume", "datetime", "asset"]
+    download_fn = download_fn or _download_OHLCV_chunk
+    chunks = [
+        stock_symbols[i : i + chunk_size]
+        for i in range(0, len(stock_symbols), chunk_size)
     ]
-    return all_stock_data.reset_index(drop=True)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunk_data = list(
+            executor.map(lambda chunk: download_fn(chunk, start_date, end_date), chunks)
+        )
+    missing = _find_missing_OHLCV_symbols(chunks, chunk_data)
+    if missing:
+        print(
+            f"[warn] 下列 {len(missing)} 檔股票沒有下載到價量資料，結果中不會出現：{missing[:20]}"
+        )
+    all_stock_data = _build_long_OHLCV_data(chunks, chunk_data)
+    return _to_compact(all_stock_data) if compact else all_stock_data
+
+
+def _download_OHLCV_chunk(
+    symbols: Annotated[list[str], "一批 yfinance 股票代碼"],
+    start_date: Annotated[str, "起始日期", "YYYY-MM-DD"],
+    end_date: Annotated[str, "結束日期", "YYYY-MM-DD"],
+) -> Annotated[pd.DataFrame, "欄位為 (價量欄位, 股票代碼) 的 MultiIndex 寬表"]:
+    """
+    函式說明：
+    以一次 yf.download 下載一批股票(由 yfinance 自己的執行緒同時下載批次中的每檔股票)。
+    yf.download 每次呼叫都會清空並寫入模組共用的 yfinance.shared._DFS，多個執行緒同時呼叫會互相覆蓋結果，
+    所以用 _YF_DOWNLOAD_LOCK 讓各批次的 yf.download 依序執行；
+    批次中沒有下載到資料的股票，再逐檔以 yf.Ticker(symbol).history 補抓(每個 Ticker 各自保存結果，可以同時執行)。
+    """
+    fields = ["Open", "High", "Low", "Close", "Volume"]
+    with _YF_DOWNLOAD_LOCK:
+        frame = yf.download(
+            symbols,
+            start=start_date,
+            end=end_date,
+            group_by="column",
+            auto_adjust=True,
+            threads=True,
+            progress=False,
+        )
+    frames = {}
+    if frame is not None and not frame.empty:
+        frame = frame.reindex(columns=pd.MultiIndex.from_product([fields, symbols]))
+        frames = {symbol: frame.xs(symbol, axis=1, level=1) for symbol in symbols}
+    for symbol in symbols:
+        if symbol in frames and not frames[symbol].isna().all().all():
+            continue
+        frames.pop(symbol, None)
+        history = yf.Ticker(symbol).history(
+            start=start_date, end=end_date, auto_adjust=True
+        )
+        if history is None or history.empty:
+            continue
+        # 和 yf.download 一樣去掉時區，只保留日期
+        history.index = history.index.tz_localize(None)
+        frames[symbol] = history[fields]
+    if not frames:
+        return pd.DataFrame()
+    # (股票代碼, 價量欄位) -> (價量欄位, 股票代碼)
+    return pd.concat(frames, axis=1).swaplevel(axis=1)
+
+
+def _find_missing_OHLCV_symbols(
+    chunks: Annotated[list[list[str]], "每一批的股票代碼"],
+    chunk_data: Annotated[list[pd.DataFrame], "每一批下載回來的寬表"],
+) -> Annotated[list[str], "沒有下載到任何價量資料的股票代碼"]:
+    missing = []
+    for symbols, frame in zip(chunks, chunk_data):
+        if frame is None or frame.empty:
+            missing.extend(symbols)
+            continue
+        tickers = frame.columns.get_level_values(1)
+        for symbol in symbols:
+            if symbol not in tickers or frame.xs(symbol, axis=1, level=1).isna().all().all():
+                missing.append(symbol)
+    return missing
+
+
+def _build_long_OHLCV_data(
+    chunks: Annotated[list[list[str]], "每一批的股票代碼"],
+    chunk_data: Annotated[list[pd.DataFrame], "每一批下載回來的寬表"],
+) -> Annotated[pd.DataFrame, "價量的長表", "欄位名稱包含開高低收量、datetime、asset"]:
+    """
+    函式說明：
+    將每一批 (日期 x 價量欄位 x 股票) 的寬表轉為長表，結果與逐檔下載相同：
+    1. 只保留該股票有資料的日期(價量欄位不全是遺失值)
+    2. 每檔股票各自向前填補遺失值
+    3. 依股票代碼順序、日期由舊到新排列
+    先算出總列數，再把每一批的資料直接寫進預先配置好的陣列。
+    """
+    fields = ["Open", "High", "Low", "Close", "Volume"]
+    blocks = []
+    for symbols, frame in zip(chunks, chunk_data):
+        if frame is None or frame.empty:
+            continue
+        frame = frame.reindex(columns=pd.MultiIndex.from_product([fields, symbols]))
+        # (日期, 價量欄位, 股票) -> (股票, 日期, 價量欄位)
+        values = frame.to_numpy(dtype=float).reshape(len(frame), len(fields), len(symbols))
+        values = values.transpose(2, 0, 1)
+        has_data = ~np.isnan(values).all(axis=2)
+        # 沿著日期方向向前填補：記下每個位置最近一次有值的日期位置
+        last_valid = np.where(
+            np.isnan(values), 0, np.arange(len(frame))[None, :, None]
+        )
+        np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+        values = np.take_along_axis(values, last_valid, axis=1)
+        blocks.append((symbols, frame.index.to_numpy(), values, has_data))
+
+    n_rows = sum(int(has_data.sum()) for *_, has_data in blocks)
+    out_values = np.empty((n_rows, len(fields)))
+    out_datetime = np.empty(n_rows, dtype="datetime64[ns]")
+    out_asset = np.empty(n_rows, dtype=object)
+    row = 0
+    for symbols, dates, values, has_data in blocks:
+        n = int(has_data.sum())
+        out_values[row : row + n] = values[has_data]
+        out_datetime[row : row + n] = np.broadcast_to(dates, has_data.shape)[has_data]
+        out_asset[row : row + n] = np.repeat(
+            [symbol.split(".")[0] for symbol in symbols], has_data.sum(axis=1)
+        )
+        row += n
+
+    all_stock_data = pd.DataFrame(out_values, columns=fields)
+    # 沒有遺失值時，成交量維持和 yfinance 相同的整數型別
+    if not all_stock_data["Volume"].isna().any():
+        all_stock_data["Volume"] = all_stock_data["Volume"].astype("int64")
+    all_stock_data["datetime"] = out_datetime
+    all_stock_data["asset"] = out_asset
+    return all_stock_data
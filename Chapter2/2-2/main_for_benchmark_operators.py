@@ -0,0 +1,278 @@
+# %%
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+utils_folder_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(utils_folder_path)
+
+from Chapter2.utils import alpha_code_1 as chap2_utils_alpha_code_1
+from Chapter2.utils import alphas191 as chap2_utils_alphas191
+from Chapter2.utils import kernels as chap2_utils_kernels
+
+"""
+備註：
+比較 Alpha 因子運算子改寫前(rolling.apply 逐窗呼叫 Python 函式)與改寫後(向量化)的耗時，並確認結果相同。
+使用隨機產生的 日期 x 股票 面板資料，挖掉部分數值並加入重複值，檢查遺失值與同值排名的處理。
+rolling.apply 的寫法很慢，用 500 天 x 300 檔的面板；其他運算子用 10 年(2520 天) x 2000 檔的面板。
+"""
+rng = np.random.default_rng(0)
+
+
+def make_panel(n_dates, n_assets):
+    panel = pd.DataFrame(
+        np.round(rng.lognormal(3, 0.2, (n_dates, n_assets)), 1),
+        index=pd.bdate_range("2010-01-01", periods=n_dates, name="date"),
+        columns=pd.Index([f"{600000 + i}" for i in range(n_assets)], name="asset"),
+    )
+    panel[rng.random(panel.shape) < 0.01] = np.nan
+    return panel
+
+
+panel = make_panel(500, 300)
+large_panel = make_panel(2520, 2000)
+
+
+def decay_linear_loop(df, period=10):
+    # 原本 alpha_code_1.decay_linear 的寫法：逐列用 np.dot 計算(改成不修改輸入、保留欄位名稱，方便比較)
+    df = df.ffill().bfill().fillna(value=0)
+    na_lwma = np.zeros_like(df)
+    na_lwma[:period, :] = df.iloc[:period, :]
+    na_series = df.values
+    divisor = period * (period + 1) / 2
+    y = (np.arange(period) + 1) * 1.0 / divisor
+    for row in range(period - 1, df.shape[0]):
+        x = na_series[row - period + 1 : row + 1, :]
+        na_lwma[row, :] = np.dot(x.T, y)
+    return pd.DataFrame(na_lwma, index=df.index, columns=df.columns)
+
+
+large_volume = make_panel(2520, 2000) * 1000
+
+
+def corr_rolling(x, y, window):
+    # 原本 alphas191.Corr 的寫法
+    r = x.rolling(window).corr(y).fillna(0)
+    r.iloc[: (window - 1), :] = None
+    return r
+
+
+def corr_cov_requests(df):
+    # 模擬多個因子共用相同輸入(例如 rank(volume))的相關係數/共變異數計算
+    ranked = df.rank(axis=1, pct=True)
+    ranked_volume = large_volume.rank(axis=1, pct=True)
+    return [
+        (ranked, ranked_volume, 5),
+        (ranked, ranked_volume, 10),
+        (df, large_volume, 10),
+        (df, ranked_volume, 10),
+        (ranked, ranked_volume, 6),
+        (df, large_volume, 5),
+    ]
+
+
+def corr_cov_rolling(df):
+    # 原本的寫法：每組各自呼叫 rolling.corr / rolling.cov
+    return pd.concat([x.rolling(w).corr(y) for x, y, w in corr_cov_requests(df)] + [x.rolling(w).cov(y) for x, y, w in corr_cov_requests(df)])
+
+
+def corr_cov_batch(df):
+    result = chap2_utils_kernels.rolling_corr_cov(corr_cov_requests(df))
+    return pd.concat([corr for corr, _ in result] + [cov for _, cov in result])
+
+
+def rank_panels_inputs(df):
+    # 一批因子各自需要做橫截面排名的面板
+    return [df, large_volume, df.diff(), df / large_volume, df.shift(1), large_volume.diff()]
+
+
+# 每一項：(運算子名稱, 改寫前的寫法, 改寫後的函式, 測試資料)
+operators = [
+    (
+        "alpha_code_1.ts_rank(10)",
+        lambda df: df.rolling(10).apply(chap2_utils_alpha_code_1.rolling_rank),
+        lambda df: chap2_utils_alpha_code_1.ts_rank(df, 10),
+        panel,
+    ),
+    (
+        "alphas191.Tsrank(20)",
+        lambda df: df.rolling(20).apply(lambda x: rankdata(x)[-1]),
+        lambda df: chap2_utils_alphas191.Tsrank(df, 20),
+        panel,
+    ),
+    (
+        "alphas191.Decaylinear(12)",
+        lambda df: df.rolling(12).apply(lambda x: np.sum(np.arange(1, 13) * x) / 78),
+        lambda df: chap2_utils_alphas191.Decaylinear(df, 12),
+        panel,
+    ),
+    (
+        "alphas191.Wma(10)",
+        lambda df: df.rolling(10).apply(
+            lambda x: np.sum(np.power(0.9, np.arange(9, -1, -1)) * x) / np.sum(np.power(0.9, np.arange(9, -1, -1)))
+        ),
+        lambda df: chap2_utils_alphas191.Wma(df, 10),
+        panel,
+    ),
+    (
+        "alphas191.Regbeta(Sequence(20))",
+        lambda df: df.rolling(20).apply(lambda y: np.polyfit(np.arange(1, 21), y, deg=1)[0]),
+        lambda df: chap2_utils_alphas191.Regbeta(df, chap2_utils_alphas191.Sequence(20)),
+        panel,
+    ),
+    (
+        "alpha_code_1.ts_argmax(30)",
+        lambda df: df.rolling(30).apply(np.argmax) + 1,
+        lambda df: chap2_utils_alpha_code_1.ts_argmax(df, 30),
+        panel,
+    ),
+    (
+        "alpha_code_1.ts_argmin(9)",
+        lambda df: df.rolling(9).apply(np.argmin) + 1,
+        lambda df: chap2_utils_alpha_code_1.ts_argmin(df, 9),
+        panel,
+    ),
+    (
+        "alphas191.Lowday(20)",
+        lambda df: df.rolling(20).apply(lambda x: len(x) - x.values.argmin()),
+        lambda df: chap2_utils_alphas191.Lowday(df, 20),
+        panel,
+    ),
+    (
+        "alphas191.Highday(20)",
+        lambda df: df.rolling(20).apply(lambda x: len(x) - x.values.argmax()),
+        lambda df: chap2_utils_alphas191.Highday(df, 20),
+        panel,
+    ),
+    (
+        "alpha_code_1.product(15)",
+        lambda df: df.rolling(15).apply(chap2_utils_alpha_code_1.rolling_prod),
+        lambda df: chap2_utils_alpha_code_1.product(df, 15),
+        panel,
+    ),
+    (
+        "alphas191.Prod(5)",
+        lambda df: df.rolling(5).apply(lambda x: np.prod(x)),
+        lambda df: chap2_utils_alphas191.Prod(df, 5),
+        panel,
+    ),
+    (
+        "alphas191.Returns",
+        lambda df: df.rolling(2).apply(lambda x: x.iloc[-1] / x.iloc[0]) - 1,
+        chap2_utils_alphas191.Returns,
+        panel,
+    ),
+    (
+        "alphas191.Count(20)",
+        lambda df: (df > 20).rolling(20).apply(lambda x: x.sum()),
+        lambda df: chap2_utils_alphas191.Count(df > 20, 20),
+        panel,
+    ),
+    (
+        "alphas191.Corr(10)",
+        lambda df: corr_rolling(df, large_volume, 10),
+        lambda df: chap2_utils_alphas191.Corr(df, large_volume, 10),
+        large_panel,
+    ),
+    (
+        "kernels.rolling_corr_cov(6 組)",
+        corr_cov_rolling,
+        corr_cov_batch,
+        large_panel,
+    ),
+    (
+        "alphas191.Rank",
+        lambda df: df.rank(axis=1, method="min", pct=True),
+        chap2_utils_alphas191.Rank,
+        large_panel,
+    ),
+    (
+        "alpha_code_1.rank",
+        lambda df: df.rank(pct=True),
+        chap2_utils_alpha_code_1.rank,
+        large_panel,
+    ),
+    (
+        "kernels.rank_panels(6 個)",
+        lambda df: pd.concat([x.rank(axis=1, method="min", pct=True) for x in rank_panels_inputs(df)]),
+        lambda df: pd.concat(chap2_utils_kernels.rank_panels(rank_panels_inputs(df), axis=1, method="min", pct=True)),
+        large_panel,
+    ),
+    (
+        "alpha_code_1.decay_linear(10)",
+        lambda df: decay_linear_loop(df, 10),
+        lambda df: chap2_utils_alpha_code_1.decay_linear(df, 10),
+        large_panel,
+    ),
+]
+
+benchmark_result = []
+for name, old_fn, new_fn, data in operators:
+    t1 = time.time()
+    expected = old_fn(data)
+    t2 = time.time()
+    result = new_fn(data)
+    t3 = time.time()
+
+    pd.testing.assert_frame_equal(result, expected)
+    benchmark_result.append(
+        {
+            "運算子": name,
+            "資料大小": f"{data.shape[0]}x{data.shape[1]}",
+            "改寫前(秒)": round(t2 - t1, 3),
+            "改寫後(秒)": round(t3 - t2, 3),
+            "加速倍數": round((t2 - t1) / (t3 - t2), 1),
+        }
+    )
+
+print(pd.DataFrame(benchmark_result).to_string(index=False))
+
+# %%
+# Alphas191 在建構時就會計算日收益率(Returns)，比較改寫前後建構一次的耗時
+def returns_rolling_apply(df):
+    # 原本 alphas191.Returns 的寫法
+    return df.rolling(2).apply(lambda x: x.iloc[-1] / x.iloc[0]) - 1
+
+
+def make_stocks_data(close):
+    benchmark = close.mean(axis=1)
+    return {
+        "open": close,
+        "high": close * 1.01,
+        "low": close * 0.99,
+        "close": close,
+        "volume": close * 1000,
+        "amount": close * 100000,
+        "vwap": close,
+        "benchmark_open": benchmark,
+        "benchmark_close": benchmark,
+    }
+
+
+constructor_result = []
+for data in [panel, make_panel(2520, 300)]:
+    stocks_data = make_stocks_data(data)
+    new_returns = chap2_utils_alphas191.Returns
+    chap2_utils_alphas191.Returns = returns_rolling_apply
+    t1 = time.time()
+    expected = chap2_utils_alphas191.Alphas191(stocks_data)
+    t2 = time.time()
+    chap2_utils_alphas191.Returns = new_returns
+    result = chap2_utils_alphas191.Alphas191(stocks_data)
+    t3 = time.time()
+
+    pd.testing.assert_frame_equal(result.returns, expected.returns)
+    constructor_result.append(
+        {
+            "資料大小": f"{data.shape[0]}x{data.shape[1]}",
+            "改寫前(秒)": round(t2 - t1, 3),
+            "改寫後(秒)": round(t3 - t2, 3),
+            "加速倍數": round((t2 - t1) / (t3 - t2), 1),
+        }
+    )
+
+print("Alphas191 建構耗時")
+print(pd.DataFrame(constructor_result).to_string(index=False))
@@ -0,0 +1,122 @@
+# %%
+import os
+import sys
+import time
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+
+utils_folder_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(utils_folder_path)
+
+from Chapter2.utils import alphas191 as chap2_utils_alphas191
+from Chapter2.utils import alpha_code_1 as chap2_utils_alpha_code_1
+from Chapter2.utils import chunked as chap2_utils_chunked
+from Chapter2.utils import datas as chap2_utils_datas
+
+"""
+備註：
+全市場 20 年的資料無法整份放進記憶體時，可以先用 save_memmap_panel 存成按列(股票)連續的內存映射面板，
+再用 chunked.evaluate_chunked 分塊計算，結果也寫成內存映射面板：
+只用時間序列運算(Delay、Sum、Tsmax、Sma、Corr…)的因子每個股票互不相關，按股票分塊、每塊讀全部日期，結果與整份計算相同；
+用到截面運算(Rank 等)的因子需要同一天的所有股票，按日期分塊、每塊前面多讀 warmup 天的歷史。
+這裡用隨機資料把兩種類別的因子分塊計算，再與整份資料一次計算的結果比較：
+先用涵蓋全部日期的 warmup 檢查分塊本身的結果，再用預設的 warmup(依每個因子用到的視窗推算的歷史長度)比較。
+原本就無法計算的因子(公式有問題)會印出錯誤並略過。
+用到整段歷史的截面因子(如 alpha054 的 std()、遞迴的 Sma)無法按日期分塊，evaluate_chunked 會改用整份資料計算。
+預設 warmup 下仍不同的截面因子，是 pandas 滾動加總從日期塊的第一列開始累加、最後一位的捨入不同，
+再經 Rank 改變只差捨入的並列名次(例如 2 天的 Corr 都是 +-1)；這裡確認這些因子在整份計算時，
+只要歷史從後面一個日期塊開始，結果也一樣會改變，也就是差異來自捨入，而不是歷史不夠。
+"""
+rng = np.random.default_rng(0)
+warnings.simplefilter("ignore")
+
+
+def make_panel(n_dates, n_assets):
+    close = pd.DataFrame(
+        np.exp(np.cumsum(rng.normal(0, 0.02, (n_dates, n_assets)), axis=0)) * 20,
+        index=pd.Index([str(x.date()) for x in pd.bdate_range("2010-01-01", periods=n_dates)], name="date"),
+        columns=pd.Index([f"{600000 + i}" for i in range(n_assets)], name="asset"),
+    )
+    open_ = close * np.exp(rng.normal(0, 0.01, close.shape))
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0, 0.01, close.shape)))
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0, 0.01, close.shape)))
+    volume = pd.DataFrame(np.round(rng.lognormal(8, 0.5, close.shape)), index=close.index, columns=close.columns)
+    amount = volume * 100 * (high + low + close) / 3
+    benchmark = close.mean(axis=1)
+    # 與 get_stocks_data 相同的欄位與單位(成交量為手、漲跌幅為百分比)
+    return {
+        "open": open_,
+        "high": high,
+        "low": low,
+        "close": close,
+        "volume": volume,
+        "amount": amount,
+        "pctChg": close.pct_change() * 100,
+        "vwap": amount / volume / 100,
+        "benchmark_open": benchmark.shift(1).bfill(),
+        "benchmark_close": benchmark,
+    }
+
+
+folder = tempfile.mkdtemp()
+n_dates = 500
+panel = chap2_utils_datas.save_memmap_panel(make_panel(n_dates, 200), f"{folder}/panel")
+
+# %%
+def different_alphas(result, expected, names):
+    # 與整份計算結果相比，超出容許誤差的因子，以及其最大絕對誤差與不同的值所占比例
+    different = {}
+    for name in names:
+        value = result[name].to_numpy()
+        close = np.isclose(value, expected[name], rtol=1e-9, atol=1e-12, equal_nan=True)
+        if not close.all():
+            with np.errstate(invalid="ignore"):
+                gap = np.abs(value - expected[name])
+            different[name] = (float(np.nanmax(gap)) if np.isfinite(gap).any() else np.nan, 1 - close.mean())
+    return different
+
+
+for cls in [chap2_utils_alphas191.Alphas191, chap2_utils_alpha_code_1.Alphas]:
+    time_series, cross = chap2_utils_chunked.classify_alphas(cls)
+    print(f"{cls.__module__}: 時間序列因子 {len(time_series)} 個，截面因子 {len(cross)} 個")
+
+    # warmup 涵蓋全部日期時，按日期分塊的結果也應與整份計算相同(whole-history 的統計量除外)
+    t1 = time.time()
+    result = chap2_utils_chunked.evaluate_chunked(cls, panel, f"{folder}/{cls.__name__}",
+                                                  asset_chunk=64, date_chunk=120, warmup=n_dates)
+    t2 = time.time()
+    print(f"分塊計算 {t2 - t1:.3f} 秒")
+
+    expected = {}
+    for name in result.keys():
+        value = getattr(cls.from_fields(panel.take()), name)()
+        # 只和日期有關的因子(Series)、常數因子，在結果面板中每個股票都是同一個值
+        if isinstance(value, pd.DataFrame):
+            value = value.reindex(index=result.index, columns=result.columns)
+        expected[name] = np.broadcast_to(np.asarray(value, dtype=float).reshape(-1, 1) if np.ndim(value) == 1
+                                         else np.asarray(value, dtype=float), (n_dates, len(result.columns)))
+    different = different_alphas(result, expected, result.keys())
+    print(f"與整份計算相同 {len(result.keys()) - len(different)} 個，不同 {len(different)} 個：{list(different)}")
+
+    # 預設的 warmup：每個截面因子依 alpha_lookback 推算需要的歷史，用到整段歷史的因子改用整份資料計算
+    default_result = chap2_utils_chunked.evaluate_chunked(cls, panel, f"{folder}/{cls.__name__}_default",
+                                                          asset_chunk=64, date_chunk=120)
+    names = [name for name in cross if name in default_result.keys()]
+    diverged = different_alphas(default_result, expected, names)
+    print(f"預設 warmup 時截面因子與整份計算相同 {len(names) - len(diverged)} 個，不同 {len(diverged)} 個：")
+    for name, (gap, share) in diverged.items():
+        print(f"  {name}: 最大絕對誤差 {gap:.3g}，不同的值占 {share * 100:.3g}%")
+
+    # 整份計算的歷史從第二個日期塊(第 120 天)開始時，推算的歷史長度之後的日期是否與原本的整份計算相同
+    start = 120
+    later = cls.from_fields(panel.take(slice(start, n_dates)))
+    start_sensitive = []
+    for name in diverged:
+        lookback = chap2_utils_chunked.alpha_lookback(cls, name)
+        value = np.asarray(getattr(later, name)(), dtype=float)[lookback:]
+        if not np.allclose(value, expected[name][start + lookback:], rtol=1e-9, atol=1e-12, equal_nan=True):
+            start_sensitive.append(name)
+    print(f"歷史的起點不同時，整份計算本身也會改變的因子：{start_sensitive}")
+    assert set(diverged) <= set(start_sensitive)
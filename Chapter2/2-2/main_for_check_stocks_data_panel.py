@@ -0,0 +1,132 @@
+# %%
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+utils_folder_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(utils_folder_path)
+
+from Chapter2.utils import alphas as chap2_utils_alphas
+from Chapter2.utils import datas as chap2_utils_datas
+
+"""
+備註：
+Alphas.get_stocks_data 改成把每個欄位直接填進 日期 x 股票 的二維陣列，不再逐檔合併指數後 concat 再 pivot。
+這裡在暫存資料夾產生一份樣本資料(data_bfq/*.csv 與 index/*.csv)，用原本的 merge + pivot 寫法和新的寫法各建一次面板，
+逐個欄位用 assert_frame_equal 比較。
+樣本刻意包含：股票停牌的日期、只有指數沒有任何股票的日期、只有股票沒有指數的日期。
+- 原本的寫法在 pivot 前用 asset 非空過濾，只有指數的日期會被丟掉，所以兩種寫法的日期都只有股票出現過的日期
+- 原本的指數欄位是 日期 x 股票 的表，股票停牌那天的指數也是空值；新寫法的指數是按日期對齊的 series，
+  這裡只在股票有資料的位置比較
+"""
+rng = np.random.default_rng(0)
+year, benchmark = "2021", "000905"
+list_assets = [f"{600000 + i}" for i in range(20)]
+columns = ["日期", "开盘", "收盘", "最高", "最低", "成交量", "成交额", "涨跌幅", "换手率"]
+
+
+def make_sample_data(path):
+    dates = pd.bdate_range("2020-01-01", "2022-12-31")
+    os.makedirs(f"{path}/data_bfq")
+    os.makedirs(f"{path}/index")
+    for code in list_assets:
+        close = np.exp(np.cumsum(rng.normal(0, 0.02, len(dates)))) * 20
+        df = pd.DataFrame(
+            {
+                "日期": dates.strftime("%Y-%m-%d"),
+                "开盘": close * np.exp(rng.normal(0, 0.01, len(dates))),
+                "收盘": close,
+                "最高": close * 1.02,
+                "最低": close * 0.98,
+                "成交量": np.round(rng.lognormal(12, 0.5, len(dates))),
+                "涨跌幅": rng.normal(0, 2, len(dates)),
+                "换手率": rng.uniform(0, 5, len(dates)),
+            }
+        )
+        df["成交额"] = df["成交量"] * df["收盘"] * 100
+        # 隨機停牌，並讓 2021-03-01 這天所有股票都沒有資料
+        df = df[(rng.random(len(df)) > 0.03) & (df["日期"] != "2021-03-01")]
+        df.to_csv(f"{path}/data_bfq/{code}.csv")
+    bm_close = np.exp(np.cumsum(rng.normal(0, 0.01, len(dates)))) * 5000
+    bm = pd.DataFrame(
+        {
+            "date": dates.strftime("%Y-%m-%d"),
+            "open": bm_close * np.exp(rng.normal(0, 0.005, len(dates))),
+            "close": bm_close,
+            "high": bm_close * 1.01,
+            "low": bm_close * 0.99,
+            "volume": rng.lognormal(18, 0.3, len(dates)),
+        }
+    )
+    # 2021-06-01 這天只有股票、沒有指數
+    bm[bm["date"] != "2021-06-01"].to_csv(f"{path}/index/{benchmark}.csv", index=False)
+
+
+def get_stocks_data_by_pivot(year, list_assets, benchmark):
+    # 原本的寫法：每檔股票 outer merge 指數，concat 後 pivot 成 (欄位, 股票) 的寬表
+    yer = int(year)
+    start_time = f"{yer-1}-01-01"
+    end_time = f"{yer+1}-01-01"
+    df = pd.read_csv(f"index/{benchmark}.csv")
+    bm_data = df[(df["date"] >= start_time) & (df["date"] <= end_time)]
+    bm_data = bm_data.rename(columns={
+        "date": "benchmark_date",
+        "open": "benchmark_open",
+        "close": "benchmark_close",
+        "high": "benchmark_high",
+        "low": "benchmark_low",
+        "volume": "benchmark_vol"})
+    stock_data = chap2_utils_datas.read_date_data(start_time, end_time, list_assets, columns=columns)
+    list_all = []
+    for c, df in stock_data.groupby("asset", sort=False):
+        df = df.merge(bm_data, how="outer", left_on="日期", right_on="benchmark_date")
+        list_all.append(df)
+    df_all = pd.concat(list_all)
+    df_all = df_all.rename(columns={
+        "日期": "date",
+        "开盘": "open",
+        "收盘": "close",
+        "最高": "high",
+        "最低": "low",
+        "成交量": "volume",
+        "成交额": "amount",
+        "涨跌幅": "pctChg",
+        "换手率": "turnover"})
+    df_all["vwap"] = df_all.amount / df_all.volume / 100
+    df_all["turnover"] = df_all["turnover"] / 100
+    df_all = df_all.reset_index()
+    df_all = df_all[["asset", "date", "open", "close", "high", "low", "volume", "amount", "vwap", "pctChg", "turnover", "benchmark_open", "benchmark_close"]]
+    df_all = df_all[df_all["asset"].notnull()]
+    return df_all.pivot(index="date", columns="asset")
+
+
+# %%
+cwd = os.getcwd()
+with tempfile.TemporaryDirectory() as path:
+    make_sample_data(path)
+    os.chdir(path)
+    try:
+        expected = get_stocks_data_by_pivot(year, list_assets, benchmark)
+        panel = chap2_utils_alphas.Alphas.get_stocks_data(year, list_assets, benchmark)
+    finally:
+        os.chdir(cwd)
+
+print(f"日期數 pivot {len(expected.index)}，新寫法 {len(panel['close'].index)}")
+print(f"只有指數的日期 2021-03-01 是否在面板中：{'2021-03-01' in panel['close'].index}")
+pd.testing.assert_index_equal(panel["close"].index, expected.index, check_names=False)
+
+for field in ["open", "close", "high", "low", "volume", "amount", "vwap", "pctChg", "turnover"]:
+    pd.testing.assert_frame_equal(panel[field], expected[field], check_names=False)
+    print(f"{field} 相同")
+
+has_row = expected["close"].notna()
+for field in ["benchmark_open", "benchmark_close"]:
+    broadcast = pd.DataFrame(
+        np.broadcast_to(panel[field].to_numpy()[:, None], has_row.shape),
+        index=expected.index,
+        columns=expected[field].columns,
+    )
+    pd.testing.assert_frame_equal(broadcast.where(has_row), expected[field], check_names=False)
+    print(f"{field} 在股票有資料的位置相同")
@@ -0,0 +1,93 @@
+# %%
+import os
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+
+utils_folder_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+sys.path.append(utils_folder_path)
+
+from Chapter2.utils import alphas191 as chap2_utils_alphas191
+from Chapter2.utils import formula as chap2_utils_formula
+from Chapter2.utils import streaming as chap2_utils_streaming
+
+"""
+備註：
+每天收盤後只多一天的資料，不必把整段歷史重算一次：StreamingAlphas191 先用歷史資料建立每個運算的滾動狀態
+(DELAY 的緩衝、SUM/MEAN 的累計和、STD/CORR/COV 的累計動差、TSMAX/TSMIN/HIGHDAY/LOWDAY 的單調佇列、SMA 的指數平均，
+只有 TSRANK、DECAYLINEAR 等需要整個視窗的運算保留最近 window 天的資料)，之後每天只更新一列。
+這裡用前 n_dates - n_updates 天建立狀態，逐日更新最後 n_updates 天，再與整段資料一次計算的結果比較。
+用到 BANCHMARKINDEXOPEN/BANCHMARKINDEXCLOSE 的因子(指數欄位)不支援逐日更新，會略過。
+"""
+rng = np.random.default_rng(0)
+warnings.simplefilter("ignore", FutureWarning)
+
+
+def make_stocks_data(n_dates, n_assets):
+    close = pd.DataFrame(
+        np.exp(np.cumsum(rng.normal(0, 0.02, (n_dates, n_assets)), axis=0)) * 20,
+        index=pd.bdate_range("2010-01-01", periods=n_dates, name="date"),
+        columns=pd.Index([f"{600000 + i}" for i in range(n_assets)], name="asset"),
+    )
+    open_ = close * np.exp(rng.normal(0, 0.01, close.shape))
+    high = np.maximum(open_, close) * np.exp(np.abs(rng.normal(0, 0.01, close.shape)))
+    low = np.minimum(open_, close) * np.exp(-np.abs(rng.normal(0, 0.01, close.shape)))
+    volume = pd.DataFrame(np.round(rng.lognormal(12, 0.5, close.shape)), index=close.index, columns=close.columns)
+    benchmark = close.mean(axis=1)
+    return {
+        "open": open_,
+        "high": high,
+        "low": low,
+        "close": close,
+        "volume": volume,
+        "amount": volume * close,
+        "vwap": (high + low + close) / 3,
+        "benchmark_open": benchmark.shift(1).bfill(),
+        "benchmark_close": benchmark,
+    }
+
+
+n_dates, n_updates = 500, 5
+stocks_data = make_stocks_data(n_dates, 300)
+
+# 編譯所有能解析、且不用到指數欄位的原始公式
+compiler = chap2_utils_formula.FormulaCompiler()
+for name, formula in chap2_utils_formula.alphas191_formulas().items():
+    if "BANCHMARKINDEX" in formula:
+        continue
+    try:
+        compiler.add(name, formula)
+    except ValueError:
+        pass
+print(f"逐日更新 {len(compiler.outputs)} 個因子")
+
+# %%
+history = {field: value.iloc[:n_dates - n_updates] for field, value in stocks_data.items()}
+t1 = time.time()
+streaming = chap2_utils_streaming.StreamingAlphas191(compiler, history)
+t2 = time.time()
+print(f"用 {n_dates - n_updates} 天歷史建立狀態 {t2 - t1:.3f} 秒")
+
+updates = []
+for i in range(n_dates - n_updates, n_dates):
+    row = {field: value.iloc[i] for field, value in stocks_data.items()}
+    t1 = time.time()
+    updates.append(streaming.update(stocks_data["close"].index[i], row))
+    print(f"{stocks_data['close'].index[i].date()} 更新 {time.time() - t1:.3f} 秒")
+
+# %%
+t1 = time.time()
+full_result = compiler.evaluate(chap2_utils_alphas191.Alphas191(stocks_data))
+t2 = time.time()
+print(f"整段資料一次計算 {t2 - t1:.3f} 秒")
+
+different = []
+for name in compiler.outputs:
+    batch = np.broadcast_to(np.asarray(full_result[name], dtype=float).reshape(n_dates, -1), (n_dates, 300))
+    for update, expected in zip(updates, batch[-n_updates:]):
+        if not np.allclose(update[name].to_numpy(), expected, rtol=1e-7, atol=1e-9, equal_nan=True):
+            different.append(name)
+            break
+print(f"與整段計算結果相同 {len(compiler.outputs) - len(different)} 個，不同 {len(different)} 個：{different}")
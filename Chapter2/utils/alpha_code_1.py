@@ -4,6 +4,8 @@ from numpy import abs
 from numpy import log
 from numpy import sign
 from scipy.stats import rankdata
+from .datas import MemmapPanel
+from .kernels import rolling_rank_last, rolling_dot, rolling_argmax, rolling_argmin, rolling_product, rolling_corr_cov, rank_panel
 
 # region Auxiliary functions
 def ts_sum(df, window=10):
@@ -42,7 +44,7 @@ def correlation(x, y, window=10):
     :param window: the rolling window.
     :return: a pandas DataFrame with the rolling correlation over the past 'window' days.
     """
-    return x.rolling(window).corr(y)
+    return rolling_corr_cov([(x, y, window)])[0][0]
 
 def covariance(x, y, window=10):
     """
@@ -51,7 +53,7 @@ def covariance(x, y, window=10):
     :param window: the rolling window.
     :return: a pandas DataFrame with the time-series min over the past 'window' days.
     """
-    return x.rolling(window).cov(y)
+    return rolling_corr_cov([(x, y, window)])[0][1]
 
 def rolling_rank(na):
     """
@@ -68,7 +70,7 @@ def ts_rank(df, window=10):
     :param window: the rolling window.
     :return: a pandas DataFrame with the time-series rank over the past window days.
     """
-    return df.rolling(window).apply(rolling_rank)
+    return rolling_rank_last(df, window)
 
 def rolling_prod(na):
     """
@@ -85,7 +87,7 @@ def product(df, window=10):
     :param window: the rolling window.
     :return: a pandas DataFrame with the time-series product over the past 'window' days.
     """
-    return df.rolling(window).apply(rolling_prod)
+    return rolling_product(df, window)
 
 def ts_min(df, window=10):
     """
@@ -130,7 +132,7 @@ def rank(df):
     :return: a pandas DataFrame with rank within each column.
     """
     #return df.rank(axis=1, pct=True)
-    return df.rank(pct=True)
+    return rank_panel(df, axis=0, pct=True)
 
 def scale(df, k=1):
     """
@@ -148,7 +150,7 @@ def ts_argmax(df, window=10):
     :param window: the rolling window.
     :return: well.. that :)
     """
-    return df.rolling(window).apply(np.argmax) + 1 
+    return rolling_argmax(df, window) + 1
 
 def ts_argmin(df, window=10):
     """
@@ -157,33 +159,27 @@ def ts_argmin(df, window=10):
     :param window: the rolling window.
     :return: well.. that :)
     """
-    return df.rolling(window).apply(np.argmin) + 1
+    return rolling_argmin(df, window) + 1
 
 def decay_linear(df, period=10):
     """
     Linear weighted moving average implementation.
-    :param df: a pandas DataFrame.
+    :param df: a pandas Series or DataFrame (one column per asset).
     :param period: the LWMA period
-    :return: a pandas DataFrame with the LWMA.
+    :return: a pandas Series or DataFrame with the LWMA, same index and columns as df.
     """
-    # Clean data
+    # Clean data (on a copy, the input is left untouched)
+    df = df.astype(float, copy=False)
     if df.isnull().values.any():
-        df.fillna(method='ffill', inplace=True)
-        df.fillna(method='bfill', inplace=True)
-        df.fillna(value=0, inplace=True)
-    na_lwma = np.zeros_like(df)
-    na_lwma[:period, :] = df.iloc[:period, :] 
-    # na_series = df.as_matrix()
-    na_series = df.values
-
+        df = df.ffill().bfill().fillna(value=0)
     divisor = period * (period + 1) / 2
     y = (np.arange(period) + 1) * 1.0 / divisor
     # Estimate the actual lwma with the actual close.
     # The backtest engine should assure to be snooping bias free.
-    for row in range(period - 1, df.shape[0]):
-        x = na_series[row - period + 1: row + 1, :]
-        na_lwma[row, :] = (np.dot(x.T, y))
-    return pd.DataFrame(na_lwma, index=df.index, columns=['CLOSE'])  
+    lwma = rolling_dot(df, y, strict=False)
+    # The first period-1 rows keep the cleaned values
+    lwma.iloc[:period - 1] = df.iloc[:period - 1]
+    return lwma
 # endregion
 
 def get_alpha(df):
@@ -282,10 +278,44 @@ class Alphas(object):
         self.volume = df_data['S_DQ_VOLUME']*100 
         self.returns = df_data['S_DQ_PCTCHANGE'] 
         self.vwap = (df_data['S_DQ_AMOUNT']*1000)/(df_data['S_DQ_VOLUME']*100+1) # vwap: volume weighted average price(成交量加權平均價格)
+
+    # Operators comparing assets on the same date; none here: rank() and scale() work within each column (asset)
+    # over the whole history, so every alpha of this class can be computed on any subset of the assets
+    cross_sectional_operators = ()
+    # Operators depending on the whole history of an asset: rank() and scale() over all dates of the column
+    whole_history_operators = ('rank', 'scale')
+
+    @classmethod
+    def from_panel(cls, path):
+        """
+        Build the alphas from a memory-mapped panel written by datas.save_memmap_panel.
+        :param path: directory of the panel (one .npy per field plus index.json).
+        :return: an Alphas object whose price fields are date x asset frames backed by the mapped files.
+        """
+        return cls.from_fields(MemmapPanel(path))
+
+    @classmethod
+    def from_fields(cls, panel):
+        """
+        Build the alphas from a mapping field -> date x asset frame in the layout of datas.save_memmap_panel,
+        e.g. a MemmapPanel or a chunk of it taken with MemmapPanel.take.
+        :param panel: the mapping, with open, high, low, close, volume, pctChg and amount.
+        :return: an Alphas object.
+        """
+        # akshare units: volume in lots, amount in yuan, pctChg in percent
+        return cls({
+            'S_DQ_OPEN': panel['open'],
+            'S_DQ_HIGH': panel['high'],
+            'S_DQ_LOW': panel['low'],
+            'S_DQ_CLOSE': panel['close'],
+            'S_DQ_VOLUME': panel['volume'],
+            'S_DQ_PCTCHANGE': panel['pctChg'],
+            'S_DQ_AMOUNT': panel['amount'] / 1000,
+        })
         
     # Alpha#1	 (rank(Ts_ArgMax(SignedPower(((returns < 0) ? stddev(returns, 20) : close), 2.), 5)) -0.5)
     def alpha001(self):
-        inner = self.close
+        inner = self.close.copy()
         inner[self.returns < 0] = stddev(self.returns, 20)
         return rank(ts_argmax(inner ** 2, 5))
     
@@ -468,11 +498,11 @@ class Alphas(object):
     def alpha031(self):
         adv20 = sma(self.volume, 20)
         df = correlation(adv20, self.low, 12).replace([-np.inf, np.inf], 0).fillna(value=0)         
-        p1=rank(rank(rank(decay_linear((-1 * rank(rank(delta(self.close, 10)))).to_frame(), 10)))) 
+        p1=rank(rank(rank(decay_linear((-1 * rank(rank(delta(self.close, 10)))), 10)))) 
         p2=rank((-1 * delta(self.close, 3)))
         p3=sign(scale(df))
         
-        return p1.CLOSE+p2+p3
+        return p1+p2+p3
 
     # Alpha#32	 (scale(((sum(close, 7) / 7) - close)) + (20 * scale(correlation(vwap, delay(close, 5),230))))
     def alpha032(self):
@@ -512,7 +542,7 @@ class Alphas(object):
     # Alpha#39	 ((-1 * rank((delta(close, 7) * (1 - rank(decay_linear((volume / adv20), 9)))))) * (1 +rank(sum(returns, 250))))
     def alpha039(self):
         adv20 = sma(self.volume, 20)
-        return ((-1 * rank(delta(self.close, 7) * (1 - rank(decay_linear((self.volume / adv20).to_frame(), 9).CLOSE)))) *
+        return ((-1 * rank(delta(self.close, 7) * (1 - rank(decay_linear((self.volume / adv20), 9))))) *
                 (1 + rank(sma(self.returns, 250))))
     
     # Alpha#40	 ((-1 * rank(stddev(high, 10))) * correlation(high, volume, 10))
@@ -608,7 +638,7 @@ class Alphas(object):
     
     # Alpha#57	 (0 - (1 * ((close - vwap) / decay_linear(rank(ts_argmax(close, 30)), 2))))
     def alpha057(self):
-        return (0 - (1 * ((self.close - self.vwap) / decay_linear(rank(ts_argmax(self.close, 30)).to_frame(), 2).CLOSE)))
+        return (0 - (1 * ((self.close - self.vwap) / decay_linear(rank(ts_argmax(self.close, 30)), 2))))
     
     # Alpha#58	 (-1 * Ts_Rank(decay_linear(correlation(IndNeutralize(vwap, IndClass.sector), volume,3.92795), 7.89291), 5.50322))
      
@@ -646,7 +676,7 @@ class Alphas(object):
       
     # Alpha#66	 ((rank(decay_linear(delta(vwap, 3.51013), 7.23052)) + Ts_Rank(decay_linear(((((low* 0.96633) + (low * (1 - 0.96633))) - vwap) / (open - ((high + low) / 2))), 11.4157), 6.72611)) * -1)
     def alpha066(self):
-        return ((rank(decay_linear(delta(self.vwap, 4).to_frame(), 7).CLOSE) + ts_rank(decay_linear(((((self.low* 0.96633) + (self.low * (1 - 0.96633))) - self.vwap) / (self.open - ((self.high + self.low) / 2))).to_frame(), 11).CLOSE, 7)) * -1)
+        return ((rank(decay_linear(delta(self.vwap, 4), 7)) + ts_rank(decay_linear(((((self.low* 0.96633) + (self.low * (1 - 0.96633))) - self.vwap) / (self.open - ((self.high + self.low) / 2))), 11), 7)) * -1)
     
     # Alpha#67	 ((rank((high - ts_min(high, 2.14593)))^rank(correlation(IndNeutralize(vwap,IndClass.sector), IndNeutralize(adv20, IndClass.subindustry), 6.02936))) * -1)
      
@@ -664,28 +694,28 @@ class Alphas(object):
     # Alpha#71	 max(Ts_Rank(decay_linear(correlation(Ts_Rank(close, 3.43976), Ts_Rank(adv180,12.0647), 18.0175), 4.20501), 15.6948), Ts_Rank(decay_linear((rank(((low + open) - (vwap +vwap)))^2), 16.4662), 4.4388))
     def alpha071(self):
         adv180 = sma(self.volume, 180)
-        p1=ts_rank(decay_linear(correlation(ts_rank(self.close, 3), ts_rank(adv180,12), 18).to_frame(), 4).CLOSE, 16)
-        p2=ts_rank(decay_linear((rank(((self.low + self.open) - (self.vwap +self.vwap))).pow(2)).to_frame(), 16).CLOSE, 4)
+        p1=ts_rank(decay_linear(correlation(ts_rank(self.close, 3), ts_rank(adv180,12), 18), 4), 16)
+        p2=ts_rank(decay_linear((rank(((self.low + self.open) - (self.vwap +self.vwap))).pow(2)), 16), 4)
         df=pd.DataFrame({'p1':p1,'p2':p2})
         df.loc[df['p1']>=df['p2'],'max']=df['p1']
         df.loc[df['p2']>=df['p1'],'max']=df['p2']
         return df['max']
-        #return max(ts_rank(decay_linear(correlation(ts_rank(self.close, 3), ts_rank(adv180,12), 18).to_frame(), 4).CLOSE, 16), ts_rank(decay_linear((rank(((self.low + self.open) - (self.vwap +self.vwap))).pow(2)).to_frame(), 16).CLOSE, 4))
+        #return max(ts_rank(decay_linear(correlation(ts_rank(self.close, 3), ts_rank(adv180,12), 18), 4), 16), ts_rank(decay_linear((rank(((self.low + self.open) - (self.vwap +self.vwap))).pow(2)), 16), 4))
     
     # Alpha#72	 (rank(decay_linear(correlation(((high + low) / 2), adv40, 8.93345), 10.1519)) /rank(decay_linear(correlation(Ts_Rank(vwap, 3.72469), Ts_Rank(volume, 18.5188), 6.86671),2.95011)))
     def alpha072(self):
         adv40 = sma(self.volume, 40)
-        return (rank(decay_linear(correlation(((self.high + self.low) / 2), adv40, 9).to_frame(), 10).CLOSE) /rank(decay_linear(correlation(ts_rank(self.vwap, 4), ts_rank(self.volume, 19), 7).to_frame(),3).CLOSE))
+        return (rank(decay_linear(correlation(((self.high + self.low) / 2), adv40, 9), 10)) /rank(decay_linear(correlation(ts_rank(self.vwap, 4), ts_rank(self.volume, 19), 7),3)))
     
     # Alpha#73	 (max(rank(decay_linear(delta(vwap, 4.72775), 2.91864)),Ts_Rank(decay_linear(((delta(((open * 0.147155) + (low * (1 - 0.147155))), 2.03608) / ((open *0.147155) + (low * (1 - 0.147155)))) * -1), 3.33829), 16.7411)) * -1)
     def alpha073(self):
-        p1=rank(decay_linear(delta(self.vwap, 5).to_frame(), 3).CLOSE)
-        p2=ts_rank(decay_linear(((delta(((self.open * 0.147155) + (self.low * (1 - 0.147155))), 2) / ((self.open *0.147155) + (self.low * (1 - 0.147155)))) * -1).to_frame(), 3).CLOSE, 17)
+        p1=rank(decay_linear(delta(self.vwap, 5), 3))
+        p2=ts_rank(decay_linear(((delta(((self.open * 0.147155) + (self.low * (1 - 0.147155))), 2) / ((self.open *0.147155) + (self.low * (1 - 0.147155)))) * -1), 3), 17)
         df=pd.DataFrame({'p1':p1,'p2':p2})
         df.loc[df['p1']>=df['p2'],'max']=df['p1']
         df.loc[df['p2']>=df['p1'],'max']=df['p2']
         return -1*df['max']
-        #return (max(rank(decay_linear(delta(self.vwap, 5).to_frame(), 3).CLOSE),ts_rank(decay_linear(((delta(((self.open * 0.147155) + (self.low * (1 - 0.147155))), 2) / ((self.open *0.147155) + (self.low * (1 - 0.147155)))) * -1).to_frame(), 3).CLOSE, 17)) * -1)
+        #return (max(rank(decay_linear(delta(self.vwap, 5), 3)),ts_rank(decay_linear(((delta(((self.open * 0.147155) + (self.low * (1 - 0.147155))), 2) / ((self.open *0.147155) + (self.low * (1 - 0.147155)))) * -1), 3), 17)) * -1)
     
     # Alpha#74	 ((rank(correlation(close, sum(adv30, 37.4843), 15.1365)) <rank(correlation(rank(((high * 0.0261661) + (vwap * (1 - 0.0261661)))), rank(volume), 11.4791)))* -1)
     def alpha074(self):
@@ -703,13 +733,13 @@ class Alphas(object):
     # Alpha#77	 min(rank(decay_linear(((((high + low) / 2) + high) - (vwap + high)), 20.0451)),rank(decay_linear(correlation(((high + low) / 2), adv40, 3.1614), 5.64125)))
     def alpha077(self):
         adv40 = sma(self.volume, 40)
-        p1=rank(decay_linear(((((self.high + self.low) / 2) + self.high) - (self.vwap + self.high)).to_frame(), 20).CLOSE)
-        p2=rank(decay_linear(correlation(((self.high + self.low) / 2), adv40, 3).to_frame(), 6).CLOSE)
+        p1=rank(decay_linear(((((self.high + self.low) / 2) + self.high) - (self.vwap + self.high)), 20))
+        p2=rank(decay_linear(correlation(((self.high + self.low) / 2), adv40, 3), 6))
         df = pd.DataFrame({'p1': p1, 'p2': p2})
         df.loc[df['p1'] >= df['p2'], 'min'] = df['p2']
         df.loc[df['p2'] >= df['p1'], 'min'] = df['p1']
         return df['min']
-        #return min(rank(decay_linear(((((self.high + self.low) / 2) + self.high) - (self.vwap + self.high)).to_frame(), 20).CLOSE),rank(decay_linear(correlation(((self.high + self.low) / 2), adv40, 3).to_frame(), 6).CLOSE))
+        #return min(rank(decay_linear(((((self.high + self.low) / 2) + self.high) - (self.vwap + self.high)), 20)),rank(decay_linear(correlation(((self.high + self.low) / 2), adv40, 3), 6)))
     
     # Alpha#78	 (rank(correlation(sum(((low * 0.352233) + (vwap * (1 - 0.352233))), 19.7428),sum(adv40, 19.7428), 6.83313))^rank(correlation(rank(vwap), rank(volume), 5.77492)))
     def alpha078(self):
@@ -754,13 +784,13 @@ class Alphas(object):
     # Alpha#88	 min(rank(decay_linear(((rank(open) + rank(low)) - (rank(high) + rank(close))),8.06882)), Ts_Rank(decay_linear(correlation(Ts_Rank(close, 8.44728), Ts_Rank(adv60,20.6966), 8.01266), 6.65053), 2.61957))
     def alpha088(self):
         adv60 = sma(self.volume, 60)
-        p1=rank(decay_linear(((rank(self.open) + rank(self.low)) - (rank(self.high) + rank(self.close))).to_frame(),8).CLOSE)
-        p2=ts_rank(decay_linear(correlation(ts_rank(self.close, 8), ts_rank(adv60,21), 8).to_frame(), 7).CLOSE, 3)
+        p1=rank(decay_linear(((rank(self.open) + rank(self.low)) - (rank(self.high) + rank(self.close))),8))
+        p2=ts_rank(decay_linear(correlation(ts_rank(self.close, 8), ts_rank(adv60,21), 8), 7), 3)
         df=pd.DataFrame({'p1':p1,'p2':p2})
         df.loc[df['p1']>=df['p2'],'min']=df['p2']
         df.loc[df['p2']>=df['p1'],'min']=df['p1']
         return df['min']
-        #return min(rank(decay_linear(((rank(self.open) + rank(self.low)) - (rank(self.high) + rank(self.close))).to_frame(),8).CLOSE), ts_rank(decay_linear(correlation(ts_rank(self.close, 8), ts_rank(adv60,20.6966), 8).to_frame(), 7).CLOSE, 3))
+        #return min(rank(decay_linear(((rank(self.open) + rank(self.low)) - (rank(self.high) + rank(self.close))),8)), ts_rank(decay_linear(correlation(ts_rank(self.close, 8), ts_rank(adv60,20.6966), 8), 7), 3))
     
     # Alpha#89	 (Ts_Rank(decay_linear(correlation(((low * 0.967285) + (low * (1 - 0.967285))), adv10,6.94279), 5.51607), 3.79744) - Ts_Rank(decay_linear(delta(IndNeutralize(vwap,IndClass.industry), 3.48158), 10.1466), 15.3012))
      
@@ -772,13 +802,13 @@ class Alphas(object):
     # Alpha#92	 min(Ts_Rank(decay_linear(((((high + low) / 2) + close) < (low + open)), 14.7221),18.8683), Ts_Rank(decay_linear(correlation(rank(low), rank(adv30), 7.58555), 6.94024),6.80584))
     def alpha092(self):
         adv30 = sma(self.volume, 30)
-        p1=ts_rank(decay_linear(((((self.high + self.low) / 2) + self.close) < (self.low + self.open)).to_frame(), 15).CLOSE,19)
-        p2=ts_rank(decay_linear(correlation(rank(self.low), rank(adv30), 8).to_frame(), 7).CLOSE,7)
+        p1=ts_rank(decay_linear(((((self.high + self.low) / 2) + self.close) < (self.low + self.open)), 15),19)
+        p2=ts_rank(decay_linear(correlation(rank(self.low), rank(adv30), 8), 7),7)
         df=pd.DataFrame({'p1':p1,'p2':p2})
         df.loc[df['p1']>=df['p2'],'min']=df['p2']
         df.loc[df['p2']>=df['p1'],'min']=df['p1']
         return df['min']
-        #return  min(ts_rank(decay_linear(((((self.high + self.low) / 2) + self.close) < (self.low + self.open)).to_frame(), 15).CLOSE,19), ts_rank(decay_linear(correlation(rank(self.low), rank(adv30), 8).to_frame(), 7).CLOSE,7))
+        #return  min(ts_rank(decay_linear(((((self.high + self.low) / 2) + self.close) < (self.low + self.open)), 15),19), ts_rank(decay_linear(correlation(rank(self.low), rank(adv30), 8), 7),7))
     
     # Alpha#93	 (Ts_Rank(decay_linear(correlation(IndNeutralize(vwap, IndClass.industry), adv81,17.4193), 19.848), 7.54455) / rank(decay_linear(delta(((close * 0.524434) + (vwap * (1 -0.524434))), 2.77377), 16.2664)))
      
@@ -796,13 +826,13 @@ class Alphas(object):
     # Alpha#96	 (max(Ts_Rank(decay_linear(correlation(rank(vwap), rank(volume), 3.83878),4.16783), 8.38151), Ts_Rank(decay_linear(Ts_ArgMax(correlation(Ts_Rank(close, 7.45404),Ts_Rank(adv60, 4.13242), 3.65459), 12.6556), 14.0365), 13.4143)) * -1)
     def alpha096(self):
         adv60 = sma(self.volume, 60)
-        p1=ts_rank(decay_linear(correlation(rank(self.vwap), rank(self.volume).to_frame(), 4),4).CLOSE, 8)
-        p2=ts_rank(decay_linear(ts_argmax(correlation(ts_rank(self.close, 7),ts_rank(adv60, 4), 4), 13).to_frame(), 14).CLOSE, 13)
+        p1=ts_rank(decay_linear(correlation(rank(self.vwap), rank(self.volume), 4),4), 8)
+        p2=ts_rank(decay_linear(ts_argmax(correlation(ts_rank(self.close, 7),ts_rank(adv60, 4), 4), 13), 14), 13)
         df=pd.DataFrame({'p1':p1,'p2':p2})
         df.loc[df['p1']>=df['p2'],'max']=df['p1']
         df.loc[df['p2']>=df['p1'],'max']=df['p2']
         return -1*df['max']
-        #return (max(ts_rank(decay_linear(correlation(rank(self.vwap), rank(self.volume).to_frame(), 4),4).CLOSE, 8), ts_rank(decay_linear(ts_argmax(correlation(ts_rank(self.close, 7),ts_rank(adv60, 4), 4), 13).to_frame(), 14).CLOSE, 13)) * -1)
+        #return (max(ts_rank(decay_linear(correlation(rank(self.vwap), rank(self.volume), 4),4), 8), ts_rank(decay_linear(ts_argmax(correlation(ts_rank(self.close, 7),ts_rank(adv60, 4), 4), 13), 14), 13)) * -1)
     
     # Alpha#97	 ((rank(decay_linear(delta(IndNeutralize(((low * 0.721001) + (vwap * (1 - 0.721001))),IndClass.industry), 3.3705), 20.4523)) - Ts_Rank(decay_linear(Ts_Rank(correlation(Ts_Rank(low,7.87871), Ts_Rank(adv60, 17.255), 4.97547), 18.5925), 15.7152), 6.71659)) * -1)
      
@@ -811,7 +841,7 @@ class Alphas(object):
     def alpha098(self):
         adv5 = sma(self.volume, 5)
         adv15 = sma(self.volume, 15)
-        return (rank(decay_linear(correlation(self.vwap, sma(adv5, 26), 5).to_frame(), 7).CLOSE) -rank(decay_linear(ts_rank(ts_argmin(correlation(rank(self.open), rank(adv15), 21), 9),7).to_frame(), 8).CLOSE))
+        return (rank(decay_linear(correlation(self.vwap, sma(adv5, 26), 5), 7)) -rank(decay_linear(ts_rank(ts_argmin(correlation(rank(self.open), rank(adv15), 21), 9),7), 8)))
     
     # Alpha#99	 ((rank(correlation(sum(((high + low) / 2), 19.8975), sum(adv60, 19.8975), 8.8136)) <rank(correlation(low, volume, 6.28259))) * -1)
     def alpha099(self):
@@ -1,26 +1,82 @@
 
+import numpy as np
 import pandas as pd
 from multiprocessing import Pool
 import os
 import traceback
 import time
+from .datas import read_date_data, save_memmap_panel, MemmapPanel, share_panel
+from .memo import operator_cache
 
 class Alphas(object):
     def __init__(self, df_data):
         pass
 
+    # 比较同一天不同股票的算子(如截面排序 Rank)，chunked.alpha_needs_cross_section 据此判断因子能否按股票分块计算
+    # 为 None 时不做判断，所有因子都当作需要整个截面
+    cross_sectional_operators = None
+
+    # 依赖整段历史的算子(如递归的 SMA、对全部日期排序)，chunked.alpha_lookback 据此判断因子需要多少天的历史
+    # 为 None 时不做判断，所有因子都当作依赖整段历史
+    whole_history_operators = None
+
+    @classmethod
+    def from_fields(cls, panel):
+        # 从 字段 -> 日期 x 股票 数据 的映射(get_stocks_data 的 dict、MemmapPanel 或 MemmapPanel.take 取出的一块)构造因子计算对象
+        return cls(panel)
+
     @classmethod
-    def calc_alpha(cls, path, func, data):
+    def from_panel(cls, path):
+        # 从 save_memmap_panel 保存的内存映射面板构造因子计算对象，数据不整份读入内存
+        stock = cls(MemmapPanel(path))
+        stock._panel_path = path
+        return stock
+
+    @classmethod
+    def from_shared(cls, panel):
+        # 从 share_panel 放进共享内存的面板构造因子计算对象，字段直接使用共享内存，不复制数据
+        stock = cls(panel)
+        stock._shared_panel = panel
+        return stock
+
+    def __reduce_ex__(self, protocol):
+        # 由内存映射面板构造的对象传给进程池时只传路径，子进程重新映射文件，共享操作系统的页缓存
+        # 由共享内存面板构造的对象只传共享内存的名字，子进程直接连接同一块内存
+        path = getattr(self, '_panel_path', None)
+        if path is not None:
+            return (type(self).from_panel, (path,))
+        panel = getattr(self, '_shared_panel', None)
+        if panel is not None:
+            return (type(self).from_shared, (panel,))
+        return super().__reduce_ex__(protocol)
+
+    @classmethod
+    def calc_alpha(cls, path, func, data, store=None, year=None):
+        # 指定 store(AlphaStore) 时把结果写进列式存储(只保存 year 这一年)，否则保存成 path 的 csv
         try:
             t1 = time.time()
             res = func(data)
-            res.to_csv(path)
+            if store is not None:
+                store.write(os.path.splitext(os.path.basename(path))[0], res, year)
+            else:
+                res.to_csv(path)
             t2 = time.time()
             print(f"Factory {os.path.splitext(os.path.basename(path))[0]} time {t2-t1}")
         except Exception as e:
             print(f"generate {path} error!!!")
             # traceback.print_exc()
 
+    @classmethod
+    def calc_alphas(cls, tasks, data, cache_bytes=2 * 1024 ** 3, store=None, year=None):
+        # 同一个子进程里依次计算一组因子，共用一个算子缓存，相同的中间结果(如 Delay(close,1)、Rank(volume))只算一次
+        # tasks 里只有 (保存路径, 因子名)，因子方法在子进程里从 data 的类别上取得，不用把函数对象传给子进程
+        with operator_cache(cache_bytes) as cache:
+            for path, name in tasks:
+                cls.calc_alpha(path, getattr(type(data), name), data, store, year)
+            print(f"Operator cache hits {cache.hits} misses {cache.misses} "
+                  f"(keyed by operand identity {cache.identity_misses}, e.g. on pandas arithmetic results) "
+                  f"evictions {cache.evictions}")
+
     @classmethod
     def get_stocks_data(cls, year, list_assets, benchmark):
         # list_assets,df_asserts = get_zz500_stocks(f'{year}-01-01')
@@ -28,57 +84,35 @@ class Alphas(object):
         start_time = f'{yer-1}-01-01'
         end_time = f'{yer+1}-01-01'
 
-        index_path = 'index'
-        df = pd.read_csv(f'{index_path}/{benchmark}.csv')
-        bm_data =  df[(df['date'] >= start_time) & (df['date'] <= end_time)]
-
-        # 修改列名
-        bm_data = bm_data.rename(columns={
-            "date": "benchmark_date", 
-            "open": "benchmark_open", 
-            "close": "benchmark_close", 
-            "high": "benchmark_high", 
-            "low": "benchmark_low", 
-            "volume": "benchmark_vol"})
-
-        data_path = 'data_bfq'
-
         # 从本地保存的数据中读出需要的股票日数据
-        list_all = []
-        for c in list_assets:
-            df = pd.read_csv(f'{data_path}/{c}.csv')
-            df['asset'] = c
-            df = df[(df['日期'] >= start_time) & (df['日期'] <= end_time)]
-            df = df.merge(bm_data, how='outer', left_on='日期', right_on='benchmark_date')
-            list_all.append(df)
-            
-        print(len(list_all))
-
-        # 所有股票日数据拼接成一张表
-        df_all = pd.concat(list_all)
-            
-        # 修改列名
-        df_all = df_all.rename(columns={
-            "日期": "date", 
-            "开盘": "open", 
-            "收盘": "close", 
-            "最高": "high", 
-            "最低": "low", 
-            "成交量": "volume", 
-            "成交额": "amount",
-            "涨跌幅": "pctChg",
-            "换手率": "turnover"})
+        stock_data = read_date_data(start_time, end_time, list_assets,
+                                    columns=["日期", "开盘", "收盘", "最高", "最低", "成交量", "成交额", "涨跌幅", "换手率"])
+        print(stock_data['asset'].nunique())
+
+        # 日期、股票各自编码，直接把每个字段填进 日期 x 股票 的二维数组，不再逐个股票合并指数再透视
+        # 日期只取股票出现过的日期：原来的写法透视前按 asset 非空过滤，只有指数的日期同样会被丢掉
+        # 与原写法逐字段的比较见 Chapter2/2-2/main_for_check_stocks_data_panel.py
+        dates, date_codes = np.unique(stock_data['日期'].to_numpy(), return_inverse=True)
+        assets, asset_codes = np.unique(stock_data['asset'].to_numpy(), return_inverse=True)
+        index = pd.Index(dates, name='date')
+        columns = pd.Index(assets, name='asset')
+
+        panel = {}
+        for field, col in {"open": "开盘", "close": "收盘", "high": "最高", "low": "最低",
+                           "volume": "成交量", "amount": "成交额", "pctChg": "涨跌幅", "turnover": "换手率"}.items():
+            values = np.full((len(dates), len(assets)), np.nan)
+            values[date_codes, asset_codes] = stock_data[col].to_numpy(dtype=float)
+            panel[field] = pd.DataFrame(values, index=index, columns=columns)
         # 计算平均成交价
-        df_all['vwap'] =  df_all.amount / df_all.volume / 100
-        df_all['turnover']  = df_all['turnover']/100
-
-        # 返回计算因子需要的列
-        df_all = df_all.reset_index()
-        df_all = df_all[['asset','date', "open", "close", "high", "low", "volume", "amount", 'vwap', "pctChg", 'turnover', 'benchmark_open', 'benchmark_close']]
-        # ddu = df_all[df_all.duplicated()]
-        df_all=df_all[df_all['asset'].notnull()]
-        return df_all.pivot(index='date', columns='asset') 
-    
+        panel['vwap'] = panel['amount'] / panel['volume'] / 100
+        panel['turnover'] = panel['turnover'] / 100
+
+        # 指数数据只保存一份，按日期对齐成 series；股票停牌的日期不再像原写法那样把指数置空
+        bm_data = cls.get_benchmark(year, benchmark).set_index('date')
+        panel['benchmark_open'] = bm_data['open'].reindex(index).rename('benchmark_open')
+        panel['benchmark_close'] = bm_data['close'].reindex(index).rename('benchmark_close')
+        return panel
+
     @classmethod
     def get_benchmark(cls, year, code):
         yer = int(year)
@@ -95,7 +129,7 @@ class Alphas(object):
                             dir(self))))
     
     @classmethod
-    def generate_alpha_single(cls, alpha_name, year, list_assets, benchmark, need_save=False):
+    def generate_alpha_single(cls, alpha_name, year, list_assets, benchmark, need_save=False, store=None):
         # 获取计算因子所需股票数据
         stock_data = cls.get_stocks_data(year, list_assets, benchmark)
 
@@ -107,9 +141,12 @@ class Alphas(object):
             print('alpha name is error!!!')
             return None
         
-        alpha_data = factor(stock)
+        with operator_cache():
+            alpha_data = factor(stock)
 
-        if need_save:
+        if need_save and store is not None:
+            store.write(alpha_name, alpha_data, year)
+        elif need_save:
             path = f'alphas/{cls.__name__}/{year}'
             if not os.path.isdir(path):
                 os.makedirs(path)
@@ -119,37 +156,58 @@ class Alphas(object):
             
 
     @classmethod
-    def generate_alphas(cls, year, list_assets, benchmark):
+    def generate_alphas(cls, year, list_assets, benchmark, panel_path=None, cache_bytes=2 * 1024 ** 3, use_shared_memory=False,
+                        store=None):
         t1 = time.time()
         # 获取计算因子所需股票数据
         stock_data = cls.get_stocks_data(year, list_assets, benchmark)
 
         # 实例化因子计算的对象
-        stock = cls(stock_data)
+        # 指定 panel_path 时先把数据保存成内存映射面板，各个子进程映射同一份文件，而不是各自持有一份数据
+        # use_shared_memory 时把数据放进共享内存，子进程直接连接使用，任务里只传共享内存的名字
+        # 放进共享内存之后不论计算是否出错，最后都要释放共享内存，否则会一直占用到重新开机
+        shared = None
+        try:
+            if panel_path is not None:
+                save_memmap_panel(stock_data, panel_path)
+                stock = cls.from_panel(panel_path)
+            elif use_shared_memory:
+                shared = share_panel(stock_data)
+                del stock_data
+                stock = cls.from_shared(shared)
+            else:
+                stock = cls(stock_data)
         
-        # 因子计算结果的保存路径
-        path = f'alphas/{cls.__name__}/{year}'
-
-        # 创建保存路径
-        if not os.path.isdir(path):
-            os.makedirs(path)
-
-        # 创建线程池
-        count = os.cpu_count()
-        pool = Pool(count)
-
-        # 获取所有因子计算的方法
-        methods = cls.get_alpha_methods(cls)
-
-        # 在线程池中计算所有alpha
-        for m in methods:
-            factor = getattr(cls, m)
-            try:
-                pool.apply_async(cls.calc_alpha, (f'{path}/{m}.csv', factor, stock))
-            except Exception as e:
-                traceback.print_exc()
-
-        pool.close()
-        pool.join()
+            # 因子计算结果的保存路径；指定 store(AlphaStore) 时改为写进列式存储，不再每个因子保存一个 csv
+            path = f'alphas/{cls.__name__}/{year}'
+
+            # 创建保存路径
+            if store is None and not os.path.isdir(path):
+                os.makedirs(path)
+
+            # 创建线程池
+            count = os.cpu_count()
+            pool = Pool(count)
+
+            # 获取所有因子计算的方法
+            methods = cls.get_alpha_methods(cls)
+
+            # 在线程池中计算所有alpha
+            # 因子按顺序分成 count 组(相邻的因子常用相同的中间结果)，每组交给一个子进程并共用算子缓存，
+            # 缓存占用的内存不超过 cache_bytes
+            size = -(-len(methods) // count)
+            for i in range(0, len(methods), size):
+                tasks = [(f'{path}/{m}.csv', m) for m in methods[i:i + size]]
+                try:
+                    pool.apply_async(cls.calc_alphas, (tasks, stock, cache_bytes, store, year))
+                except Exception as e:
+                    traceback.print_exc()
+
+            pool.close()
+            pool.join()
+        finally:
+            if shared is not None:
+                stock = None
+                shared.unlink()
         t2 = time.time()
         print(f"Total time {t2-t1}")
@@ -1,85 +1,104 @@
 import numpy as np
 import pandas as pd
 from numpy import log
-from scipy.stats import rankdata
 from .alphas import Alphas
+from .memo import memoized
+from .kernels import rolling_rank_last, rolling_dot, rolling_argmax, rolling_argmin, rolling_product, rolling_corr_cov, rank_panel
 
+@memoized
 def Log(sr):
     #自然对数函数
     return np.log(sr)
 
+@memoized
 def Rank(sr):
     #列-升序排序并转化成百分比
-    return sr.rank(axis=1, method='min', pct=True)
+    return rank_panel(sr, axis=1, method='min', pct=True)
 
+@memoized
 def Delta(sr,period):
     #period日差分
     return sr.diff(period)
 
+@memoized
 def Delay(sr,period):
     #period阶滞后项
     return sr.shift(period)
 
+@memoized
 def Corr(x,y,window):
     #window日滚动相关系数
     #当一个变量值为常量，另一个变量值可变化时，此时无法计算相关度，使用0 进行填充
-    r = x.rolling(window).corr(y).fillna(0)
     #同时将起始 window-1 个窗口赋值为空
-    r.iloc[:(window-1), :] = None
-    return r
+    return rolling_corr_cov([(x, y, window)], fill_value=0)[0][0]
 
+@memoized
 def Cov(x,y,window):
     #window日滚动协方差
-    return x.rolling(window).cov(y)
+    return rolling_corr_cov([(x, y, window)])[0][1]
 
+@memoized
 def Sum(sr,window):
     #window日滚动求和
     return sr.rolling(window).sum()
 
+@memoized
 def Prod(sr,window):
     #window日滚动求乘积
-    return sr.rolling(window).apply(lambda x: np.prod(x))
+    return rolling_product(sr, window)
 
+@memoized
 def Mean(sr,window):
     #window日滚动求均值
     return sr.rolling(window).mean()
 
+@memoized
 def Std(sr,window):
     #window日滚动求标准差
     return sr.rolling(window).std()
 
+@memoized
 def Tsrank(sr, window):
     #window日序列末尾值的顺位
-    return sr.rolling(window).apply(lambda x: rankdata(x)[-1])
+    return rolling_rank_last(sr, window)
                
+@memoized
 def Tsmax(sr, window):
     #window日滚动求最大值    
     return sr.rolling(window).max()
 
+@memoized
 def Tsmin(sr, window):
     #window日滚动求最小值    
     return sr.rolling(window).min()
 
+@memoized
 def Sign(sr):
     #符号函数
     return np.sign(sr)
 
+@memoized
 def Max(sr1,sr2):
     return np.maximum(sr1, sr2)
 
+@memoized
 def Min(sr1,sr2):
     return np.minimum(sr1, sr2)
 
+@memoized
 def Rowmax(sr):
     return sr.max(axis=1)
 
+@memoized
 def Rowmin(sr):
     return sr.min(axis=1)
 
+@memoized
 def Sma(sr,n,m):
     #sma均值
     return sr.ewm(alpha=m/n, adjust=False).mean()
 
+@memoized
 def Abs(sr):
     #求绝对值
     return sr.abs()
@@ -88,40 +107,60 @@ def Sequence(n):
     #生成 1~n 的等差序列
     return np.arange(1,n+1)
 
+@memoized
 def Regbeta(sr,x):
-    window = len(x)
-    return sr.rolling(window).apply(lambda y: np.polyfit(x, y, deg=1)[0])
+    #对固定自变量 x 做滚动最小二乘的斜率: sum((x-mean(x))*y) / sum((x-mean(x))^2)
+    #相当于对 y 用固定权重做滚动加权求和，不用每个窗口调用一次 polyfit
+    x = np.asarray(x, dtype=float)
+    xc = x - x.mean()
+    return rolling_dot(sr, xc / np.sum(xc**2))
 
+@memoized
 def Decaylinear(sr, window):  
     weights = np.array(range(1, window+1))
     sum_weights = np.sum(weights)
-    return sr.rolling(window).apply(lambda x: np.sum(weights*x) / sum_weights)
+    return rolling_dot(sr, weights) / sum_weights
 
+@memoized
 def Lowday(sr,window):
-    return sr.rolling(window).apply(lambda x: len(x) - x.values.argmin())
+    #距离窗口内最低点的天数(最新一天为 1)
+    return window - rolling_argmin(sr, window)
 
+@memoized
 def Highday(sr,window):
-    return sr.rolling(window).apply(lambda x: len(x) - x.values.argmax())
+    #距离窗口内最高点的天数(最新一天为 1)
+    return window - rolling_argmax(sr, window)
 
+@memoized
 def Wma(sr,window):
     weights = np.array(range(window-1,-1, -1))
     weights = np.power(0.9,weights)
     sum_weights = np.sum(weights)
 
-    return sr.rolling(window).apply(lambda x: np.sum(weights*x) / sum_weights)
+    return rolling_dot(sr, weights) / sum_weights
 
+@memoized
 def Count(cond,window):
-    return cond.rolling(window).apply(lambda x: x.sum())
+    #window日内条件成立的天数
+    return cond.astype(float).rolling(window).sum()
 
+@memoized
 def Sumif(sr,window,cond):
-    sr[~cond] = 0
-    return sr.rolling(window).sum()
+    #window日内条件成立时的求和，条件不成立的值记为 0(不修改传入的 sr)
+    return sr.where(cond, 0).rolling(window).sum()
 
 def Returns(df):
-    return df.rolling(2).apply(lambda x: x.iloc[-1] / x.iloc[0]) - 1
+    #日收益率，与 rolling(2) 一样，前后两天有任一天不是有限值时为 NaN
+    prev = df.shift(1)
+    return (df / prev - 1).where(np.isfinite(df) & np.isfinite(prev))
 
 
 class Alphas191(Alphas):
+    # 截面算子：Rank 在同一天的股票之间排序，Rowmax/Rowmin 在同一天的股票之间取最大/最小值
+    cross_sectional_operators = ('Rank', 'Rowmax', 'Rowmin')
+    # 依赖整段历史的算子：Sma 是递归的指数平滑，每个值都受之前所有日期影响
+    whole_history_operators = ('Sma',)
+
     def __init__(self, df_data):
         def _to_frame(value, name):
             if isinstance(value, pd.Series):
@@ -600,7 +639,10 @@ class Alphas191(Alphas):
     
     def alpha075(self):  
         ####COUNT(CLOSE>OPEN & BANCHMARKINDEXCLOSE<BANCHMARKINDEXOPEN,50)/COUNT(BANCHMARKINDEXCLOSE<BANCHMARKINDEXOPEN,50)###
-        return Count(((self.close>self.open)&(self.benchmark_close<self.benchmark_open)),50)/Count((self.benchmark_close<self.benchmark_open),50)
+        # 指数是按日期的 series，需要沿着日期方向(axis=0)和个股数据对齐
+        bm_down = (self.benchmark_close < self.benchmark_open)
+        part = (self.close > self.open).mul(bm_down, axis=0).astype(bool)
+        return Count(part, 50).div(Count(bm_down, 50), axis=0)
     
     def alpha076(self):   #1650
         ####STD(ABS((CLOSE/DELAY(CLOSE,1)-1))/VOLUME,20)/MEAN(ABS((CLOSE/DELAY(CLOSE,1)-1))/VOLUME,20)###
@@ -1172,11 +1214,16 @@ class Alphas191(Alphas):
     
     def alpha181(self):   #1532  公式有问题，假设后面的sum周期为20
         ####SUM(((CLOSE/DELAY(CLOSE,1)-1)-MEAN((CLOSE/DELAY(CLOSE,1)-1),20))-(BANCHMARKINDEXCLOSE-MEAN(BANCHMARKINDEXCLOSE,20))^2,20)/SUM((BANCHMARKINDEXCLOSE-MEAN(BANCHMARKINDEXCLOSE,20))^3)###
-        return Sum(((self.close/Delay(self.close,1)-1)-Mean((self.close/Delay(self.close,1)-1),20))-(self.benchmark_close-Mean(self.benchmark_close,20))**2,20)/Sum(((self.benchmark_close-Mean(self.benchmark_close,20))**3),20)
+        bm_part = self.benchmark_close - Mean(self.benchmark_close, 20)
+        part = ((self.close/Delay(self.close,1)-1)-Mean((self.close/Delay(self.close,1)-1),20)).sub(bm_part**2, axis=0)
+        return Sum(part, 20).div(Sum(bm_part**3, 20), axis=0)
     
     def alpha182(self):  
         ####COUNT((CLOSE>OPEN & BANCHMARKINDEXCLOSE>BANCHMARKINDEXOPEN)OR(CLOSE<OPEN & BANCHMARKINDEXCLOSE<BANCHMARKINDEXOPEN),20)/20###
-        return Count((((self.close>self.open) & (self.benchmark_close>self.benchmark_open)) | ((self.close<self.open) & (self.benchmark_close<self.benchmark_open))),20)/20
+        bm_up = (self.benchmark_close > self.benchmark_open)
+        bm_down = (self.benchmark_close < self.benchmark_open)
+        part = (self.close > self.open).mul(bm_up, axis=0).astype(bool) | (self.close < self.open).mul(bm_down, axis=0).astype(bool)
+        return Count(part, 20)/20
     
     def alpha183(self):  
         ###MAX(SUMAC(CLOSE-MEAN(CLOSE,24)))-MIN(SUMAC(CLOSE-MEAN(CLOSE,24)))/STD(CLOSE,24)###
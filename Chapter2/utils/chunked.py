@@ -0,0 +1,296 @@
+import ast
+import inspect
+import json
+import math
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .datas import MemmapPanel
+from .memo import operator_cache
+
+
+def alpha_methods(cls):
+    """
+    :param cls: an alpha class, e.g. alphas191.Alphas191 or alpha_code_1.Alphas.
+    :return: the names of its alphaNNN methods, sorted.
+    """
+    return sorted(m for m in dir(cls) if m.startswith('alpha') and callable(getattr(cls, m)))
+
+
+def _method_tree(cls, name):
+    """
+    :return: the parsed source of cls.<name>, or None when the source is unavailable.
+    """
+    try:
+        source = inspect.getsource(getattr(cls, name))
+        # a method's source is indented; nest it in a block instead of dedenting it, since comment lines at
+        # column 0 inside the body would stop textwrap.dedent
+        return ast.parse('if True:\n' + source if source[:1].isspace() else source)
+    except (OSError, TypeError, SyntaxError):
+        return None
+
+
+def _along_assets(call):
+    """
+    Whether a call passes a non-zero axis (e.g. max(axis=1)), i.e. works across the assets of each date.
+    """
+    return any(keyword.arg == 'axis' and not (isinstance(keyword.value, ast.Constant)
+                                               and keyword.value.value in (0, 'index'))
+               for keyword in call.keywords)
+
+
+def _self_alpha(func, seen):
+    """
+    :return: the name of another alpha method called as self.alphaNNN(), or None.
+    """
+    if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'self'
+            and func.attr.startswith('alpha') and func.attr not in seen):
+        return func.attr
+    return None
+
+
+def alpha_needs_cross_section(cls, name, _seen=None):
+    """
+    Whether an alpha compares assets on the same date, read from the source of its method: it calls one of
+    cls.cross_sectional_operators (e.g. Rank), passes a non-zero axis to a pandas method (e.g. max(axis=1)),
+    or calls another alpha method that does. Alphas that do not are time-series only: every asset is computed
+    from its own history, so they can be evaluated on any subset of the assets.
+    Undecidable cases (no cross_sectional_operators on the class, source unavailable) count as cross-sectional.
+    :param cls: an alpha class.
+    :param name: name of the alpha method.
+    :return: True when the alpha needs the full cross-section of each date.
+    """
+    operators = getattr(cls, 'cross_sectional_operators', None)
+    if operators is None:
+        return True
+    tree = _method_tree(cls, name)
+    if tree is None:
+        return True
+    seen = {name} if _seen is None else _seen
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in operators:
+            return True
+        if _along_assets(node):
+            return True
+        other = _self_alpha(func, seen)
+        if other is not None:
+            seen.add(other)
+            if alpha_needs_cross_section(cls, other, seen):
+                return True
+    return False
+
+
+# pandas methods that look at every date of a column (or, for bfill, at later dates), unless they are applied
+# to a rolling window or across the assets
+_WHOLE_HISTORY_METHODS = frozenset({
+    'std', 'var', 'sem', 'mean', 'median', 'sum', 'prod', 'max', 'min', 'quantile', 'rank', 'idxmax', 'idxmin',
+    'cumsum', 'cumprod', 'cummax', 'cummin', 'expanding', 'ewm', 'ffill', 'bfill',
+})
+
+
+def _literal_window(node):
+    """
+    :return: the size of a numeric literal argument (e.g. the 20 of Mean(x, 20)), 0 for anything else.
+    """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        node = node.operand
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return math.ceil(abs(node.value)) if math.isfinite(node.value) else 0
+    return 0
+
+
+def _default_windows(func, call):
+    """
+    :return: the sum of the integer defaults of the parameters a call leaves out, e.g. the window=10 of
+        ts_sum(x) in alpha_code_1; 0 when the function is unknown.
+    """
+    try:
+        parameters = list(inspect.signature(func).parameters.values())
+    except (TypeError, ValueError):
+        return 0
+    passed = {keyword.arg for keyword in call.keywords}
+    return sum(p.default for p in parameters[len(call.args):]
+               if p.name not in passed and isinstance(p.default, int) and not isinstance(p.default, bool))
+
+
+def _tree_lookback(cls, tree, operators, seen):
+    """
+    Upper bound of the history behind the calls in a parsed method; None for a whole-history dependency.
+    """
+    module = sys.modules.get(cls.__module__)
+    lookback = 0
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id in operators:
+                return None
+            lookback += _default_windows(getattr(module, func.id, None), node)
+        elif isinstance(func, ast.Attribute):
+            receiver = func.value
+            windowed = (isinstance(receiver, ast.Call) and isinstance(receiver.func, ast.Attribute)
+                        and receiver.func.attr == 'rolling')
+            if func.attr in _WHOLE_HISTORY_METHODS and not windowed and not _along_assets(node):
+                return None
+            other = _self_alpha(func, seen)
+            if other is not None:
+                seen.add(other)
+                inner = alpha_lookback(cls, other, seen)
+                if inner is None:
+                    return None
+                lookback += inner
+        lookback += sum(_literal_window(arg) for arg in node.args)
+        lookback += sum(_literal_window(keyword.value) for keyword in node.keywords)
+    return lookback
+
+
+def alpha_lookback(cls, name, _seen=None):
+    """
+    Number of dates of history an alpha needs before a date, read from the source of its method and of the
+    class constructor (which derives fields such as returns): the sum of the numeric literals passed to the
+    operators it calls, plus the defaults of the windows it leaves out. Nested windows add up along the
+    longest chain of calls, so the sum over all calls bounds it.
+    None when the alpha depends on the whole history: it calls one of cls.whole_history_operators (e.g. the
+    recursive Sma) or a pandas reduction over all dates such as close.std() or cumsum(), or when it cannot be
+    decided (no whole_history_operators on the class, source unavailable).
+    :param cls: an alpha class.
+    :param name: name of the alpha method.
+    :return: the number of dates, or None.
+    """
+    operators = getattr(cls, 'whole_history_operators', None)
+    if operators is None:
+        return None
+    seen = {name} if _seen is None else _seen
+    trees = [_method_tree(cls, name)]
+    if _seen is None:
+        trees.append(_method_tree(cls, '__init__'))
+    lookback = 0
+    for tree in trees:
+        part = None if tree is None else _tree_lookback(cls, tree, operators, seen)
+        if part is None:
+            return None
+        lookback += part
+    return lookback
+
+
+def classify_alphas(cls, names=None):
+    """
+    :param cls: an alpha class.
+    :param names: alpha method names, all of them by default.
+    :return: (time-series-only names, cross-sectional names).
+    """
+    names = alpha_methods(cls) if names is None else list(names)
+    cross = [name for name in names if alpha_needs_cross_section(cls, name)]
+    return [name for name in names if name not in cross], cross
+
+
+def _chunks(n, size):
+    return [(start, min(start + size, n)) for start in range(0, n, size)]
+
+
+def _block(result, index, columns):
+    """
+    A chunk result as a float array over the chunk's dates and assets; an alpha that only depends on the
+    date (e.g. one built from the benchmark series alone) is repeated for every asset, a constant everywhere.
+    """
+    if np.ndim(result) == 0:
+        return np.full((len(index), len(columns)), float(result))
+    if isinstance(result, pd.Series):
+        result = result.reindex(index).to_numpy(dtype=float)
+        return np.repeat(result[:, None], len(columns), axis=1)
+    return result.reindex(index=index, columns=columns).to_numpy(dtype=float)
+
+
+def evaluate_chunked(cls, panel, output, names=None, asset_chunk=500, date_chunk=250, warmup=None,
+                     cache_bytes=2 * 1024 ** 3):
+    """
+    Evaluate alphas out of core, from a memory-mapped panel on disk to a memory-mapped panel on disk, so that
+    e.g. the whole A-share universe over 20 years is computed in bounded memory.
+    Time-series-only alphas (see alpha_needs_cross_section) are evaluated on blocks of 'asset_chunk' assets
+    over all dates; the panel is stored column by column, so each block is one contiguous read per field, and
+    the results are exact. Cross-sectional alphas are evaluated on blocks of 'date_chunk' dates over all
+    assets, each block preceded by enough dates of history for its rolling windows (see alpha_lookback, rounded
+    up to a multiple of 'date_chunk' so alphas with similar lookbacks share their reads). Cross-sectional alphas
+    that depend on the whole history (recursive Sma, close.std(), ...) cannot be cut by dates; they are evaluated
+    on the full panel in one block, which needs the whole panel of the fields they use in memory.
+    With enough history the values match the full panel up to rounding: pandas rolling sums accumulate from
+    the first row they are given, so the last bits depend on where the block starts, and a Rank over values
+    that only differ by rounding (e.g. the Corr of 2 days, always +-1) can order such near-ties differently.
+    Alphas of one block share an operator cache. An alpha that fails on any block is reported and left out.
+    :param cls: an alpha class with from_fields, e.g. alphas191.Alphas191 or alpha_code_1.Alphas.
+    :param panel: a datas.MemmapPanel (or its directory) holding the fields the alpha class needs.
+    :param output: directory of the result panel, one date x asset .npy per alpha; replaced if it exists.
+    :param names: alpha method names, all of them by default.
+    :param asset_chunk: number of assets per block for the time-series-only alphas.
+    :param date_chunk: number of dates per block for the cross-sectional alphas.
+    :param warmup: number of dates of history loaded before each date block for every cross-sectional alpha
+        with a bounded lookback; by default derived per alpha from alpha_lookback.
+    :param cache_bytes: memory budget of the operator cache of one block.
+    :return: a datas.MemmapPanel of the results.
+    """
+    if not isinstance(panel, MemmapPanel):
+        panel = MemmapPanel(panel)
+    time_series, cross = classify_alphas(cls, names)
+    n_dates, n_assets = len(panel.index), len(panel.columns)
+
+    if os.path.isdir(output):
+        shutil.rmtree(output)
+    os.makedirs(output)
+    results = {name: np.lib.format.open_memmap(f'{output}/{name}.npy', mode='w+', dtype='float64',
+                                               shape=(n_dates, n_assets), fortran_order=True)
+               for name in time_series + cross}
+    failed = set()
+
+    def run(names, rows, columns, keep):
+        data = panel.take(rows, columns)
+        stock = cls.from_fields(data)
+        index, assets = panel.index[rows][keep:], panel.columns[columns]
+        with operator_cache(cache_bytes):
+            for name in names:
+                if name in failed:
+                    continue
+                try:
+                    block = _block(getattr(stock, name)(), index, assets)
+                except Exception:
+                    print(f"generate {name} error!!!")
+                    failed.add(name)
+                    continue
+                results[name][rows.start + keep:rows.stop, columns] = block
+
+    if time_series:
+        for start, stop in _chunks(n_assets, asset_chunk):
+            run(time_series, slice(0, n_dates), slice(start, stop), 0)
+    # cross-sectional alphas grouped by the history each date block needs; None = the full panel at once
+    by_warmup = {}
+    for name in cross:
+        lookback = alpha_lookback(cls, name)
+        if lookback is not None:
+            lookback = warmup if warmup is not None else -(-lookback // date_chunk) * date_chunk
+        by_warmup.setdefault(lookback, []).append(name)
+    for history, group in by_warmup.items():
+        if history is None:
+            run(group, slice(0, n_dates), slice(0, n_assets), 0)
+            continue
+        for start, stop in _chunks(n_dates, date_chunk):
+            first = max(start - history, 0)
+            run(group, slice(first, stop), slice(0, n_assets), start - first)
+
+    for name in list(results):
+        results.pop(name).flush()
+        if name in failed:
+            os.remove(f'{output}/{name}.npy')
+
+    # index.json is written last, as in save_memmap_panel: without it the output is incomplete
+    with open(f'{output}/index.json', 'w', encoding='utf-8') as f:
+        json.dump({'dates': [str(x) for x in panel.index],
+                   'assets': [str(x) for x in panel.columns],
+                   'fields': {name: 2 for name in time_series + cross if name not in failed}}, f, ensure_ascii=False)
+    return MemmapPanel(output)
@@ -1,6 +1,10 @@
+import numpy as np
 import pandas as pd
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 import os
+import json
+import shutil
+import uuid
 
 def download_date_data(code, flag):
     try:
@@ -35,21 +39,84 @@ def download_all_date_data(flag):
     pool.close()
     pool.join()
 
-def get_all_date_data(start_time, end_time, list_assets):
-    data_path = 'data_bfq'
+def convert_date_data_to_parquet(flag, batch_size=500):
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+    except ImportError:
+        raise ImportError("pyarrow is required for convert_date_data_to_parquet; install via pip if needed.")
+    fg = 'bfq' if flag not in ['qfq', 'hfq'] else flag
+    csv_path = f'data_{fg}'
+    parquet_path = f'data_{fg}_parquet'
 
-    # 从本地保存的数据中读出需要的股票日数据
+    # 把 data_{fg}/{code}.csv 转成按年份分区的 parquet: data_{fg}_parquet/year=YYYY/*.parquet
+    # 每批读入 batch_size 个股票，避免一次把所有股票读进内存
+    codes = sorted(os.path.splitext(f)[0] for f in os.listdir(csv_path) if f.endswith('.csv'))
+    # 重新转换时先删除旧的 parquet，避免残留上次转换的文件
+    if os.path.isdir(parquet_path):
+        shutil.rmtree(parquet_path)
+    for i in range(0, len(codes), batch_size):
+        list_all = []
+        for c in codes[i:i + batch_size]:
+            df = pd.read_csv(f'{csv_path}/{c}.csv', index_col=0, dtype={'股票代码': str})
+            df['asset'] = c
+            list_all.append(df)
+        df_all = pd.concat(list_all, ignore_index=True)
+        df_all['year'] = df_all['日期'].str[:4].astype('int32')
+        # 分区内按日期排序，读取时可以依据 row group 的日期统计值跳过不需要的数据
+        df_all = df_all.sort_values(['日期', 'asset'])
+        ds.write_dataset(
+            pa.Table.from_pandas(df_all, preserve_index=False),
+            parquet_path,
+            format='parquet',
+            partitioning=['year'],
+            partitioning_flavor='hive',
+            basename_template=f'part-{i // batch_size}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+        )
+
+def read_date_data(start_time, end_time, list_assets, columns=None, flag='bfq'):
+    fg = 'bfq' if flag not in ['qfq', 'hfq'] else flag
+    parquet_path = f'data_{fg}_parquet'
+    list_assets = [str(c) for c in list_assets]
+    if columns is not None:
+        columns = list(dict.fromkeys(['日期'] + [c for c in columns if c != 'asset']))
+
+    if os.path.isdir(parquet_path):
+        # 已转换成 parquet：日期范围、股票列表和需要的列都下推到读取阶段，只解码需要的数据
+        try:
+            import pyarrow.dataset as ds
+        except ImportError:
+            raise ImportError("pyarrow is required for read_date_data; install via pip if needed.")
+        dataset = ds.dataset(parquet_path, format='parquet', partitioning='hive')
+        cond = ((ds.field('year') >= int(start_time[:4])) & (ds.field('year') <= int(end_time[:4]))
+                & (ds.field('日期') >= start_time) & (ds.field('日期') <= end_time)
+                & ds.field('asset').isin(list_assets))
+        if columns is None:
+            columns = [c for c in dataset.schema.names if c not in ['asset', 'year']]
+        df_all = dataset.to_table(columns=columns + ['asset'], filter=cond).to_pandas()
+        # 和逐个读取 csv 的结果一致：按 list_assets 的顺序、日期升序排列
+        order = pd.Series(range(len(list_assets)), index=list_assets)
+        df_all = df_all.iloc[np.lexsort((df_all['日期'].to_numpy(), order[df_all['asset']].to_numpy()))]
+        return df_all.reset_index(drop=True)
+
+    # 没有 parquet 时，逐个读取股票的 csv
     list_all = []
     for c in list_assets:
-        df = pd.read_csv(f'{data_path}/{c}.csv')
+        df = pd.read_csv(f'data_{fg}/{c}.csv', dtype={'股票代码': str},
+                         usecols=lambda x: x != 'Unnamed: 0' and (columns is None or x in columns))
         df['asset'] = c
         list_all.append(df[(df['日期'] >= start_time) & (df['日期'] <= end_time)])
-        
-    print(len(list_all))
+    df_all = pd.concat(list_all, ignore_index=True)
+    return df_all if columns is None else df_all[columns + ['asset']]
+
+def get_all_date_data(start_time, end_time, list_assets):
+    # 从本地保存的数据中读出需要的股票日数据
+    df_all = read_date_data(start_time, end_time, list_assets,
+                            columns=["日期", "开盘", "收盘", "最高", "最低", "成交量", "成交额", "涨跌幅"])
+
+    print(df_all['asset'].nunique())
 
-    # 所有股票日数据拼接成一张表
-    df_all = pd.concat(list_all)
-        
     # 修改列名
     df_all = df_all.rename(columns={
         "日期": "date", 
@@ -68,6 +135,275 @@ def get_all_date_data(start_time, end_time, list_assets):
     df_all = df_all[['asset','date', "open", "close", "high", "low", "volume", 'vwap', "pctChg"]]
     return df_all
 
+def save_memmap_panel(panel, path):
+    # 把 日期 x 股票 的面板数据按字段保存成 numpy 的 .npy 文件，另外用 index.json 记录日期和股票
+    # 二维字段按列(Fortran)顺序保存，同一个股票的时间序列在磁盘上是连续的，适合滚动计算
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    index, columns = None, None
+    fields = {}
+    for field, value in panel.items():
+        if isinstance(value, pd.DataFrame):
+            columns = value.columns if columns is None else columns
+            value = value.reindex(columns=columns)
+        index = value.index if index is None else index
+        value = value.reindex(index)
+        arr = np.lib.format.open_memmap(f'{path}/{field}.npy', mode='w+', dtype='float64',
+                                        shape=value.shape, fortran_order=value.ndim == 2)
+        arr[:] = value.to_numpy(dtype='float64')
+        arr.flush()
+        del arr
+        fields[field] = value.ndim
+
+    # index.json 最后写入，没有它说明上次保存没有完成
+    with open(f'{path}/index.json', 'w', encoding='utf-8') as f:
+        json.dump({'dates': [str(x) for x in index],
+                   'assets': [str(x) for x in columns] if columns is not None else [],
+                   'fields': fields}, f, ensure_ascii=False)
+    return MemmapPanel(path)
+
+class MemmapPanel(object):
+    # 以内存映射的方式打开 save_memmap_panel 保存的面板数据，用法和 get_stocks_data 返回的 dict 一样
+    # 取字段时才打开对应的 .npy 文件，数据页由操作系统按需读入，多个进程共享同一份页缓存
+    # mmap_mode 默认为 'c'(写时复制)：因子计算中对数据的原地修改只影响当前进程，不会写回磁盘
+    def __init__(self, path, mmap_mode='c'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(f'{path}/index.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.index = pd.Index(meta['dates'], name='date')
+        self.columns = pd.Index(meta['assets'], name='asset')
+        self.fields = meta['fields']
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        arr = np.load(f'{self.path}/{field}.npy', mmap_mode=self.mmap_mode)
+        if arr.ndim == 1:
+            return pd.Series(arr, index=self.index, name=field, copy=False)
+        return pd.DataFrame(arr, index=self.index, columns=self.columns, copy=False)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return [(field, self[field]) for field in self.fields]
+
+    def take(self, rows=slice(None), columns=slice(None)):
+        # 把一部分日期(rows)、一部分股票(columns)的数据读进内存，返回 字段 -> DataFrame/Series 的 dict，用法和整份面板一样
+        # rows、columns 是位置切片；二维字段按列保存，取一段股票时每个股票的时间序列在磁盘上是连续读取的
+        # 指数等一维字段只按日期切
+        index = self.index[rows]
+        panel = {}
+        for field, ndim in self.fields.items():
+            arr = np.load(f'{self.path}/{field}.npy', mmap_mode='r')
+            if ndim == 1:
+                panel[field] = pd.Series(np.array(arr[rows]), index=index, name=field)
+            else:
+                panel[field] = pd.DataFrame(np.array(arr[rows, columns], order='F'), index=index,
+                                            columns=self.columns[columns], copy=False)
+        return panel
+
+    def __reduce__(self):
+        # 传给子进程时只传路径，子进程自己重新映射文件，而不是把整份数据序列化过去
+        return (self.__class__, (self.path, self.mmap_mode))
+
+def share_panel(panel):
+    # 把 日期 x 股票 的面板数据按字段放进 multiprocessing.shared_memory，每个字段一块共享内存
+    # 二维字段与 save_memmap_panel 一样按列(Fortran)顺序存放；用完后由创建者调用 unlink() 释放
+    index, columns = None, None
+    fields = {}
+    blocks = {}
+    try:
+        for field, value in panel.items():
+            if isinstance(value, pd.DataFrame):
+                columns = value.columns if columns is None else columns
+                value = value.reindex(columns=columns)
+            index = value.index if index is None else index
+            value = value.reindex(index)
+            shm = shared_memory.SharedMemory(create=True, size=max(value.size * 8, 1))
+            blocks[shm.name] = shm
+            arr = np.ndarray(value.shape, dtype='float64', buffer=shm.buf, order='F')
+            arr[:] = value.to_numpy(dtype='float64')
+            del arr
+            fields[field] = (shm.name, value.shape)
+    except Exception:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+        raise
+    _shared_blocks.update(blocks)
+    return SharedPanel(index, columns, fields)
+
+# 当前进程已连接的共享内存块，按名字保存；numpy 视图还在使用时不能关闭，所以连接后一直保留到进程结束或 unlink()
+_shared_blocks = {}
+
+class SharedPanel(object):
+    # share_panel 放进共享内存的面板数据，用法和 get_stocks_data 返回的 dict、MemmapPanel 一样
+    # 取字段时直接把共享内存当作 numpy 数组使用，不复制数据；数组是只读的，避免一个进程的原地修改影响其他进程
+    # 传给子进程时只传共享内存的名字、形状和日期/股票索引，子进程连接同一块内存
+    def __init__(self, index, columns, fields):
+        self.index = index
+        self.columns = columns
+        self.fields = fields
+
+    def _block(self, name):
+        shm = _shared_blocks.get(name)
+        if shm is None:
+            shm = _shared_blocks[name] = shared_memory.SharedMemory(name=name)
+        return shm
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+        name, shape = self.fields[field]
+        arr = np.ndarray(shape, dtype='float64', buffer=self._block(name).buf, order='F')
+        arr.flags.writeable = False
+        if arr.ndim == 1:
+            return pd.Series(arr, index=self.index, name=field, copy=False)
+        return pd.DataFrame(arr, index=self.index, columns=self.columns, copy=False)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return [(field, self[field]) for field in self.fields]
+
+    def unlink(self):
+        # 由创建者在所有子进程结束后调用：删除共享内存的名字，最后一个使用者关闭后操作系统回收内存
+        for name, _ in self.fields.values():
+            shm = _shared_blocks.pop(name, None)
+            if shm is None:
+                continue
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                # 还有 DataFrame 引用这块内存，名字已删除，连接保留到进程结束
+                _shared_blocks[name] = shm
+
+    def __reduce__(self):
+        return (self.__class__, (self.index, self.columns, self.fields))
+
+class AlphaStore(object):
+    # 因子计算结果的列式存储，代替每个因子每年一个 csv：{root}/{alpha}/{year}.parquet
+    # 每个文件是一个因子一年的数据，按 日期、股票 排序的长表(date, asset, value)，用 zstd 压缩，
+    # 每 row_group_dates 个交易日一个分块；宽表每只股票一列，几千列的 parquet 解码很慢，长表只有一个数值列
+    # 读取时只打开需要的因子和年份，按分块的日期范围跳过不需要的分块，不需要解析文本
+    # 写入先写到临时文件再改名，进程池里多个子进程同时写入也不会读到写了一半的文件
+    def __init__(self, root, compression='zstd', compression_level=None, row_group_dates=64):
+        self.root = root
+        self.compression = compression
+        self.compression_level = compression_level
+        self.row_group_dates = row_group_dates
+
+    def write(self, alpha, data, year=None):
+        # data 为 日期 x 股票 的因子值；指定 year 时只保存该年的日期(前后多算的日期只是为了滚动计算的历史数据)
+        # 不指定 year 时按日期所在年份分别保存；同一个因子同一年的数据会整份覆盖
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required for AlphaStore; install via pip if needed.")
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+        years = pd.to_datetime(data.index).year
+        assets = [str(a) for a in data.columns]
+        # 股票顺序和索引名称记在文件的 metadata 里，读取时直接把数值列还原成二维面板
+        meta = json.dumps({'assets': assets, 'index_name': data.index.name, 'columns_name': data.columns.name},
+                          ensure_ascii=False)
+        path = f'{self.root}/{alpha}'
+        os.makedirs(path, exist_ok=True)
+        for y in ([int(year)] if year is not None else np.unique(years)):
+            part = data[years == y]
+            values = part.to_numpy(dtype='float64')
+            table = pa.table({
+                'date': pa.array(np.repeat(part.index.to_numpy(), len(assets))),
+                'asset': pa.array(np.tile(np.array(assets, dtype=object), len(part))),
+                'value': values.ravel(),
+            }).replace_schema_metadata({'alpha_store': meta})
+            tmp_path = f'{path}/.{y}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+            try:
+                pq.write_table(table, tmp_path, compression=self.compression, compression_level=self.compression_level,
+                               row_group_size=max(self.row_group_dates * len(assets), 1), write_statistics=['date'])
+                os.replace(tmp_path, f'{path}/{y}.parquet')
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def alphas(self):
+        # 已保存的因子名称
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(a for a in os.listdir(self.root) if self.years(a))
+
+    def years(self, alpha):
+        # 某个因子已保存的年份
+        path = f'{self.root}/{alpha}'
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(f[:-8]) for f in os.listdir(path) if f.endswith('.parquet'))
+
+    def read(self, alpha, start_time=None, end_time=None, assets=None):
+        # 读取一个因子在 [start_time, end_time] 之间的 日期 x 股票 面板，assets 指定只取部分股票(没有的股票为 NaN)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("pyarrow is required for AlphaStore; install via pip if needed.")
+        start = None if start_time is None else pd.Timestamp(start_time)
+        end = None if end_time is None else pd.Timestamp(end_time)
+        years = [y for y in self.years(alpha) if (start is None or y >= start.year) and (end is None or y <= end.year)]
+        if not years:
+            raise KeyError(alpha)
+
+        frames = []
+        for y in years:
+            pf = pq.ParquetFile(f'{self.root}/{alpha}/{y}.parquet', read_dictionary=['date'])
+            meta = json.loads(pf.schema_arrow.metadata[b'alpha_store'])
+            # 依据每个分块里日期的最小/最大值，跳过不在日期范围内的分块
+            groups = []
+            for i in range(pf.num_row_groups):
+                stats = pf.metadata.row_group(i).column(0).statistics
+                if stats is not None and stats.has_min_max and (
+                        (start is not None and pd.Timestamp(stats.max) < start)
+                        or (end is not None and pd.Timestamp(stats.min) > end)):
+                    continue
+                groups.append(i)
+            table = pf.read_row_groups(groups, columns=['date', 'value'])
+            n_assets = len(meta['assets'])
+            dates = table.column('date').take(pa.array(np.arange(0, table.num_rows, n_assets)))
+            if pa.types.is_dictionary(dates.type):
+                dates = dates.cast(dates.type.value_type)
+            df = pd.DataFrame(table.column('value').to_numpy().reshape(-1, n_assets),
+                              index=pd.Index(dates.to_pandas(), name=meta['index_name']),
+                              columns=pd.Index(meta['assets'], name=meta['columns_name']))
+            frames.append(df if assets is None else df.reindex(columns=pd.Index([str(a) for a in assets],
+                                                                                name=meta['columns_name'])))
+        df = pd.concat(frames) if len(frames) > 1 else frames[0]
+        if start is not None or end is not None:
+            dates = pd.to_datetime(df.index)
+            keep = np.ones(len(df), dtype=bool)
+            if start is not None:
+                keep &= dates >= start
+            if end is not None:
+                keep &= dates <= end
+            df = df[keep]
+        return df
+
+    def read_alphas(self, alphas=None, start_time=None, end_time=None, assets=None):
+        # 一次读取多个因子，返回 {因子名称: 面板}；alphas 为 None 时读取所有已保存的因子
+        alphas = self.alphas() if alphas is None else alphas
+        return {alpha: self.read(alpha, start_time, end_time, assets) for alpha in alphas}
+
 def get_zz500_stocks(time):
     try:
         import baostock as bs
@@ -139,3 +475,4 @@ def download_index_data(code):
 if __name__ == '__main__':
     download_index_data("sh000300")
     download_all_date_data("bfq")
+    convert_date_data_to_parquet("bfq")
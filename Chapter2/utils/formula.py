@@ -0,0 +1,415 @@
+import inspect
+import operator
+import re
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from .alphas191 import (Alphas191, Log, Rank, Delta, Delay, Corr, Cov, Sum, Prod, Mean, Std, Tsrank, Tsmax, Tsmin,
+                        Sign, Max, Min, Sma, Abs, Sequence, Regbeta, Decaylinear, Lowday, Highday, Wma, Count, Sumif)
+
+
+# region Language
+# Formula fields and the Alphas191 attribute each one reads
+FIELDS = {
+    'OPEN': 'open',
+    'HIGH': 'high',
+    'LOW': 'low',
+    'CLOSE': 'close',
+    'VOLUME': 'volume',
+    'AMOUNT': 'amount',
+    'VWAP': 'vwap',
+    'RET': 'returns',
+    'BANCHMARKINDEXOPEN': 'benchmark_open',
+    'BANCHMARKINDEXCLOSE': 'benchmark_close',
+}
+
+# Formula functions: (operator, argument kinds), 'x' is an expression and 'n' a constant parameter
+FUNCTIONS = {
+    'LOG': (Log, 'x'),
+    'RANK': (Rank, 'x'),
+    'DELTA': (Delta, 'xn'),
+    'DELAY': (Delay, 'xn'),
+    'CORR': (Corr, 'xxn'),
+    'COV': (Cov, 'xxn'),
+    'SUM': (Sum, 'xn'),
+    'PROD': (Prod, 'xn'),
+    'MEAN': (Mean, 'xn'),
+    'STD': (Std, 'xn'),
+    'TSRANK': (Tsrank, 'xn'),
+    'TSMAX': (Tsmax, 'xn'),
+    'TSMIN': (Tsmin, 'xn'),
+    'SIGN': (Sign, 'x'),
+    'MAX': (Max, 'xx'),
+    'MIN': (Min, 'xx'),
+    'SMA': (Sma, 'xnn'),
+    'ABS': (Abs, 'x'),
+    'SEQUENCE': (Sequence, 'n'),
+    'REGBETA': (Regbeta, 'xn'),
+    'DECAYLINEAR': (Decaylinear, 'xn'),
+    'LOWDAY': (Lowday, 'xn'),
+    'HIGHDAY': (Highday, 'xn'),
+    'WMA': (Wma, 'xn'),
+    'COUNT': (Count, 'xn'),
+    'SUMIF': (Sumif, 'xnx'),
+}
+
+_BINARY = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '^': operator.pow,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '&&': operator.and_,
+    '||': operator.or_,
+}
+
+# Operations whose operands can be reordered, so a+b and b+a become one node
+_COMMUTATIVE = {'+', '*', '==', '!=', '&&', '||', 'MAX', 'MIN'}
+
+_TOKEN = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(&&|\|\||<=|>=|==|!=|[-+*/^<>=?:(),&|]))")
+# endregion
+
+
+def _tokenize(formula):
+    """
+    Split a formula into ('num' | 'name' | 'op', text) tokens.
+    :param formula: a formula string such as 'RANK(DELTA(CLOSE, 1))'.
+    :return: a list of tokens ending with ('end', '').
+    """
+    for wide, ascii_char in (('，', ','), ('？', '?'), ('：', ':'), ('–', '-')):
+        formula = formula.replace(wide, ascii_char)
+    tokens = []
+    position = 0
+    while True:
+        while position < len(formula) and formula[position].isspace():
+            position += 1
+        if position == len(formula):
+            break
+        match = _TOKEN.match(formula, position)
+        if match is None:
+            raise ValueError(f"unexpected character {formula[position]!r} at {position} in {formula!r}")
+        number, name, op = match.groups()
+        if number is not None:
+            tokens.append(('num', number))
+        elif name is not None:
+            tokens.append(('name', name.upper()))
+        else:
+            tokens.append(('op', {'=': '==', '&': '&&', '|': '||'}.get(op, op)))
+        position = match.end()
+    tokens.append(('end', ''))
+    return tokens
+
+
+def _align_series(values):
+    """
+    Broadcast the Series operands (the benchmark fields, one value per date) to the shape of a DataFrame operand.
+    pandas aligns a Series with the columns of a DataFrame, not with its dates, so 'CLOSE > BANCHMARKINDEXCLOSE'
+    would otherwise come out as an all-NaN frame with the dates as extra columns.
+    :param values: the operands of one operation.
+    :return: the operands, with every Series repeated over the columns of the first DataFrame operand.
+    """
+    like = next((v for v in values if isinstance(v, pd.DataFrame)), None)
+    if like is None or not any(isinstance(v, pd.Series) for v in values):
+        return values
+    return [
+        pd.DataFrame(np.repeat(v.reindex(like.index).to_numpy()[:, None], like.shape[1], axis=1),
+                     index=like.index, columns=like.columns)
+        if isinstance(v, pd.Series) else v
+        for v in values
+    ]
+
+
+def _if(cond, a, b):
+    """
+    The formula 'cond ? a : b' on panels; a comparison with NaN is false and takes the ':' branch.
+    """
+    for like in (a, b, cond):
+        if isinstance(like, pd.DataFrame):
+            return pd.DataFrame(np.where(cond, a, b), index=like.index, columns=like.columns)
+        if isinstance(like, pd.Series):
+            return pd.Series(np.where(cond, a, b), index=like.index, name=like.name)
+    return a if cond else b
+
+
+class _Parser(object):
+    """
+    Recursive descent parser that builds the nodes of a formula directly in a FormulaCompiler.
+    Precedence from low to high: ?:, ||, &&, comparisons, + -, * /, unary -, ^.
+    """
+
+    _COMPARISONS = ('<', '>', '<=', '>=', '==', '!=')
+
+    def __init__(self, compiler, formula):
+        self.compiler = compiler
+        self.formula = formula
+        self.tokens = _tokenize(formula)
+        self.position = 0
+
+    def parse(self):
+        node = self.ternary()
+        self.expect('end')
+        return node
+
+    def peek(self):
+        return self.tokens[self.position]
+
+    def take(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def accept(self, *ops):
+        kind, text = self.peek()
+        if kind == 'op' and text in ops:
+            self.position += 1
+            return text
+        return None
+
+    def expect(self, text):
+        kind, value = self.take()
+        if (kind == 'end' and text == 'end') or (kind == 'op' and value == text):
+            return
+        raise ValueError(f"expected {text!r} but got {value or 'end of formula'!r} in {self.formula!r}")
+
+    def ternary(self):
+        node = self.binary(0)
+        if self.accept('?'):
+            a = self.ternary()
+            self.expect(':')
+            b = self.ternary()
+            node = self.compiler._node('?', (node, a, b))
+        return node
+
+    def binary(self, level):
+        levels = (('||',), ('&&',), self._COMPARISONS, ('+', '-'), ('*', '/'))
+        if level == len(levels):
+            return self.unary()
+        node = self.binary(level + 1)
+        while True:
+            op = self.accept(*levels[level])
+            if op is None:
+                return node
+            node = self.compiler._node(op, (node, self.binary(level + 1)))
+
+    def unary(self):
+        if self.accept('-'):
+            return self.compiler._node('neg', (self.unary(),))
+        if self.accept('+'):
+            return self.unary()
+        return self.power()
+
+    def power(self):
+        node = self.primary()
+        if self.accept('^'):
+            node = self.compiler._node('^', (node, self.unary()))
+        return node
+
+    def primary(self):
+        kind, text = self.take()
+        if kind == 'num':
+            return self.compiler._const(float(text) if any(c in text for c in '.eE') else int(text))
+        if kind == 'op' and text == '(':
+            node = self.ternary()
+            self.expect(')')
+            return node
+        if kind == 'name':
+            if self.accept('('):
+                args = [self.ternary()]
+                while self.accept(','):
+                    args.append(self.ternary())
+                self.expect(')')
+                return self.compiler._call(text, args, self.formula)
+            if text not in FIELDS:
+                raise ValueError(f"unknown field {text!r} in {self.formula!r}")
+            return self.compiler._node('field', (FIELDS[text],))
+        raise ValueError(f"unexpected {text or 'end of formula'!r} in {self.formula!r}")
+
+
+class FormulaCompiler(object):
+    """
+    Compile alpha formulas written in the Alphas191 notation (RANK, DELAY, CORR, SMA, ... , 'c ? a : b')
+    into one computation DAG shared by all of them.
+    Identical sub-expressions of different formulas (and a+b / b+a) become a single node and constant
+    sub-expressions are folded, so evaluating many alphas costs the number of distinct nodes.
+    MAX/MIN with a constant window (> 1) as second argument are the rolling TSMAX/TSMIN,
+    the way the Alphas191 methods translate them; MAX(x, 0) stays element-wise.
+    """
+
+    def __init__(self):
+        self.nodes = []  # (op, args): args are node ids, the value of 'const' or the attribute of 'field'
+        self.outputs = {}  # formula name -> node id
+        self.parsed_operations = 0  # operations before merging, i.e. the cost of evaluating every formula on its own
+        self._index = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def operations(self):
+        """
+        Number of distinct operations in the DAG, i.e. the cost of evaluating all formulas together.
+        """
+        return sum(op not in ('const', 'field') for op, _ in self.nodes)
+
+    def _const(self, value):
+        if isinstance(value, np.ndarray):
+            key = ('const', 'array', value.dtype.str, value.tobytes())
+        else:
+            key = ('const', type(value).__name__, value)
+        return self._add(key, ('const', value))
+
+    def _node(self, op, args):
+        """
+        Add an operation on existing nodes, folding it when all operands are constants.
+        :return: the node id.
+        """
+        if op == 'field':
+            return self._add(('field',) + args, ('field', args[0]))
+        foldable = op not in FUNCTIONS or set(FUNCTIONS[op][1]) == {'n'}
+        if foldable and all(self.nodes[a][0] == 'const' for a in args):
+            return self._const(self._apply(op, [self.nodes[a][1] for a in args]))
+        self.parsed_operations += 1
+        if op in _COMMUTATIVE:
+            args = tuple(sorted(args))
+        return self._add((op,) + tuple(args), (op, tuple(args)))
+
+    def _add(self, key, node):
+        node_id = self._index.get(key)
+        if node_id is None:
+            node_id = self._index[key] = len(self.nodes)
+            self.nodes.append(node)
+        return node_id
+
+    def _call(self, name, args, formula):
+        if name in ('MAX', 'MIN') and len(args) == 2 and self.nodes[args[0]][0] != 'const':
+            window = self.nodes[args[1]]
+            if window[0] == 'const' and np.ndim(window[1]) == 0 and window[1] > 1 and window[1] == int(window[1]):
+                name = 'TS' + name
+        if name not in FUNCTIONS:
+            raise ValueError(f"unknown function {name!r} in {formula!r}")
+        kinds = FUNCTIONS[name][1]
+        if len(args) != len(kinds):
+            raise ValueError(f"{name} takes {len(kinds)} arguments, got {len(args)} in {formula!r}")
+        for arg, kind in zip(args, kinds):
+            if kind == 'n' and self.nodes[arg][0] != 'const':
+                raise ValueError(f"the parameters of {name} must be constants in {formula!r}")
+        return self._node(name, tuple(args))
+
+    @staticmethod
+    def _apply(op, values):
+        values = _align_series(values)
+        if op in FUNCTIONS:
+            return FUNCTIONS[op][0](*values)
+        if op == 'neg':
+            return -values[0]
+        if op == '?':
+            return _if(*values)
+        return _BINARY[op](*values)
+
+    def add(self, name, formula):
+        """
+        Compile one formula into the DAG.
+        :param name: name of the result, e.g. 'alpha001'.
+        :param formula: the formula string.
+        :return: the id of the node holding the result.
+        """
+        if name in self.outputs:
+            raise ValueError(f"formula {name!r} is already compiled")
+        node_id = _Parser(self, formula).parse()
+        self.outputs[name] = node_id
+        return node_id
+
+    def dependencies(self, node_ids):
+        """
+        :param node_ids: node ids, e.g. the values of 'outputs'.
+        :return: the sorted ids of these nodes and of every node they depend on; children come before parents.
+        """
+        needed = set()
+        stack = list(node_ids)
+        while stack:
+            node_id = stack.pop()
+            if node_id not in needed:
+                needed.add(node_id)
+                op, args = self.nodes[node_id]
+                if op not in ('const', 'field'):
+                    stack.extend(args)
+        return sorted(needed)
+
+    def evaluate_nodes(self, data, node_ids):
+        """
+        Evaluate nodes, each once, in dependency order with the vectorized operators.
+        An intermediate result is released as soon as its last consumer has been computed.
+        :param data: an Alphas191 instance, or the dict of stock data that Alphas191 is built from.
+        :param node_ids: the nodes whose results are returned.
+        :return: dict node id -> result.
+        """
+        if not isinstance(data, Alphas191):
+            data = Alphas191(data)
+        keep = set(node_ids)
+        needed = self.dependencies(keep)
+        consumers = Counter()
+        for node_id in needed:
+            op, args = self.nodes[node_id]
+            if op not in ('const', 'field'):
+                consumers.update(set(args))
+
+        values = {}
+        for node_id in needed:
+            op, args = self.nodes[node_id]
+            if op == 'const':
+                values[node_id] = args
+                continue
+            if op == 'field':
+                values[node_id] = getattr(data, args)
+                continue
+            values[node_id] = self._apply(op, [values[a] for a in args])
+            for child in set(args):
+                consumers[child] -= 1
+                if consumers[child] == 0 and child not in keep:
+                    del values[child]
+        return {node_id: values[node_id] for node_id in keep}
+
+    def evaluate(self, data, names=None):
+        """
+        Evaluate compiled formulas; identical sub-expressions are computed once.
+        :param data: an Alphas191 instance, or the dict of stock data that Alphas191 is built from.
+        :param names: the formulas to evaluate, all of them by default.
+        :return: dict name -> result.
+        """
+        names = list(self.outputs) if names is None else list(names)
+        values = self.evaluate_nodes(data, [self.outputs[name] for name in names])
+        return {name: values[self.outputs[name]] for name in names}
+
+
+def alphas191_formulas():
+    """
+    The original formulas in the '####...###' comments of the Alphas191 methods.
+    :return: dict method name -> formula string, for the methods that carry one.
+    """
+    formulas = {}
+    for name in Alphas191.get_alpha_methods(Alphas191):
+        for line in inspect.getsource(getattr(Alphas191, name)).splitlines():
+            line = line.strip()
+            if line.startswith('####'):
+                formulas[name] = line.strip('#').strip()
+                break
+    return formulas
+
+
+def compile_formulas(formulas):
+    """
+    :param formulas: dict name -> formula string.
+    :return: a FormulaCompiler holding all of them.
+    """
+    compiler = FormulaCompiler()
+    for name, formula in formulas.items():
+        compiler.add(name, formula)
+    return compiler
@@ -0,0 +1,511 @@
+import numpy as np
+import pandas as pd
+
+
+# region Helpers
+def _values(df):
+    """
+    Return the data of a Series/DataFrame as a 2-D float array, one column per series.
+    :param df: a pandas Series or DataFrame.
+    :return: a numpy array of shape (len(df), n_columns).
+    """
+    values = np.asarray(df, dtype=float)
+    return values.reshape(len(values), -1)
+
+
+def _wrap(values, like):
+    """
+    Put a 2-D result back into the shape and labels of the input.
+    :param values: a numpy array of shape (len(like), n_columns).
+    :param like: the pandas Series or DataFrame the result was computed from.
+    :return: a pandas Series or DataFrame with the index/columns of 'like'.
+    """
+    if isinstance(like, pd.Series):
+        return pd.Series(values[:, 0], index=like.index, name=like.name)
+    return pd.DataFrame(values, index=like.index, columns=like.columns)
+
+
+def _full_windows(values, window):
+    """
+    Mark the rows whose trailing window holds 'window' finite values,
+    i.e. where df.rolling(window) (min_periods=window) produces a value
+    (pandas rolling treats +/-inf as missing).
+    :param values: a 2-D numpy array.
+    :param window: the rolling window.
+    :return: a boolean numpy array of the same shape as 'values'.
+    """
+    return _window_count(np.isfinite(values), window) == window
+
+
+def _window_count(flags, window):
+    """
+    Number of True flags in each trailing window (partial windows at the top are counted as they are).
+    :param flags: a 2-D boolean numpy array.
+    :param window: the rolling window.
+    :return: an integer numpy array of the same shape as 'flags'.
+    """
+    count = np.cumsum(flags, axis=0, dtype=np.int32)
+    count[window:] = count[window:] - count[:-window]
+    return count
+# endregion
+
+
+def rolling_rank_last(df, window):
+    """
+    Rank of the last value inside each rolling window, for every column at once.
+    Same result as df.rolling(window).apply(lambda x: rankdata(x)[-1]):
+    ties get the average rank and any window containing NaN or inf gives NaN.
+    The rank is built from window-1 shifted comparisons instead of one
+    Python call per window.
+    :param df: a pandas Series or DataFrame.
+    :param window: the rolling window.
+    :return: a pandas Series or DataFrame with the time-series rank over the past 'window' days.
+    """
+    values = _values(df)
+    out = np.full(values.shape, np.nan)
+    n = len(values)
+    if 0 < window <= n:
+        last = values[window - 1:]
+        less = np.zeros(last.shape)
+        equal = np.ones(last.shape)
+        for lag in range(1, window):
+            prev = values[window - 1 - lag:n - lag]
+            less += prev < last
+            equal += prev == last
+        # average rank of the last value: values below it, plus the mean position among its ties
+        out[window - 1:] = less + (equal + 1) / 2
+        out[~_full_windows(values, window)] = np.nan
+    return _wrap(out, df)
+
+
+def _weighted_lag_sum(values, weights, out):
+    """
+    Write sum(weights[k] * values[k:m + k]) into out (m = len(values) - len(weights) + 1).
+    Every element is accumulated with the same elementwise operations in the same order,
+    so identical windows give bit-identical results in every column and ties survive a later rank
+    (a BLAS matrix product does not guarantee this). The panel is processed in blocks along its
+    contiguous axis so the accumulator stays in cache. inf inputs (inf - inf, inf * 0) only spoil their own
+    windows, so the floating point warnings they raise are silenced; rolling_dot masks those windows itself.
+    :param values: a 2-D numpy array.
+    :param weights: 1-D array of window weights, oldest first.
+    :param out: a numpy array of shape (m, values.shape[1]) receiving the result.
+    """
+    window = len(weights)
+    m = len(values) - window + 1
+    by_column = values.flags.f_contiguous
+    step = 64 if by_column else 128
+    with np.errstate(invalid='ignore', over='ignore'):
+        for start in range(0, values.shape[1] if by_column else m, step):
+            if by_column:
+                cols = slice(start, start + step)
+                acc = out[:, cols]
+                lagged = lambda k: values[k:m + k, cols]
+            else:
+                stop = min(start + step, m)
+                acc = out[start:stop]
+                lagged = lambda k: values[start + k:stop + k]
+            np.multiply(lagged(0), weights[0], out=acc)
+            tmp = np.empty_like(acc)
+            for k in range(1, window):
+                np.multiply(lagged(k), weights[k], out=tmp)
+                acc += tmp
+
+
+def rolling_dot(df, weights, strict=True):
+    """
+    Fixed-weight rolling dot product, for every column at once:
+    result[t] = sum(weights[k] * df[t - len(weights) + 1 + k]), so the last weight multiplies the newest value.
+    Computed as len(weights) shifted multiply-adds over the whole panel instead of one call per window.
+    :param df: a pandas Series or DataFrame.
+    :param weights: 1-D array of window weights, oldest first.
+    :param strict: if True, windows holding NaN or inf give NaN like df.rolling(window).apply(...);
+        if False, the plain dot product is returned for every full window.
+    :return: a pandas Series or DataFrame, NaN for the first len(weights)-1 rows.
+    """
+    weights = np.asarray(weights, dtype=float)
+    window = len(weights)
+    values = _values(df)
+    out = np.full(values.shape, np.nan, order='F' if values.flags.f_contiguous else 'C')
+    n = len(values)
+    if 0 < window <= n:
+        _weighted_lag_sum(values, weights, out[window - 1:])
+        if strict:
+            out[~_full_windows(values, window)] = np.nan
+    return _wrap(out, df)
+
+
+def _rolling_argmax_values(values, window):
+    """
+    Position (0 = oldest) of the first maximum inside every full rolling window of a 2-D array.
+    Uses the van Herk/Gil-Werman scheme: the rows are cut into blocks of 'window' rows, and every
+    window is the suffix of one block plus the prefix of the next, so the cost does not grow with the window.
+    Only values inside a window are ever compared for it, so NaN/inf only spoil windows that contain them.
+    :param values: a 2-D numpy array with at least 'window' rows.
+    :param window: the rolling window.
+    :return: a numpy array of shape (len(values) - window + 1, values.shape[1]).
+    """
+    n, c = values.shape
+    n_blocks = -(-n // window)
+    padded = np.full((n_blocks * window, c), -np.inf)
+    padded[:n] = values
+    blocks = padded.reshape(n_blocks, window, c)
+    offset = np.arange(window).reshape(1, window, 1)
+    block_start = (np.arange(n_blocks) * window).reshape(n_blocks, 1, 1)
+    is_new = np.empty(blocks.shape, dtype=bool)
+    is_new[:, 0] = True
+
+    # prefix of each block: running max and where it first appeared (a later tie does not move it)
+    prefix_max = np.maximum.accumulate(blocks, axis=1)
+    np.greater(blocks[:, 1:], prefix_max[:, :-1], out=is_new[:, 1:])
+    prefix_pos = np.maximum.accumulate(np.where(is_new, offset, 0), axis=1) + block_start
+
+    # suffix of each block, scanned backwards: an earlier tie takes over the position
+    reverse = blocks[:, ::-1]
+    suffix_max = np.maximum.accumulate(reverse, axis=1)
+    np.greater_equal(reverse[:, 1:], suffix_max[:, :-1], out=is_new[:, 1:])
+    suffix_pos = (window - 1) - np.maximum.accumulate(np.where(is_new, offset, 0), axis=1)
+    suffix_max = suffix_max[:, ::-1].reshape(-1, c)
+    suffix_pos = (suffix_pos[:, ::-1] + block_start).reshape(-1, c)
+    prefix_max = prefix_max.reshape(-1, c)
+    prefix_pos = prefix_pos.reshape(-1, c)
+
+    # window [t - window + 1, t] = suffix starting at its first row + prefix ending at t
+    m = n - window + 1
+    first = suffix_max[:m] >= prefix_max[window - 1:n]
+    pos = np.where(first, suffix_pos[:m], prefix_pos[window - 1:n])
+    return pos - np.arange(m).reshape(m, 1)
+
+
+def _rolling_arg(df, window, find):
+    values = _values(df)
+    out = np.full(values.shape, np.nan)
+    if 0 < window <= len(values):
+        out[window - 1:] = _rolling_argmax_values(values if find == 'max' else -values, window)
+        out[~_full_windows(values, window)] = np.nan
+    return _wrap(out, df)
+
+
+def rolling_argmax(df, window):
+    """
+    Position of the maximum inside each rolling window, for every column at once.
+    Same result as df.rolling(window).apply(np.argmax): 0 is the oldest day of the window,
+    ties give the earliest day and any window containing NaN or inf gives NaN.
+    :param df: a pandas Series or DataFrame.
+    :param window: the rolling window.
+    :return: a pandas Series or DataFrame with positions between 0 and window-1.
+    """
+    return _rolling_arg(df, window, 'max')
+
+
+def rolling_argmin(df, window):
+    """
+    Position of the minimum inside each rolling window, for every column at once.
+    Same result as df.rolling(window).apply(np.argmin); see rolling_argmax.
+    :param df: a pandas Series or DataFrame.
+    :param window: the rolling window.
+    :return: a pandas Series or DataFrame with positions between 0 and window-1.
+    """
+    return _rolling_arg(df, window, 'min')
+
+
+def rolling_product(df, window):
+    """
+    Rolling product, for every column at once, computed in log space:
+    product = (-1)^(number of negatives) * exp(sum(log|x|)), and exactly 0 when the window holds a zero.
+    Sign and zero counts are kept apart from the log sum, so negative and zero values are handled exactly
+    and only the magnitude goes through log/exp (relative error around 1e-15 per value in the window).
+    The log sum uses the same fixed-order lag sum as rolling_dot, so identical windows give identical products.
+    Same result as df.rolling(window).apply(np.prod) up to that rounding; windows holding NaN or inf give NaN.
+    :param df: a pandas Series or DataFrame.
+    :param window: the rolling window.
+    :return: a pandas Series or DataFrame with the time-series product over the past 'window' days.
+    """
+    values = _values(df)
+    out = np.full(values.shape, np.nan)
+    n = len(values)
+    if window == 1:
+        # a one-day product is the value itself, no need to round-trip through log/exp
+        out[np.isfinite(values)] = values[np.isfinite(values)]
+    elif 0 < window <= n:
+        finite = np.isfinite(values)
+        zero = values == 0
+        magnitude = np.abs(values)
+        magnitude[~finite | zero] = 1
+        log_sum = np.empty((n - window + 1, values.shape[1]), order='F' if values.flags.f_contiguous else 'C')
+        _weighted_lag_sum(np.log(magnitude), np.ones(window), log_sum)
+        # the parity of the negative count gives the sign
+        negative = _window_count(values < 0, window)[window - 1:]
+        out[window - 1:] = np.where(negative % 2 == 1, -1.0, 1.0) * np.exp(log_sum)
+        out[window - 1:][_window_count(zero, window)[window - 1:] > 0] = 0
+        out[~_full_windows(values, window)] = np.nan
+    return _wrap(out, df)
+
+
+def _split_window_sums(blocks, m):
+    """
+    Every window of 'window' rows is the tail of one block of 'window' rows plus the head of the next block.
+    Return the sums over both parts for the m windows, from one running sum each way through every block,
+    so the cost does not grow with the window and each sum only adds up values of one or two neighbouring blocks.
+    :param blocks: a C-ordered numpy array of shape (n_blocks, window, n_columns).
+    :param m: number of windows (window starts 0 .. m-1).
+    :return: (tail_sums, head_sums), two numpy arrays of shape (m, n_columns); the head sum is 0 when the
+        window is a whole block.
+    """
+    n_blocks, window, c = blocks.shape
+    head = np.empty(blocks.shape)
+    tail = np.empty(blocks.shape)
+    head[:, 0] = blocks[:, 0]
+    tail[:, -1] = blocks[:, -1]
+    for i in range(1, window):
+        np.add(head[:, i - 1], blocks[:, i], out=head[:, i])
+        np.add(tail[:, -i], blocks[:, -i - 1], out=tail[:, -i - 1])
+    # the head of the window starting at row s ends at row s + window - 1
+    head = head.reshape(-1, c)[window - 1:window - 1 + m].copy()
+    # a window starting on a block boundary is a whole block and has no head part
+    head[::window] = 0
+    return tail.reshape(-1, c)[:m], head
+
+
+class _MomentCache(object):
+    """
+    Per-input pieces shared by the rolling_corr_cov requests of one window and one block of columns,
+    keyed by input, so an input used in several pairs (e.g. rank(volume)) is prepared and summed only once.
+    """
+
+    def __init__(self, n, window):
+        self.window = window
+        self.m = n - window + 1
+        self.n_blocks = -(-n // window)
+        n_head = (np.arange(self.m) % window).reshape(-1, 1).astype(float)
+        self.inv_tail = 1 / (window - n_head)
+        self.inv_head = 1 / np.maximum(n_head, 1)
+        # weight of the mean difference when merging the two parts: n_tail * n_head / window
+        self.weight = (window - n_head) * n_head / window
+        self.block = np.arange(self.m) // window
+        self.inputs = {}
+
+    def single(self, key, values):
+        """
+        Centred blocks, tail/head sums, gap between the tail and head means, the sum of squared deviations
+        and the masks of missing and constant windows of one input, for rows window-1 .. n-1.
+        """
+        if key not in self.inputs:
+            window, m = self.window, self.m
+            values = np.ascontiguousarray(values)
+            n, c = values.shape
+            finite = np.isfinite(values)
+            blocks = np.zeros((self.n_blocks * window, c))
+            np.copyto(blocks[:n], values, where=finite)
+            blocks = blocks.reshape(self.n_blocks, window, c)
+            count = np.zeros((self.n_blocks * window, c), dtype=bool)
+            count[:n] = finite
+            # centre each block on its first finite value so the sums only see local deviations; unlike the block
+            # mean it never depends on rows after the window (a window needing it holds that row), so appending
+            # rows to the data does not change earlier results, not even in the last bit
+            first = count.reshape(self.n_blocks, window, c).argmax(axis=1)
+            centre = np.take_along_axis(blocks, first[:, None, :], axis=1)[:, 0]
+            blocks -= centre[:, None, :]
+            blocks.reshape(-1, c)[:n][~finite] = 0
+            tail_sum, head_sum = _split_window_sums(blocks, m)
+            tail_sq, head_sq = _split_window_sums(blocks * blocks, m)
+            # difference between the tail mean and the head mean
+            centre_gap = centre - centre[np.minimum(np.arange(self.n_blocks) + 1, self.n_blocks - 1)]
+            gap = centre_gap[self.block] + tail_sum * self.inv_tail - head_sum * self.inv_head
+            # sum of squared deviations = tail part + head part + merge term
+            sq = tail_sq - tail_sum * tail_sum * self.inv_tail
+            sq += head_sq - head_sum * head_sum * self.inv_head
+            sq += gap * gap * self.weight
+            np.maximum(sq, 0, out=sq)
+            missing = _window_count(finite, window)[window - 1:] < window
+            # a window is constant when all of its window-1 consecutive pairs are equal
+            same = np.zeros(values.shape, dtype=bool)
+            same[1:] = values[1:] == values[:-1]
+            constant = _window_count(same, window - 1)[window - 1:] == window - 1 if window > 1 else ~missing
+            self.inputs[key] = (blocks, tail_sum, head_sum, gap, sq, missing, constant)
+        return self.inputs[key]
+
+    def comoment(self, x_key, y_key):
+        """
+        Sum of (x - mean x) * (y - mean y) over each window, merged from its tail and head parts.
+        """
+        bx, tx, hx, gx, _, _, _ = self.inputs[x_key]
+        by, ty, hy, gy, _, _, _ = self.inputs[y_key]
+        tail_xy, head_xy = _split_window_sums(bx * by, self.m)
+        # parallel merge of the two parts: C = C_tail + C_head + gap_x * gap_y * n_tail * n_head / n
+        out = tail_xy - tx * ty * self.inv_tail
+        out += head_xy
+        out -= hx * hy * self.inv_head
+        out += gx * gy * self.weight
+        return out
+
+
+def rolling_corr_cov(requests, fill_value=None):
+    """
+    Rolling correlation and covariance for a batch of (x, y, window) requests over the same panel.
+    The per-input pieces (block means, sums of squared deviations, missing/constant window masks) are computed
+    once per input and window and shared by every pair that uses them, so e.g. rank(volume) paired with several
+    series is only prepared once. Each window is split into the tail of one block and the head of the next and
+    the two parts are merged with the parallel co-moment formula, so the cost does not grow with the window and
+    large values far away in time do not cost precision. Columns are processed in blocks that fit in cache.
+    Up to rounding the results match x.rolling(window).corr(y) and x.rolling(window).cov(y): x and y are aligned
+    like pandas, a DataFrame paired with a Series uses the Series for every column, and windows where either
+    side holds NaN or inf give NaN. A window in which x or y is constant gives a NaN correlation
+    (pandas returns NaN or +/-inf there depending on rounding).
+    :param requests: list of (x, y, window) with pandas Series/DataFrame x and y.
+    :param fill_value: if not None, missing correlations are replaced by it, except for the first window-1 rows
+        which stay NaN (alphas191.Corr uses 0).
+    :return: list of (correlation, covariance) pandas objects, in the order of 'requests'.
+    """
+    arrays = {}
+    jobs = []
+    for x, y, window in requests:
+        if isinstance(x, pd.Series) and isinstance(y, pd.DataFrame):
+            x, y = y, x
+        if isinstance(y, pd.DataFrame):
+            if not (x.index.equals(y.index) and x.columns.equals(y.columns)):
+                x, y = x.align(y, join='outer')
+        elif not x.index.equals(y.index):
+            x, y = x.align(y, join='outer', axis=0)
+        for df in (x, y):
+            # keep 'df' alive so its id is not reused while 'arrays' exists
+            arrays.setdefault(id(df), (df, _values(df)))
+        shape = (len(x), x.shape[1] if isinstance(x, pd.DataFrame) else 1)
+        jobs.append((x, id(x), id(y), window, np.full(shape, np.nan), np.full(shape, np.nan)))
+
+    # one window and one block of columns at a time, sharing the per-input pieces inside each group
+    groups = {}
+    for job in jobs:
+        x, x_key, _, window, corr, _ = job
+        if 0 < window <= len(x):
+            groups.setdefault((tuple(x.index), window), []).append(job)
+    for (index, window), group in groups.items():
+        n = len(index)
+        n_columns = max(job[4].shape[1] for job in group)
+        step = max(1, (1 << 17) // n)
+        for start in range(0, n_columns, step):
+            cols = slice(start, start + step)
+            cache = _MomentCache(n, window)
+            for x, x_key, y_key, _, corr, cov in group:
+                if corr.shape[1] <= start:
+                    continue
+                # a single column (Series) is paired with every column of the block
+                keys = []
+                for key in (x_key, y_key):
+                    values = arrays[key][1]
+                    part = values if values.shape[1] == 1 else values[:, cols]
+                    keys.append((key, part.shape[1] == 1))
+                    cache.single(keys[-1], part)
+                _, _, _, _, sx, missing_x, constant_x = cache.inputs[keys[0]]
+                _, _, _, _, sy, missing_y, constant_y = cache.inputs[keys[1]]
+                cxy = cache.comoment(keys[0], keys[1]) if x_key != y_key else sx.copy()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    body = np.clip(cxy / np.sqrt(sx * sy), -1, 1)
+                missing = missing_x | missing_y
+                body[missing | constant_x | constant_y] = np.nan
+                corr[window - 1:, cols] = body
+                # sample covariance (ddof=1) is undefined for a one-day window
+                if window > 1:
+                    cxy /= window - 1
+                    cxy[missing] = np.nan
+                    cov[window - 1:, cols] = cxy
+
+    results = []
+    for x, _, _, window, corr, cov in jobs:
+        if fill_value is not None:
+            corr[np.isnan(corr)] = fill_value
+            corr[:window - 1] = np.nan
+        results.append((_wrap(corr, x), _wrap(cov, x)))
+    return results
+
+
+def _rank_last_axis(values, method, pct):
+    """
+    Rank along the last axis of a float array, NaN kept as NaN (pandas na_option='keep').
+    One argsort per call; tie groups are found on the sorted values. Except for 'first' (which needs a stable
+    sort with NaN last), NaN is sorted as +inf: numpy's vectorised sort skips arrays holding NaN, and the only
+    group this merges is the top one, whose upper end is then capped at the number of valid values.
+    :param values: a float numpy array.
+    :param method: 'average', 'min', 'max', 'first' or 'dense', as in pandas.
+    :param pct: if True, divide by the number of valid values (by the number of distinct values for 'dense').
+    :return: a float numpy array of the same shape.
+    """
+    if method not in ('average', 'min', 'max', 'first', 'dense'):
+        raise ValueError(f"method must be 'average', 'min', 'max', 'first' or 'dense', got {method!r}")
+    k = values.shape[-1]
+    missing = np.isnan(values)
+    count = k - missing.sum(axis=-1, keepdims=True)
+    position = np.arange(1, k + 1, dtype=float)
+    if method == 'first':
+        order = np.argsort(values, axis=-1, kind='stable')
+        ranks = np.broadcast_to(position, values.shape).copy()
+    else:
+        keys = np.where(missing, np.inf, values) if missing.any() else values
+        order = np.argsort(keys, axis=-1)
+        ordered = np.take_along_axis(keys, order, axis=-1)
+        # first and last position of every run of equal values
+        start = np.ones(values.shape, dtype=bool)
+        np.not_equal(ordered[..., 1:], ordered[..., :-1], out=start[..., 1:])
+        if method == 'dense':
+            ranks = np.cumsum(start, axis=-1).astype(float)
+        if method in ('min', 'average'):
+            low = np.maximum.accumulate(np.where(start, position, 0), axis=-1)
+        if method in ('max', 'average'):
+            end = np.ones(values.shape, dtype=bool)
+            end[..., :-1] = start[..., 1:]
+            high = np.minimum.accumulate(np.where(end, position, k)[..., ::-1], axis=-1)[..., ::-1]
+            np.minimum(high, count, out=high)
+        if method == 'min':
+            ranks = low
+        elif method == 'max':
+            ranks = high
+        elif method == 'average':
+            ranks = (low + high) / 2
+    if pct and method != 'dense':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ranks /= count
+    out = np.empty(values.shape)
+    np.put_along_axis(out, order, ranks, axis=-1)
+    out[missing] = np.nan
+    if pct and method == 'dense':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out /= np.max(np.where(missing, 0, out), axis=-1, keepdims=True)
+    return out
+
+
+def rank_panels(panels, axis=0, method='average', pct=False):
+    """
+    Rank many panels in one call, like df.rank(axis=axis, method=method, pct=pct) on each of them.
+    axis=0 ranks every column over time (time-series rank, alpha_code_1.rank);
+    axis=1 ranks every row across assets (cross-sectional rank, alphas191.Rank). NaN stays NaN and is not counted.
+    Each panel is ranked on its own, a block of rows at a time: the sort and its temporaries then stay in cache,
+    where stacking panels or sorting a whole panel at once is bound by memory bandwidth and loses to pandas.
+    :param panels: list of pandas Series/DataFrame (a Series is always ranked along its index).
+    :param axis: 0 or 1.
+    :param method: how to rank ties: 'average', 'min', 'max', 'first' or 'dense'.
+    :param pct: if True, return ranks divided by the number of valid values.
+    :return: list of pandas Series/DataFrame with the ranks, in the order of 'panels'.
+    """
+    if axis not in (0, 1):
+        raise ValueError(f"axis must be 0 or 1, got {axis!r}")
+    results = []
+    for df in panels:
+        values = _values(df)
+        # put the ranked axis last
+        transposed = axis == 0 or isinstance(df, pd.Series)
+        if transposed:
+            values = values.T
+        ranks = np.empty(values.shape)
+        step = max(1, (1 << 16) // max(values.shape[-1], 1))
+        for start in range(0, values.shape[0], step):
+            ranks[start:start + step] = _rank_last_axis(values[start:start + step], method, pct)
+        results.append(_wrap(ranks.T if transposed else ranks, df))
+    return results
+
+
+def rank_panel(df, axis=0, method='average', pct=False):
+    """
+    Same as df.rank(axis=axis, method=method, pct=pct); see rank_panels.
+    :param df: a pandas Series or DataFrame.
+    :return: a pandas Series or DataFrame with the ranks.
+    """
+    return rank_panels([df], axis, method, pct)[0]
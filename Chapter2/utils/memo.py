@@ -0,0 +1,190 @@
+"""
+Memoization of the alpha operators (Delay, Rank, Mean, ...) while a batch of alphas runs on the same data.
+
+A cache key is the operator name plus one token per argument. The result of a memoized operator is keyed by the
+way it was computed (operator name and the tokens of its own inputs), so an intermediate that is computed again,
+e.g. Rank(Delay(close, 1)) in two alphas, hits even when Delay(close, 1) was evicted and rebuilt as a new object.
+Objects that did not come out of a memoized operator, such as the input panel or plain pandas arithmetic
+(close - open, volume / Mean(volume, 20), ...), have no such token and are keyed by identity: those are new objects
+every time an alpha builds them, so an operator applied to them only hits when the very same object is passed again.
+OperatorCache.identity_misses counts the misses whose key holds such an identity token.
+"""
+import functools
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+_active_cache = None
+
+
+def _nbytes(value):
+    """
+    Memory held by an operator result, used for the cache budget.
+    DataFrame.memory_usage boxes every column as a Series, which costs more than most operators on wide panels,
+    so the size is taken from the column dtypes instead.
+    :param value: the result of an operator.
+    :return: size in bytes (0 for scalars and unknown objects).
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(len(value) * sum(dtype.itemsize for dtype in value.dtypes))
+    if isinstance(value, (pd.Series, np.ndarray)):
+        return int(value.nbytes)
+    return 0
+
+
+def _token(arg, cache, identities):
+    """
+    Part of a cache key for one operator argument.
+    Results of memoized operators are keyed by how they were computed (see the module docstring);
+    other pandas objects and large arrays by identity (the cache keeps them alive, so the id is not reused);
+    small arrays such as Sequence(n) by content; everything else by value.
+    :param arg: an operator argument.
+    :param cache: the active OperatorCache.
+    :param identities: a list that receives one entry for every identity token, to count identity-keyed misses.
+    :return: a hashable token.
+    """
+    if isinstance(arg, (pd.DataFrame, pd.Series)) or (isinstance(arg, np.ndarray) and arg.size > 1024):
+        origin = cache.origin(arg)
+        if origin is not None:
+            return ('op', origin)
+        identities.append(arg)
+        return ('id', id(arg))
+    if isinstance(arg, np.ndarray):
+        return ('array', arg.dtype.str, arg.shape, arg.tobytes())
+    if isinstance(arg, (list, tuple)):
+        return (type(arg).__name__,) + tuple(_token(a, cache, identities) for a in arg)
+    try:
+        hash(arg)
+    except TypeError:
+        identities.append(arg)
+        return ('id', id(arg))
+    return (type(arg).__name__, arg)
+
+
+class OperatorCache(object):
+    """
+    LRU cache of operator results keyed by operator name, operand tokens and parameters,
+    bounded by the total size of the cached results.
+    """
+
+    def __init__(self, max_bytes=2 * 1024 ** 3):
+        """
+        :param max_bytes: memory budget for the cached results; the least recently used results are evicted beyond it.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.identity_misses = 0
+        self._entries = OrderedDict()
+        # id(result) -> (weak reference to the result, key it was computed under)
+        self._origins = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        :return: (True, result) on a hit and (False, None) on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def origin(self, value):
+        """
+        :return: the key a live result of a memoized operator was computed under, or None for any other object.
+        """
+        entry = self._origins.get(id(value))
+        if entry is not None and entry[0]() is value:
+            return entry[1]
+        return None
+
+    def remember(self, key, result):
+        """
+        Record the key 'result' was computed under, for as long as the result object is alive,
+        so later operators applied to it are keyed by that key instead of by its identity.
+        """
+        if not isinstance(result, (pd.DataFrame, pd.Series, np.ndarray)):
+            return
+        result_id = id(result)
+
+        def forget(ref):
+            if self._origins.get(result_id, (None,))[0] is ref:
+                del self._origins[result_id]
+
+        self._origins[result_id] = (weakref.ref(result, forget), key)
+
+    def put(self, key, operands, result):
+        """
+        Store a result; 'operands' are the objects keyed by identity in 'key', kept alive with it so those ids stay valid.
+        """
+        size = _nbytes(result)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (operands, result, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._origins.clear()
+        self.nbytes = 0
+
+    def __repr__(self):
+        return (f"OperatorCache(entries={len(self)}, nbytes={self.nbytes}, hits={self.hits}, "
+                f"misses={self.misses}, identity_misses={self.identity_misses}, evictions={self.evictions})")
+
+
+@contextmanager
+def operator_cache(max_bytes=2 * 1024 ** 3):
+    """
+    Turn on memoization of the decorated operators inside a with block, e.g. while a batch of alphas runs on
+    the same data, so each distinct intermediate (Delay(close, 1), Rank(volume), ...) is computed once.
+    Results are shared between callers while the block is active and must not be modified in place.
+    :param max_bytes: memory budget for the cached results.
+    :return: the OperatorCache, for its statistics.
+    """
+    global _active_cache
+    previous = _active_cache
+    _active_cache = OperatorCache(max_bytes)
+    try:
+        yield _active_cache
+    finally:
+        _active_cache.clear()
+        _active_cache = previous
+
+
+def memoized(func):
+    """
+    Decorator for pure operators: inside operator_cache() the result is looked up by operator name,
+    operand tokens and parameters before computing it; outside it the operator runs unchanged.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        cache = _active_cache
+        if cache is None:
+            return func(*args, **kwargs)
+        identities = []
+        key = (func.__module__, func.__qualname__, _token(args, cache, identities),
+               _token(tuple(sorted(kwargs.items())), cache, identities))
+        hit, result = cache.get(key)
+        if not hit:
+            if identities:
+                cache.identity_misses += 1
+            result = func(*args, **kwargs)
+            cache.remember(key, result)
+            cache.put(key, identities, result)
+        return result
+    return wrapper
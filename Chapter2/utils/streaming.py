@@ -0,0 +1,538 @@
+import numpy as np
+import pandas as pd
+
+from .alphas191 import Alphas191
+from .formula import FUNCTIONS, _BINARY
+from .kernels import rank_panel
+
+
+# Element-wise formula functions on one row of assets
+_ELEMENTWISE = {'LOG': np.log, 'SIGN': np.sign, 'ABS': np.abs, 'MAX': np.maximum, 'MIN': np.minimum}
+
+# Rolling sums kept as running totals: SUM/MEAN of x, COUNT of cond, SUMIF of x where cond
+_RUNNING_SUMS = {'SUM', 'MEAN', 'COUNT', 'SUMIF'}
+
+
+class _Ring(object):
+    """
+    The last 'size' rows of an input, one column per asset.
+    """
+
+    def __init__(self, size, history):
+        """
+        :param size: number of rows kept.
+        :param history: 2-D numpy array of past rows; its last 'size' rows seed the buffer.
+        """
+        self.values = np.full((size, history.shape[1]), np.nan)
+        self.filled = min(size, len(history))
+        self.position = self.filled % size if size else 0
+        if self.filled:
+            self.values[:self.filled] = history[-self.filled:]
+
+    def full(self):
+        return self.filled == len(self.values)
+
+    def oldest(self):
+        return self.values[self.position]
+
+    def push(self, row):
+        """
+        Append a row, dropping the oldest one when the buffer is full.
+        """
+        self.values[self.position] = row
+        self.position = (self.position + 1) % len(self.values)
+        self.filled = min(self.filled + 1, len(self.values))
+
+    def ordered(self):
+        """
+        :return: the rows from the oldest to the newest.
+        """
+        if not self.full():
+            return self.values[:self.filled]
+        return np.concatenate((self.values[self.position:], self.values[:self.position]))
+
+
+class _Delay(object):
+    """
+    DELAY(x, n) and DELTA(x, n) from a buffer of the last n rows of x.
+    """
+
+    def __init__(self, op, n, history):
+        self.op = op
+        self.ring = _Ring(n, history) if n else None
+
+    def update(self, x):
+        if self.ring is None:
+            delayed = x
+        else:
+            delayed = self.ring.oldest().copy() if self.ring.full() else np.full(len(x), np.nan)
+            self.ring.push(x)
+        return x - delayed if self.op == 'DELTA' else delayed
+
+
+class _RunningSum(object):
+    """
+    Rolling SUM/MEAN/COUNT/SUMIF (min_periods=window) as running state, O(assets) per new row, following the
+    online algorithm of pandas rolling sum/mean step by step (Kahan-compensated add/remove, a run of one repeated
+    value gives exactly value * count, inf counts as missing), so the new rows round exactly like the batch run.
+    """
+
+    def __init__(self, op, window, history):
+        n = history.shape[1]
+        self.op = op
+        self.window = window
+        self.ring = _Ring(window, history[:0])
+        self.sum = np.zeros(n)
+        self.compensation_add = np.zeros(n)
+        self.compensation_remove = np.zeros(n)
+        self.nobs = np.zeros(n, dtype=np.int64)
+        self.negative = np.zeros(n, dtype=np.int64)
+        self.repeats = np.zeros(n, dtype=np.int64)
+        self.last = np.full(n, np.nan)
+        # the compensation terms depend on every earlier row, so the whole history is replayed
+        for row in history:
+            self._push(row)
+
+    @staticmethod
+    def _kahan(total, compensation, value, observed):
+        y = value - compensation
+        t = total + y
+        return np.where(observed, t, total), np.where(observed, t - total - y, compensation)
+
+    def _push(self, row):
+        row = np.where(np.isinf(row), np.nan, row)
+        if self.ring.full():
+            old = self.ring.oldest()
+            observed = old == old
+            self.sum, self.compensation_remove = self._kahan(self.sum, self.compensation_remove, -old, observed)
+            self.nobs -= observed
+            self.negative -= observed & np.signbit(old)
+        observed = row == row
+        self.sum, self.compensation_add = self._kahan(self.sum, self.compensation_add, row, observed)
+        self.nobs += observed
+        self.negative += observed & np.signbit(row)
+        self.repeats = np.where(observed, np.where(row == self.last, self.repeats + 1, 1), self.repeats)
+        self.last = np.where(observed, row, self.last)
+        self.ring.push(row)
+
+    def update(self, x, cond=None):
+        if self.op == 'COUNT':
+            x = np.asarray(x, dtype=float)
+        elif self.op == 'SUMIF':
+            x = np.where(cond, x, 0)
+        self._push(x)
+        repeated = self.repeats >= self.nobs
+        if self.op == 'MEAN':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = self.sum / self.nobs
+            result = np.where((self.negative == 0) & (result < 0), 0, result)
+            result = np.where((self.negative == self.nobs) & (result > 0), 0, result)
+            result = np.where(repeated, self.last, result)
+        else:
+            result = np.where(repeated, self.last * self.nobs, self.sum)
+        return np.where(self.nobs >= self.window, result, np.nan)
+
+
+class _Sma(object):
+    """
+    SMA(x, n, m) = x.ewm(alpha=m/n, adjust=False).mean(), carried forward with the same recursion as pandas
+    (ignore_na=False: the previous average keeps decaying across missing values).
+    """
+
+    def __init__(self, n, m, history):
+        self.alpha = m / n
+        self.weighted = np.full(history.shape[1], np.nan)
+        self.old_wt = np.ones(history.shape[1])
+        self.nobs = np.zeros(history.shape[1], dtype=np.int64)
+        for row in history:
+            self.update(row)
+
+    def update(self, x):
+        x = np.where(np.isinf(x), np.nan, x)
+        observed = x == x
+        started = self.weighted == self.weighted
+        self.old_wt = np.where(started, self.old_wt * (1 - self.alpha), self.old_wt)
+        mixed = started & observed & (self.weighted != x)
+        with np.errstate(invalid='ignore'):
+            average = (self.old_wt * self.weighted + self.alpha * x) / (self.old_wt + self.alpha)
+        self.weighted = np.where(mixed, average, self.weighted)
+        self.old_wt = np.where(started & observed, 1.0, self.old_wt)
+        self.weighted = np.where(~started & observed, x, self.weighted)
+        self.nobs += observed
+        return np.where(self.nobs >= 1, self.weighted, np.nan)
+
+
+class _RunningStd(object):
+    """
+    Rolling STD (ddof=1, min_periods=window) as running state, O(assets) per new row, following the online
+    Welford algorithm of pandas rolling var step by step (Kahan-compensated mean, separate compensation for
+    added and removed values, a run of one repeated value gives exactly 0, inf counts as missing).
+    """
+
+    def __init__(self, window, history):
+        n = history.shape[1]
+        self.window = window
+        self.ring = _Ring(window, history[:0])
+        self.nobs = np.zeros(n, dtype=np.int64)
+        self.mean = np.zeros(n)
+        self.ssqdm = np.zeros(n)
+        self.compensation_add = np.zeros(n)
+        self.compensation_remove = np.zeros(n)
+        self.repeats = np.zeros(n, dtype=np.int64)
+        self.last = np.full(n, np.nan)
+        # the compensation terms depend on every earlier row, so the whole history is replayed
+        for row in history:
+            self._push(row)
+
+    def _step(self, value, observed, compensation, sign):
+        prev_mean = self.mean - compensation
+        y = value - compensation
+        t = y - self.mean
+        compensation = np.where(observed, t + self.mean - y, compensation)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.mean + sign * t / self.nobs
+        ssqdm = self.ssqdm + sign * (value - prev_mean) * (value - mean)
+        # the last value removed from a window resets the state
+        emptied = observed & (self.nobs == 0)
+        self.mean = np.where(emptied, 0, np.where(observed, mean, self.mean))
+        self.ssqdm = np.where(emptied, 0, np.where(observed, ssqdm, self.ssqdm))
+        return compensation
+
+    def _push(self, row):
+        row = np.where(np.isinf(row), np.nan, row)
+        if self.ring.full():
+            old = self.ring.oldest()
+            observed = old == old
+            self.nobs -= observed
+            self.compensation_remove = self._step(old, observed, self.compensation_remove, -1)
+        observed = row == row
+        self.nobs += observed
+        self.repeats = np.where(observed, np.where(row == self.last, self.repeats + 1, 1), self.repeats)
+        self.last = np.where(observed, row, self.last)
+        self.compensation_add = self._step(row, observed, self.compensation_add, 1)
+        self.ring.push(row)
+
+    def update(self, x):
+        self._push(x)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.where((self.nobs == 1) | (self.repeats >= self.nobs), 0, self.ssqdm / (self.nobs - 1))
+        std = np.sqrt(np.maximum(var, 0))
+        return np.where((self.nobs >= self.window) & (self.nobs > 1), std, np.nan)
+
+
+class _RunningCov(object):
+    """
+    Rolling CORR/COV of two inputs as running sums, O(assets) per new row (amortised), rounding exactly like the
+    batch kernel (kernels.rolling_corr_cov). As there, the rows are cut into blocks of 'window' rows counted from
+    the first row of the data, each block centred on its first finite value, and every window is the tail of one
+    block plus the head of the next, merged with the parallel co-moment formula. The head sums of the current
+    block are running sums over its rows; the tail sums of a block are taken once when it is complete.
+    The sums therefore only depend on the values inside the window, so equal windows of different assets give
+    bit-identical results and ties survive a later RANK.
+    """
+
+    # per input pair: x, y, x*x, y*y, x*y
+    _SUMS = 5
+
+    def __init__(self, op, window, history_x, history_y):
+        n = history_x.shape[1]
+        self.op = op
+        self.window = window
+        self.rows = 0
+        self.block = np.zeros((window, self._SUMS, n))
+        self.head = np.zeros((self._SUMS, n))
+        self.tail = np.zeros((window, self._SUMS, n))
+        self.centre = np.full((2, n), np.nan)
+        self.tail_centre = np.zeros((2, n))
+        self.finite = _Ring(window, np.zeros((0, n)))
+        self.missing = np.zeros(n, dtype=np.int64)
+        # number of consecutive equal pairs ending at the last row, per input
+        self.equal = np.zeros((2, n), dtype=np.int64)
+        self.last = np.full((2, n), np.nan)
+        # the sums only need the last complete block and the current one
+        start = max(len(history_x) - 2 * window, 0) // window * window
+        self.rows = start
+        for x, y in zip(history_x[start:], history_y[start:]):
+            self._push(x, y)
+
+    def _push(self, x, y):
+        window = self.window
+        position = self.rows % window
+        self.rows += 1
+        values = np.stack((x, y))
+        finite = np.isfinite(values)
+        if position == 0:
+            self.centre[:] = np.nan
+        # centre of the block: its first finite value
+        self.centre = np.where(np.isnan(self.centre) & finite, values, self.centre)
+        deviation = np.where(finite, values - self.centre, 0)
+        row = self.block[position]
+        row[0], row[1] = deviation
+        np.multiply(deviation, deviation, out=row[2:4])
+        np.multiply(deviation[0], deviation[1], out=row[4])
+        if position == 0:
+            self.head[:] = row
+        else:
+            self.head += row
+        if position == window - 1:
+            # block complete: its suffix sums are the tail sums of the windows starting inside it
+            self.tail[-1] = self.block[-1]
+            for i in range(1, window):
+                np.add(self.tail[-i], self.block[-i - 1], out=self.tail[-i - 1])
+            self.tail_centre = np.where(np.isnan(self.centre), 0, self.centre)
+        both = finite[0] & finite[1]
+        if self.finite.full():
+            self.missing -= ~self.finite.oldest().astype(bool)
+        self.missing += ~both
+        self.finite.push(both)
+        self.equal = np.where(values == self.last, self.equal + 1, 0)
+        self.last = values
+
+    def update(self, x, y):
+        self._push(x, y)
+        window, n = self.window, len(x)
+        if self.rows < window:
+            return np.full(n, np.nan)
+        n_head = float(self.rows % window)
+        inv_tail = 1 / (window - n_head)
+        inv_head = 1 / max(n_head, 1)
+        weight = (window - n_head) * n_head / window
+        tail = self.tail[int(n_head)]
+        if n_head:
+            head, centre_gap = self.head, self.tail_centre - self.centre
+        else:
+            # the window is the block just completed
+            head, centre_gap = np.zeros_like(self.head), np.zeros((2, n))
+        gap = centre_gap + tail[:2] * inv_tail - head[:2] * inv_head
+        sq = tail[2:4] - tail[:2] * tail[:2] * inv_tail
+        sq += head[2:4] - head[:2] * head[:2] * inv_head
+        sq += gap * gap * weight
+        np.maximum(sq, 0, out=sq)
+        cxy = tail[4] - tail[0] * tail[1] * inv_tail
+        cxy += head[4]
+        cxy -= head[0] * head[1] * inv_head
+        cxy += gap[0] * gap[1] * weight
+        missing = self.missing > 0
+        if self.op == 'CORR':
+            constant = (self.equal >= window - 1).any(axis=0) if window > 1 else ~missing
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corr = np.clip(cxy / np.sqrt(sq[0] * sq[1]), -1, 1)
+            corr[missing | constant] = np.nan
+            corr[np.isnan(corr)] = 0
+            return corr
+        if window == 1:
+            return np.full(n, np.nan)
+        cxy /= window - 1
+        cxy[missing] = np.nan
+        return cxy
+
+
+class _Extreme(object):
+    """
+    Rolling TSMAX/TSMIN and the HIGHDAY/LOWDAY days since the extreme, from a monotonic deque per asset:
+    the positions of the values that can still become the window extreme, oldest first, their values decreasing
+    (increasing for a minimum). A new row drops the expired front and every smaller value at the back, so each
+    row enters and leaves the deque once (O(1) amortised per asset). An equal value does not drop the earlier one,
+    so ties give the earliest day like rolling_argmax. A NaN or inf empties the deque: no window holding it has
+    a value. The deques are stored as ring buffers over all assets and updated with vectorized numpy operations.
+    """
+
+    def __init__(self, op, window, history):
+        n = history.shape[1]
+        self.op = op
+        self.window = window
+        self.sign = 1.0 if op in ('TSMAX', 'HIGHDAY') else -1.0
+        self.columns = np.arange(n)
+        self.keys = np.zeros((window, n))
+        self.days = np.zeros((window, n), dtype=np.int64)
+        self.head = np.zeros(n, dtype=np.int64)
+        self.size = np.zeros(n, dtype=np.int64)
+        self.last_missing = np.full(n, -1, dtype=np.int64)
+        # only the last 'window' rows can still be part of a window
+        seed = history[-window:]
+        self.rows = len(history) - len(seed)
+        for row in seed:
+            self.update(row)
+
+    def update(self, x):
+        day = self.rows
+        self.rows += 1
+        window, columns = self.window, self.columns
+        finite = np.isfinite(x)
+        key = self.sign * x
+        expired = (self.size > 0) & (self.days[self.head, columns] <= day - window)
+        self.head = np.where(expired, (self.head + 1) % window, self.head)
+        self.size -= expired
+        self.size[~finite] = 0
+        self.last_missing[~finite] = day
+        while True:
+            back = (self.head + self.size - 1) % window
+            smaller = finite & (self.size > 0) & (self.keys[back, columns] < key)
+            if not smaller.any():
+                break
+            self.size -= smaller
+        back = ((self.head + self.size) % window)[finite]
+        self.keys[back, columns[finite]] = key[finite]
+        self.days[back, columns[finite]] = day
+        self.size += finite
+        valid = (day - self.last_missing >= window) & (day + 1 >= window)
+        if self.op in ('TSMAX', 'TSMIN'):
+            result = self.sign * self.keys[self.head, columns]
+        else:
+            # window - position of the extreme in the window (0 = oldest day)
+            result = (day + 1 - self.days[self.head, columns]).astype(float)
+        return np.where(valid, result, np.nan)
+
+
+class _Window(object):
+    """
+    The rolling operators that need every value of the window (TSRANK, DECAYLINEAR, WMA, REGBETA, PROD):
+    the batch operator is applied to the buffered window only, i.e. 'window' rows instead of the whole history,
+    and its last row is kept.
+    """
+
+    def __init__(self, op, kinds, params, window, histories, columns):
+        self.func = FUNCTIONS[op][0]
+        self.kinds = kinds
+        self.params = params
+        self.columns = columns
+        self.rings = [_Ring(window, history) for history in histories]
+
+    def update(self, *xs):
+        frames = []
+        for ring, x in zip(self.rings, xs):
+            ring.push(x)
+            frames.append(pd.DataFrame(ring.ordered(), columns=self.columns))
+        frames, params = iter(frames), iter(self.params)
+        args = [next(frames) if kind == 'x' else next(params) for kind in self.kinds]
+        return np.asarray(self.func(*args), dtype=float)[-1]
+
+
+class StreamingAlphas191(object):
+    """
+    Incremental daily update of compiled Alphas191 formulas: after a batch evaluation over the history,
+    each new trading day of OHLCV produces one new row of every formula without recomputing the history.
+    Every stateful node of the formula DAG keeps its own rolling state per asset, updated in O(assets) per day:
+    lagged buffers for DELAY/DELTA, running window sums for SUM/MEAN/COUNT/SUMIF, running moments for STD and
+    CORR/COV, monotonic deques for TSMAX/TSMIN/HIGHDAY/LOWDAY and the EWM state of SMA. Only the operators that
+    need every value of the window (TSRANK, DECAYLINEAR, WMA, REGBETA, PROD) keep the last 'window' rows and
+    rerun the batch operator on them. Element-wise operations and RANK only need the new row.
+    The asset universe is fixed by the history; the benchmark fields are not supported.
+    """
+
+    def __init__(self, compiler, data, names=None):
+        """
+        :param compiler: a formula.FormulaCompiler holding the formulas.
+        :param data: the history, an Alphas191 instance or the dict of stock data that Alphas191 is built from.
+        :param names: the formulas to update, all of them by default.
+        """
+        if not isinstance(data, Alphas191):
+            data = Alphas191(data)
+        self.compiler = compiler
+        self.names = list(compiler.outputs) if names is None else list(names)
+        self.roots = [compiler.outputs[name] for name in self.names]
+        self.needed = compiler.dependencies(self.roots)
+        self.columns = data.close.columns
+        self.last_close = data.close.to_numpy(dtype=float)[-1]
+
+        inputs = set()
+        for node_id in self.needed:
+            op, args = compiler.nodes[node_id]
+            if op == 'field' and args.startswith('benchmark'):
+                raise ValueError(f"streaming update does not support the field {args!r}")
+            if op in FUNCTIONS and op not in _ELEMENTWISE and op not in ('RANK', 'SEQUENCE'):
+                inputs.update(a for a, kind in zip(args, FUNCTIONS[op][1]) if kind == 'x')
+        history = compiler.evaluate_nodes(data, inputs)
+        n_assets = len(self.columns)
+
+        def rows(node_id):
+            value = history[node_id]
+            if np.ndim(value) == 0:
+                return np.full((len(data.close), n_assets), float(value))
+            return np.asarray(value, dtype=float).reshape(len(value), -1)
+
+        # Rolling state of each stateful node, seeded with the end of its inputs' history
+        self.states = {}
+        for node_id in self.needed:
+            op, args = compiler.nodes[node_id]
+            if op not in FUNCTIONS or op in _ELEMENTWISE or op in ('RANK', 'SEQUENCE'):
+                continue
+            kinds = FUNCTIONS[op][1]
+            xs = [a for a, kind in zip(args, kinds) if kind == 'x']
+            params = [compiler.nodes[a][1] for a, kind in zip(args, kinds) if kind == 'n']
+            if op in ('DELAY', 'DELTA'):
+                self.states[node_id] = _Delay(op, int(params[0]), rows(xs[0]))
+            elif op == 'SUMIF':
+                cond = rows(xs[1]).astype(bool)
+                self.states[node_id] = _RunningSum(op, int(params[0]), np.where(cond, rows(xs[0]), 0))
+            elif op in _RUNNING_SUMS:
+                self.states[node_id] = _RunningSum(op, int(params[0]), rows(xs[0]))
+            elif op == 'SMA':
+                self.states[node_id] = _Sma(params[0], params[1], rows(xs[0]))
+            elif op == 'STD':
+                self.states[node_id] = _RunningStd(int(params[0]), rows(xs[0]))
+            elif op in ('CORR', 'COV'):
+                self.states[node_id] = _RunningCov(op, int(params[0]), rows(xs[0]), rows(xs[1]))
+            elif op in ('TSMAX', 'TSMIN', 'HIGHDAY', 'LOWDAY'):
+                self.states[node_id] = _Extreme(op, int(params[0]), rows(xs[0]))
+            else:
+                window = len(params[0]) if op == 'REGBETA' else int(params[-1])
+                self.states[node_id] = _Window(op, kinds, params, window, [rows(x) for x in xs], self.columns)
+
+    def _row(self, row):
+        """
+        The fields of one new day as arrays over the assets of the history.
+        """
+        fields = {}
+        for field in ('open', 'high', 'low', 'close', 'volume', 'amount', 'vwap'):
+            if field in row:
+                value = row[field]
+                if isinstance(value, pd.Series):
+                    value = value.reindex(self.columns)
+                fields[field] = np.asarray(value, dtype=float)
+        close = fields['close']
+        # Same as Returns: NaN unless both closes are finite
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = close / self.last_close - 1
+        fields['returns'] = np.where(np.isfinite(close) & np.isfinite(self.last_close), returns, np.nan)
+        self.last_close = close
+        return fields
+
+    def update(self, date, row):
+        """
+        Append one trading day.
+        :param date: label of the new row.
+        :param row: dict field -> pandas Series over the assets (or numpy array in the order of the history),
+        with at least the fields the formulas use among open, high, low, close, volume, amount and vwap.
+        :return: dict formula name -> pandas Series of the new values, indexed by asset and named 'date'.
+        """
+        fields = self._row(row)
+        values = {}
+        for node_id in self.needed:
+            op, args = self.compiler.nodes[node_id]
+            if op == 'const':
+                values[node_id] = args
+            elif op == 'field':
+                values[node_id] = fields[args]
+            elif node_id in self.states:
+                xs = [np.broadcast_to(np.asarray(values[a], dtype=float), self.columns.shape)
+                      for a, kind in zip(args, FUNCTIONS[op][1]) if kind == 'x']
+                if op == 'SUMIF':
+                    values[node_id] = self.states[node_id].update(xs[0], xs[1].astype(bool))
+                else:
+                    values[node_id] = self.states[node_id].update(*xs)
+            elif op == 'RANK':
+                value = np.broadcast_to(np.asarray(values[args[0]], dtype=float), self.columns.shape)
+                values[node_id] = rank_panel(pd.DataFrame(value[None, :]), axis=1, method='min', pct=True).to_numpy()[0]
+            elif op in _ELEMENTWISE:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    values[node_id] = _ELEMENTWISE[op](*[values[a] for a in args])
+            elif op == 'neg':
+                values[node_id] = -values[args[0]]
+            elif op == '?':
+                values[node_id] = np.where(*[values[a] for a in args])
+            else:
+                with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                    values[node_id] = _BINARY[op](values[args[0]], values[args[1]])
+        return {name: pd.Series(np.broadcast_to(values[node_id], self.columns.shape), index=self.columns, name=date)
+                for name, node_id in zip(self.names, self.roots)}